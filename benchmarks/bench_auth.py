@@ -0,0 +1,60 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Measures login verification throughput of chat_auth.Authenticator
+for different worker pool sizes, for cold logins (full PBKDF2 check) and for the
+cached path a reconnect storm takes.
+
+Usage: python -m benchmarks.bench_auth [--logins N] [--pools 1,2,4,8] [--iterations N]
+'''
+
+# Using Python version 3.12.0
+
+import argparse
+import time
+
+from chat_auth import HASH_ITERATIONS, Authenticator, LoginRateLimiter, hash_password
+
+
+def run(pool_size, logins, stored, cached):
+    """
+    Verifies 'logins' passwords and returns logins per second.
+    """
+    # Rate limiting is disabled so only verification cost is measured
+    auth = Authenticator(workers=pool_size, limiter=LoginRateLimiter(burst=0))
+    try:
+        if cached:
+            for user, (password, hashed) in stored.items():
+                auth.verify(user, password, hashed).result()
+        start = time.perf_counter()
+        futures = [auth.verify(user, password, hashed) for user, (password, hashed) in stored.items()]
+        ok = all(future.result() for future in futures)
+        elapsed = time.perf_counter() - start
+    finally:
+        auth.close()
+    assert ok, "verification failed"
+    return logins / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Login verification benchmark.")
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--pools', default='1,2,4,8')
+    parser.add_argument('--iterations', type=int, default=HASH_ITERATIONS)
+    args = parser.parse_args()
+
+    print(f"Hashing {args.logins} test accounts ({args.iterations} PBKDF2 iterations)...")
+    stored = {}
+    for i in range(args.logins):
+        password = f"pw{i:05d}"
+        stored[f"user{i:05d}"] = (password, hash_password(password, args.iterations))
+
+    print(f"{'pool':>6} {'cold logins/s':>15} {'cached logins/s':>17}")
+    for pool_size in (int(p) for p in args.pools.split(',')):
+        cold = run(pool_size, args.logins, stored, cached=False)
+        warm = run(pool_size, args.logins, stored, cached=True)
+        print(f"{pool_size:>6} {cold:>15.1f} {warm:>17.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Measures the memory a broadcast to many clients costs, with
+tracemalloc. Every recipient has an outbound queue like a server connection
+(chat_outbound.py) and speaks the legacy, framed or binary protocol. The same
+"send all" is queued to all of them once with a copy encoded for every recipient
+(what the server did before SharedMessage) and once with the shared encoding of
+SharedMessage, then written to sockets that take only part of the first message,
+so every queue is resumed after a partial write. Reported per broadcast: the
+bytes still held by the queues once it is queued, the peak while queueing and the
+peak while writing, above what was allocated before. The first broadcast of a
+sender also carries its DEFINE frame to binary recipients; the second one does not.
+
+Usage: python -m benchmarks.bench_broadcast_memory [--recipients 10000] [--length 200]
+'''
+
+# Using Python version 3.12.0
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+from chat_binary import BinarySession
+from chat_outbound import OutboundQueue, write_queued
+from chat_protocol import SharedMessage
+
+PROTOCOLS = ('legacy', 'framed', 'binary')
+
+
+class Recipient:
+    """
+    The attributes SharedMessage.encode_for() looks at, and an unbounded queue.
+    """
+    def __init__(self, protocol):
+        self.framed = protocol != 'legacy'
+        self.binary = BinarySession() if protocol == 'binary' else None
+        self.outq = OutboundQueue(0)
+
+
+class PartialSocket:
+    """
+    Takes half of what the first call offers, then everything; nothing is kept.
+    """
+    def __init__(self):
+        self.calls = 0
+
+    def send(self, data):
+        return self.take(len(data))
+
+    def sendmsg(self, buffers):
+        return self.take(sum(len(buffer) for buffer in buffers))
+
+    def take(self, length):
+        self.calls += 1
+        return length // 2 if self.calls == 1 else length
+
+
+def queue_copies(recipients, sender, text):
+    """
+    Encodes the message again for every recipient: each one gets a SharedMessage of
+    its own, so nothing is shared.
+    """
+    for client in recipients:
+        client.outq.push(SharedMessage(f"{sender}: {text}", 'all', sender, text).encode_for(client))
+
+
+def queue_shared(recipients, sender, text):
+    shared = SharedMessage(f"{sender}: {text}", 'all', sender, text)
+    for client in recipients:
+        client.outq.push(shared.encode_for(client))
+
+
+def write_queues(recipients):
+    for client in recipients:
+        sock = PartialSocket()
+        while client.outq:
+            write_queued(sock, client.outq)
+
+
+def measure(queue, recipients, sender, text):
+    """
+    Returns (bytes held after queueing, peak while queueing, peak while writing,
+    seconds to queue) for one broadcast.
+    """
+    gc.collect()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    queue(recipients, sender, text)
+    elapsed = time.perf_counter() - start
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    write_queues(recipients)
+    written = tracemalloc.get_traced_memory()[1]
+    return held - base, peak - base, written - held, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory of a broadcast to many clients.")
+    parser.add_argument('--recipients', type=int, default=10000)
+    parser.add_argument('--length', type=int, default=200, help="characters of the message text")
+    parser.add_argument('--protocols', default=','.join(PROTOCOLS),
+                        help="comma separated protocols the recipients use, in turn")
+    args = parser.parse_args()
+    protocols = args.protocols.split(',')
+    if not set(protocols) <= set(PROTOCOLS):
+        parser.error(f"protocols are {', '.join(PROTOCOLS)}")
+
+    text = "x" * args.length
+    print(f"{args.recipients} recipients ({', '.join(protocols)}), {args.length} character message")
+    print(f"{'encoding':<14} {'broadcast':<10} {'held KiB':>9} {'B/client':>9} {'peak KiB':>9} "
+          f"{'write KiB':>10} {'queue ms':>9}")
+    tracemalloc.start()
+    for name, queue in (('per recipient', queue_copies), ('shared', queue_shared)):
+        # New connections and a new sender, so the first broadcast needs the DEFINE frames again
+        recipients = [Recipient(protocols[i % len(protocols)]) for i in range(args.recipients)]
+        sender = f"sender-{name.replace(' ', '-')}"
+        for broadcast in ('first', 'second'):
+            held, peak, written, elapsed = measure(queue, recipients, sender, text)
+            print(f"{name:<14} {broadcast:<10} {held / 1024:>9.0f} {held / args.recipients:>9.1f} "
+                  f"{peak / 1024:>9.0f} {written / 1024:>10.0f} {elapsed * 1000:>9.1f}")
+    tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    main()
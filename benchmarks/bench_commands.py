@@ -0,0 +1,169 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Measures how many text command lines per second the server
+can parse and route to their handler, with the command dispatch table of
+chat_commands.py and with the if/elif chain process_command() used before it
+(reproduced below: split the line, split "send" lines again, then compare the
+command name with each command in turn and check the login state and the number
+of arguments in every branch). Only parsing, routing and those checks are timed;
+the handlers are replaced by a function that does nothing, so the numbers do not
+depend on presence, rooms or sockets.
+
+Usage: python -m benchmarks.bench_commands [--commands 50000] [--repeat 10]
+'''
+
+# Using Python version 3.12.0
+
+import argparse
+import gc
+import time
+
+from chat_commands import CommandTable, Session
+from chat_serverV2 import commands as server_commands
+
+# Command lines by kind, as a logged in user sends them
+SAMPLES = {
+    'send all': "send all hello everyone, this is a message of ordinary length",
+    'send user': "send user042 direct message with a little text in it",
+    'send #room': "send #lobby room message with a little text in it",
+    'who': "who",
+    'history': "history user042 20",
+    'join': "join #lobby",
+    'unknown': "frobnicate now",
+}
+
+
+def handled(client, args):
+    return ""
+
+
+def legacy_parse(command_line):
+    tokens = command_line.split()
+    cmd = tokens[0].lower()
+    if cmd == "send":
+        return cmd, command_line.split(' ', 2)[1:]
+    return cmd, tokens[1:]
+
+
+def legacy_route(client, command_line):
+    """
+    The routing of the former if/elif process_command(), each handler body
+    replaced by handled().
+    """
+    cmd, args = legacy_parse(command_line)
+    if cmd == "login":
+        if len(args) != 2:
+            return "Usage: login <UserID> <Password>"
+        elif client.user:
+            return f"Error: Already logged in as {client.user}"
+        return handled(client, args)
+    elif cmd == "newuser":
+        if len(args) != 2:
+            return "Usage: newuser <UserID> <Password>"
+        elif client.user:
+            return "Error: Cannot create new user while logged in"
+        return handled(client, args)
+    elif cmd == "send":
+        if not client.user:
+            return "Denied. Please login first."
+        elif not args:
+            return "Usage: send <target> <message>"
+        return handled(client, args)
+    elif cmd == "who":
+        if not client.user:
+            return "Denied. Please login first."
+        return handled(client, args)
+    elif cmd == "join":
+        if not client.user:
+            return "Denied. Please login first."
+        elif len(args) != 1:
+            return "Usage: join <#room>"
+        return handled(client, args)
+    elif cmd == "leave":
+        if not client.user:
+            return "Denied. Please login first."
+        elif len(args) != 1:
+            return "Usage: leave <#room>"
+        return handled(client, args)
+    elif cmd == "rooms":
+        if not client.user:
+            return "Denied. Please login first."
+        return handled(client, args)
+    elif cmd == "history":
+        if not client.user:
+            return "Denied. Please login first."
+        return handled(client, args)
+    elif cmd == "logout":
+        if not client.user:
+            return "Error: You are not logged in"
+        return handled(client, args)
+    else:
+        return "Error: Unknown command"
+
+
+def table_router():
+    """
+    Returns a routing function over a copy of the server's dispatch table, with the
+    same states, argument counts and responses but the handlers replaced.
+    """
+    table = CommandTable()
+    for entry in server_commands.commands.values():
+        table.register(entry.name, handled, states=entry.states, args=(entry.min_args, entry.max_args),
+                       usage=entry.usage, denied=entry.denied, rest=entry.rest)
+
+    def route(client, command_line):
+        entry, cmd, args = table.parse(command_line)
+        if entry is None:
+            return "Error: Unknown command"
+        return table.dispatch(client, entry, args)
+    return route
+
+
+def lines_per_second(routers, client, lines, repeat):
+    """
+    Returns the best rate of each router over 'repeat' runs. The routers take turns,
+    so a busy moment on the machine does not hit just one of them.
+    """
+    best = [None] * len(routers)
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            for index, (_, route) in enumerate(routers):
+                start = time.perf_counter()
+                for line in lines:
+                    route(client, line)
+                elapsed = time.perf_counter() - start
+                if best[index] is None or elapsed < best[index]:
+                    best[index] = elapsed
+    finally:
+        gc.enable()
+    return [len(lines) / elapsed for elapsed in best]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Command dispatch benchmark.")
+    parser.add_argument('--commands', type=int, default=50000, help="command lines per run")
+    parser.add_argument('--repeat', type=int, default=10, help="runs per measurement, the best one counts")
+    args = parser.parse_args()
+
+    client = Session()
+    client.login('user001')
+    routers = (('if/elif', legacy_route), ('table', table_router()))
+    # Both must answer every sample alike, or the comparison is meaningless
+    for line in SAMPLES.values():
+        answers = {route(client, line) for _, route in routers}
+        if len(answers) != 1:
+            raise SystemExit(f"Routers disagree on {line!r}: {answers}")
+
+    workloads = [(kind, [line] * args.commands) for kind, line in SAMPLES.items()]
+    mix = list(SAMPLES.values())
+    workloads.append(('mix', [mix[i % len(mix)] for i in range(args.commands)]))
+    print(f"{'command':<12} {'if/elif/s':>12} {'table/s':>12} {'speedup':>8}")
+    for kind, lines in workloads:
+        old, new = lines_per_second(routers, client, lines, args.repeat)
+        print(f"{kind:<12} {old:>12.0f} {new:>12.0f} {new / old:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Measures the reconnect storm after a server restart. A number
+of logged in clients (asyncio client library, which reconnects and logs in again by
+itself) are connected to chat_serverV2.py when it gets SIGTERM; as soon as it has
+exited a new server process is started on the same port and directory, like a deploy
+would. This is done once with --drain-timeout 0 (every connection is closed at once
+and the clients retry on their own backoff) and once with the drain (every client is
+told when to come back, at random over --reconnect-spread seconds, and the
+connections are closed in batches). Reported: how long the old server took to exit,
+when the clients were logged in again, and the most logins that landed within any
+100 ms, which is what the new server has to absorb.
+
+Usage: python -m benchmarks.bench_drain [--clients 500] [--reconnect-spread 5] [--mode event]
+'''
+
+# Using Python version 3.12.0
+
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from chat_aioclient import ChatSession, connect
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'chat_serverV2.py')
+
+# Window of the peak reconnect rate
+WINDOW = 0.1
+
+
+def start_server(args, directory, drain_timeout):
+    return subprocess.Popen(
+        [sys.executable, SERVER, '--mode', args.mode, '--port', str(args.port), '--max-clients', '0',
+         '--hash-iterations', '1000', '--user-commands', '0', '--user-bytes', '0', '--login-timeout', '0',
+         '--log-level', 'warning', '--drain-timeout', str(drain_timeout),
+         '--reconnect-spread', str(args.reconnect_spread)],
+        cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_until_up(port, timeout=10.0):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise SystemExit(f"The server on port {port} did not start")
+            await asyncio.sleep(0.05)
+            continue
+        writer.close()
+        return
+
+
+def peak_rate(times):
+    """
+    Returns the most events within any WINDOW seconds.
+    """
+    peak = start = 0
+    for end in range(len(times)):
+        while times[end] - times[start] > WINDOW:
+            start += 1
+        peak = max(peak, end - start + 1)
+    return peak
+
+
+async def restart(args, drain_timeout):
+    """
+    Returns (seconds until the old server exited, login times after the restart in
+    seconds from the SIGTERM, clients that did not come back).
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        server = start_server(args, directory, drain_timeout)
+        sessions = []
+        try:
+            await wait_until_up(args.port)
+            setup = ChatSession('127.0.0.1', args.port)
+            await setup.connect()
+            for n in range(args.clients):
+                await setup.newuser(f"user{n:05d}", 'pass')
+            await setup.close()
+            back = []
+            everybody = asyncio.Event()
+
+            def count_login(message):
+                if message.kind == 'status' and message.text == "Reconnected.":
+                    back.append(time.perf_counter())
+                    if len(back) == args.clients:
+                        everybody.set()
+            for n in range(args.clients):
+                session = await connect('127.0.0.1', args.port, f"user{n:05d}", 'pass')
+                session.add_handler(count_login)
+                sessions.append(session)
+
+            start = time.perf_counter()
+            server.send_signal(signal.SIGTERM)
+            while server.poll() is None:
+                await asyncio.sleep(0.01)
+            exited = time.perf_counter() - start
+            server = start_server(args, directory, drain_timeout)
+            try:
+                await asyncio.wait_for(everybody.wait(), args.reconnect_spread + drain_timeout + 30)
+            except asyncio.TimeoutError:
+                pass
+            return exited, [moment - start for moment in back], args.clients - len(back)
+        finally:
+            for session in sessions:
+                await session.close()
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconnect storm after a restart, with and without the drain.")
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--reconnect-spread', type=float, default=5.0,
+                        help="seconds the drain spreads the reconnects over")
+    parser.add_argument('--drain-timeout', type=float, default=10.0)
+    parser.add_argument('--mode', choices=('event', 'threaded'), default='event')
+    parser.add_argument('--port', type=int, default=19975)
+    args = parser.parse_args()
+
+    print(f"{args.clients} clients, {args.mode} mode")
+    print(f"{'shutdown':<10} {'exit s':>7} {'first s':>8} {'median s':>9} {'last s':>7} "
+          f"{'peak/100ms':>11} {'missing':>8}")
+    for name, drain_timeout in (('immediate', 0), ('drain', args.drain_timeout)):
+        exited, back, missing = asyncio.run(restart(args, drain_timeout))
+        back.sort()
+        if not back:
+            print(f"{name:<10} {exited:>7.2f}  nobody came back")
+            continue
+        print(f"{name:<10} {exited:>7.2f} {back[0]:>8.2f} {back[len(back) // 2]:>9.2f} {back[-1]:>7.2f} "
+              f"{peak_rate(back):>11} {missing:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Runs a federation of chat_serverV2.py processes on separate
+localhost ports and checks what happens when one of them fails. Every server gets
+its own directory and accounts, links with all the others and serves a number of
+logged in users (asyncio client library). The test checks and times:
+  - link up: every server lists every user of the federation in "who";
+  - a direct message, a "send all" and a room message across servers; the metrics
+    endpoint shows the broadcast went once to every peer, not once per remote user;
+  - a killed peer (SIGKILL): the others drop its users and a message to one of them
+    is refused, while the remaining servers still reach each other; after a restart
+    its users log in again (the clients reconnect by themselves) and are listed again;
+  - a hung peer (SIGSTOP): its users are dropped after --peer-timeout, and the link
+    comes back after SIGCONT.
+Exits with status 1 at the first check that fails.
+
+Usage: python -m benchmarks.bench_federation [--servers 3] [--users 20] [--peer-timeout 2]
+'''
+
+# Using Python version 3.12.0
+
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from chat_aioclient import ChatSession, connect
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'chat_serverV2.py')
+
+
+class Server:
+    """
+    One chat server process of the federation and the ports it uses.
+    """
+    def __init__(self, index, args, directory):
+        self.index = index
+        self.name = f"s{index}"
+        self.port = args.port + index
+        self.federation_port = args.port + 100 + index
+        self.metrics_port = args.port + 200 + index
+        self.directory = os.path.join(directory, self.name)
+        os.makedirs(self.directory)
+        self.peers = ",".join(f"127.0.0.1:{args.port + 100 + other}" for other in range(args.servers)
+                              if other != index)
+        self.timeout = args.peer_timeout
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, SERVER, '--mode', 'event', '--port', str(self.port), '--federation-port',
+             str(self.federation_port), '--peers', self.peers, '--federation-name', self.name,
+             '--peer-timeout', str(self.timeout), '--metrics-port', str(self.metrics_port),
+             '--hash-iterations', '1000', '--user-commands', '0', '--user-bytes', '0', '--log-level', 'warning'],
+            cwd=self.directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGCONT)
+            self.process.terminate()
+            self.process.wait()
+
+    def metric(self, sample):
+        """
+        Returns the value of one sample line of the metrics endpoint, 0 if it is missing.
+        """
+        with urllib.request.urlopen(f"http://127.0.0.1:{self.metrics_port}/metrics", timeout=2) as reply:
+            for line in reply.read().decode().splitlines():
+                if line.startswith(sample + " "):
+                    return float(line.split()[-1])
+        return 0.0
+
+
+class Failed(Exception):
+    pass
+
+
+async def wait_for(check, what, timeout=15.0):
+    """
+    Waits until check() returns True; check may be a coroutine function. Returns the
+    seconds it took.
+    """
+    start = time.perf_counter()
+    while True:
+        done = check()
+        if asyncio.iscoroutine(done):
+            done = await done
+        if done:
+            break
+        if time.perf_counter() - start > timeout:
+            raise Failed(f"timed out waiting for {what}")
+        await asyncio.sleep(0.02)
+    return time.perf_counter() - start
+
+
+async def wait_until_up(port, timeout=10.0):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise Failed(f"server on port {port} did not start")
+            await asyncio.sleep(0.05)
+            continue
+        writer.close()
+        return
+
+
+def report(check, seconds=None, note=""):
+    timing = f"{seconds * 1000:8.0f} ms" if seconds is not None else " " * 11
+    print(f"ok  {check:<52} {timing}  {note}")
+
+
+async def run(args, servers):
+    users = {server.index: [f"{server.name}user{n:03d}" for n in range(args.users)] for server in servers}
+    everybody = {user for names in users.values() for user in names}
+    received = []  # (receiving user, Message)
+
+    def recorder(user):
+        return lambda message: received.append((user, message))
+
+    for server in servers:
+        server.start()
+    for server in servers:
+        await wait_until_up(server.port)
+    sessions = {}
+    start = time.perf_counter()
+    for server in servers:
+        setup = ChatSession('127.0.0.1', server.port)
+        await setup.connect()
+        for user in users[server.index]:
+            await setup.newuser(user, 'pass')
+        await setup.close()
+        for user in users[server.index]:
+            session = await connect('127.0.0.1', server.port, user, 'pass')
+            session.add_handler(recorder(user))
+            sessions[user] = session
+
+    async def listed_everywhere(expected, skip=None):
+        # Servers that are down or hung would not answer
+        for server in servers:
+            if server is skip or server.process.poll() is not None:
+                continue
+            first = users[server.index][0]
+            if set(await sessions[first].who()) != expected:
+                return False
+        return True
+    await wait_for(lambda: listed_everywhere(everybody), "the federation to link up")
+    report(f"{len(servers)} servers list all {len(everybody)} users", time.perf_counter() - start,
+           "start, accounts and logins included")
+
+    # The first user of each server takes part in the checks
+    members = [users[server.index][0] for server in servers]
+    first, second = members[:2]
+    # Direct message across servers
+    response = await sessions[first].send(second, "hello from far away")
+    if response:
+        raise Failed(f"direct message refused: {response}")
+    seconds = await wait_for(lambda: any(user == second and message.text == "hello from far away"
+                                         for user, message in received), "the direct message")
+    report("direct message reaches a user on a peer", seconds)
+
+    # One "send all" reaches everybody, with one copy per peer
+    before = servers[0].metric('chat_federation_messages_sent_total{kind="broadcast"}')
+    await sessions[first].send('all', "broadcast across servers")
+    seconds = await wait_for(lambda: {user for user, message in received
+                                      if message.text == "broadcast across servers"} == everybody - {first},
+                             "the broadcast")
+    copies = servers[0].metric('chat_federation_messages_sent_total{kind="broadcast"}') - before
+    if copies != len(servers) - 1:
+        raise Failed(f"broadcast sent {copies:.0f} times to {len(servers) - 1} peers")
+    remote = len(everybody) - args.users
+    report("send all reaches every user", seconds, f"{copies:.0f} peer messages for {remote} remote users")
+
+    # Room message to members on every server
+    for user in members:
+        await sessions[user].join('#federated')
+    await sessions[second].send('#federated', "room message")
+    seconds = await wait_for(lambda: {user for user, message in received if message.text == "room message"} ==
+                             set(members) - {second}, "the room message")
+    report("room message reaches members on other servers", seconds)
+
+    # A peer is killed
+    victim = servers[-1]
+    survivors = everybody - set(users[victim.index])
+    victim.process.send_signal(signal.SIGKILL)
+    victim.process.wait()
+    seconds = await wait_for(lambda: listed_everywhere(survivors), "the killed server's users to be dropped")
+    report(f"killed {victim.name}: its users are dropped", seconds)
+    victim_user = users[victim.index][0]
+    response = await sessions[first].send(victim_user, "anybody there?")
+    if not response.startswith("Error"):
+        raise Failed(f"message to a user of the killed server: {response!r}")
+    report("message to one of its users is refused", None, repr(response))
+    if len(servers) > 2:
+        received.clear()
+        await sessions[first].send(second, "still here")
+        await wait_for(lambda: any(m.text == "still here" for _, m in received), "survivors to talk")
+        report("the remaining servers still reach each other")
+
+    # It comes back; its clients reconnect and log in again by themselves
+    victim.start()
+    seconds = await wait_for(lambda: listed_everywhere(everybody), "the restarted server's users", timeout=30)
+    report(f"restarted {victim.name}: its users are listed again", seconds)
+    received.clear()
+    await sessions[first].send(victim_user, "welcome back")
+    await wait_for(lambda: any(m.text == "welcome back" for _, m in received), "the direct message")
+    report("direct messages reach it again")
+
+    # A peer hangs: only the peer timeout notices
+    hung = servers[1]
+    survivors = everybody - set(users[hung.index])
+    hung.process.send_signal(signal.SIGSTOP)
+    seconds = await wait_for(lambda: listed_everywhere(survivors, skip=hung), "the hung server's users to be dropped",
+                             timeout=args.peer_timeout * 3 + 10)
+    report(f"hung {hung.name}: its users are dropped", seconds, f"peer timeout {args.peer_timeout:g} s")
+    hung.process.send_signal(signal.SIGCONT)
+    seconds = await wait_for(lambda: listed_everywhere(everybody), "the resumed server's users", timeout=30)
+    report(f"resumed {hung.name}: its users are listed again", seconds)
+    for session in sessions.values():
+        await session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Federation failover test.")
+    parser.add_argument('--servers', type=int, default=3)
+    parser.add_argument('--users', type=int, default=20, help="logged in users per server")
+    parser.add_argument('--peer-timeout', type=float, default=2.0, help="seconds before a silent peer is dropped")
+    parser.add_argument('--port', type=int, default=19960, help="client port of the first server; "
+                        "federation ports start 100 higher and metrics ports 200 higher")
+    args = parser.parse_args()
+    if args.servers < 2:
+        parser.error("a federation needs at least 2 servers")
+
+    with tempfile.TemporaryDirectory() as directory:
+        servers = [Server(index, args, directory) for index in range(args.servers)]
+        try:
+            asyncio.run(run(args, servers))
+        except Failed as e:
+            print(f"FAILED: {e}")
+            sys.exit(1)
+        finally:
+            for server in servers:
+                server.stop()
+    print("All checks passed.")
+
+
+if __name__ == "__main__":
+    main()
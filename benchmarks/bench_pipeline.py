@@ -0,0 +1,148 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Measures what pipelining gains for bulk "send" workloads.
+It starts chat_serverV2.py with rate limits off, logs in a sender and a receiver
+with the asyncio client library and sends the same number of messages with
+different windows: window 1 is the lock-step behavior (wait for every response
+before the next command), larger windows keep that many commands in flight and
+match the responses by request id. With --rtt-ms the connections go through a
+local proxy that delays every chunk, to show the effect of a real network's
+round trip time. Reports messages/sec until every message was answered and
+delivered.
+
+Usage: python -m benchmarks.bench_pipeline [--messages 5000] [--windows 1,8,64,512] [--rtt-ms 0,1]
+'''
+
+# Using Python version 3.12.0
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from chat_aioclient import ChatSession, connect
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'chat_serverV2.py')
+
+
+async def forward(reader, writer, delay):
+    """
+    Copies one direction of a proxied connection, every chunk 'delay' seconds late.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while data := await reader.read(65536):
+            # Same delay for every chunk, so the order is kept
+            loop.call_later(delay, writer.write, data)
+    finally:
+        loop.call_later(delay, writer.close)
+
+
+async def start_proxy(port, rtt):
+    """
+    Starts a local TCP proxy to the server that adds 'rtt' seconds of round trip time.
+    Returns the asyncio server; its port is in sockets[0].
+    """
+    async def relay(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            await asyncio.gather(forward(client_reader, server_writer, rtt / 2),
+                                 forward(server_reader, client_writer, rtt / 2))
+        except (ConnectionError, asyncio.CancelledError):
+            pass  # The benchmark is over
+    return await asyncio.start_server(relay, '127.0.0.1', 0)
+
+
+async def send_bulk(session, target, count, window):
+    """
+    Sends 'count' messages with at most 'window' commands waiting for their response.
+    """
+    slots = asyncio.Semaphore(window)
+
+    async def send_one(index):
+        async with slots:
+            response = await session.send(target, f"message {index:06d}")
+            if response:
+                raise RuntimeError(response)
+    await asyncio.gather(*(send_one(index) for index in range(count)))
+
+
+async def measure(port, count, windows, rtt):
+    """
+    Returns {window: messages per second} for one round trip time.
+    """
+    proxy = None
+    if rtt:
+        proxy = await start_proxy(port, rtt)
+        port = proxy.sockets[0].getsockname()[1]
+    setup = ChatSession('127.0.0.1', port)
+    await setup.connect()
+    for user in ('sender', 'receiver'):
+        await setup.newuser(user, 'pass')
+    await setup.close()
+    sender = await connect('127.0.0.1', port, 'sender', 'pass')
+    receiver = await connect('127.0.0.1', port, 'receiver', 'pass')
+    results = {}
+    try:
+        for window in windows:
+            delivered = 0
+            done = asyncio.Event()
+
+            def count_message(message):
+                nonlocal delivered
+                if message.kind == 'msg':
+                    delivered += 1
+                    if delivered == count:
+                        done.set()
+            receiver.add_handler(count_message)
+            start = time.perf_counter()
+            await send_bulk(sender, 'receiver', count, window)
+            await done.wait()
+            results[window] = count / (time.perf_counter() - start)
+            receiver.remove_handler(count_message)
+    finally:
+        await sender.close()
+        await receiver.close()
+        if proxy is not None:
+            proxy.close()
+    return results
+
+
+def run(count, windows, rtt, port):
+    with tempfile.TemporaryDirectory() as tmp:
+        server = subprocess.Popen(
+            [sys.executable, SERVER, '--port', str(port), '--hash-iterations', '1000',
+             '--user-commands', '0', '--user-bytes', '0'],
+            cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            time.sleep(1.0)
+            return asyncio.run(measure(port, count, windows, rtt))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pipelining benchmark.")
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--windows', default='1,8,64,512', help="commands in flight; 1 is lock-step")
+    parser.add_argument('--rtt-ms', default='0,1', help="added round trip times in milliseconds")
+    parser.add_argument('--port', type=int, default=19991)
+    args = parser.parse_args()
+    windows = [int(w) for w in args.windows.split(',')]
+
+    print(f"{args.messages} messages per run")
+    print(f"{'rtt ms':>7} {'window':>7} {'msg/s':>10} {'speedup':>8}")
+    for rtt in (float(r) for r in args.rtt_ms.split(',')):
+        results = run(args.messages, windows, rtt / 1000, args.port)
+        base = results[windows[0]]
+        for window in windows:
+            print(f"{rtt:>7g} {window:>7} {results[window]:>10.0f} {results[window] / base:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Measures what TLS costs the chat server. It generates a
+throwaway certificate with the openssl command, then starts chat_serverV2.py with
+TLS off and with TLS on (for every --tls-workers value) and measures:
+  - connections/sec: load processes open connections as fast as they can, each
+    one doing the TCP connect, the TLS handshake (full, or resumed with a session
+    ticket) and the protocol hello, then closing it. TLS 1.3 resumption skips the
+    certificate and its signature but still does a key exchange; a TLS 1.2
+    resumption (--max-version 1.2) skips both;
+  - messages/sec: one client sends pipelined messages to another, like
+    bench_pipeline.py, over one long-lived connection each.
+
+Usage: python -m benchmarks.bench_tls [--duration 3] [--procs 2] [--messages 20000] [--tls-workers 2,0]
+                                      [--max-version 1.3]
+'''
+
+# Using Python version 3.12.0
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_pipeline import send_bulk
+from chat_aioclient import ChatSession, connect
+from chat_binary import HELLO_BINARY
+from chat_tls import client_context
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'chat_serverV2.py')
+
+
+def make_certificate(directory):
+    """
+    Generates a self-signed ECDSA certificate for localhost. Returns (cert, key) paths.
+    """
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    try:
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                        '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                        '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1', '-keyout', key, '-out', cert],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError) as e:
+        sys.exit(f"Could not generate a test certificate with openssl: {e}")
+    return cert, key
+
+
+def connect_loop(port, kind, cafile, max_version, duration, start_at, results):
+    """
+    Opens and closes connections until the time is up. 'kind' is 'tcp' (no TLS),
+    'full' (a new TLS session every time) or 'resumed' (the last session is offered).
+    """
+    if kind == 'full':
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.load_verify_locations(cafile)
+    elif kind == 'resumed':
+        context = client_context(cafile)
+    else:
+        context = None
+    if context is not None:
+        context.maximum_version = max_version
+    count = reused = 0
+    while time.time() < start_at:
+        time.sleep(0.001)
+    deadline = start_at + duration
+    while time.time() < deadline:
+        sock = socket.create_connection(('127.0.0.1', port))
+        # Like asyncio clients; otherwise Nagle holds the hello back behind an unacknowledged Finished
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if context is not None:
+            sock = context.wrap_socket(sock, server_hostname='localhost')
+        sock.sendall(HELLO_BINARY)
+        reply = b""
+        while len(reply) < len(HELLO_BINARY):
+            chunk = sock.recv(64)
+            if not chunk:
+                raise RuntimeError("server closed the connection")
+            reply += chunk
+        if context is not None:
+            reused += sock.session_reused
+        sock.close()
+        count += 1
+    results.put((count, reused))
+
+
+def connection_rate(port, kind, cafile, max_version, duration, procs):
+    """
+    Returns (connections per second, share of them that resumed a session).
+    """
+    results = multiprocessing.Queue()
+    start_at = time.time() + 1.0
+    loaders = [multiprocessing.Process(target=connect_loop,
+                                       args=(port, kind, cafile, max_version, duration, start_at, results))
+               for _ in range(procs)]
+    for loader in loaders:
+        loader.start()
+    totals = [results.get() for _ in loaders]
+    for loader in loaders:
+        loader.join()
+    count = sum(t[0] for t in totals)
+    return count / duration, sum(t[1] for t in totals) / max(count, 1)
+
+
+async def message_rate(port, count, window, tls):
+    """
+    Returns the messages per second of one sender with 'window' messages in flight.
+    """
+    setup = ChatSession('127.0.0.1', port, tls=tls)
+    await setup.connect()
+    for user in ('sender', 'receiver'):
+        await setup.newuser(user, 'pass')
+    await setup.close()
+    sender = await connect('127.0.0.1', port, 'sender', 'pass', tls=tls)
+    receiver = await connect('127.0.0.1', port, 'receiver', 'pass', tls=tls)
+    delivered = 0
+    done = asyncio.Event()
+
+    def count_message(message):
+        nonlocal delivered
+        if message.kind == 'msg':
+            delivered += 1
+            if delivered == count:
+                done.set()
+    receiver.add_handler(count_message)
+    try:
+        start = time.perf_counter()
+        await send_bulk(sender, 'receiver', count, window)
+        await done.wait()
+        return count / (time.perf_counter() - start)
+    finally:
+        await sender.close()
+        await receiver.close()
+
+
+def server_cpu(pid):
+    """
+    Returns the CPU seconds a process has used so far, or None where /proc is missing.
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def run(args, cert, key, tls_workers):
+    """
+    Measures one server configuration; tls_workers None means TLS off.
+    Returns [(test, rate per second, server CPU milliseconds per operation or None, note)].
+    """
+    command = [sys.executable, SERVER, '--mode', 'event', '--port', str(args.port), '--hash-iterations', '1000',
+               '--user-commands', '0', '--user-bytes', '0', '--login-timeout', '0']
+    if tls_workers is not None:
+        command += ['--tls-cert', cert, '--tls-key', key, '--tls-workers', str(tls_workers)]
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        server = subprocess.Popen(command, cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        def measure(test, func):
+            # func() returns (rate, operations, note)
+            before = server_cpu(server.pid)
+            rate, count, note = func()
+            after = server_cpu(server.pid)
+            cpu = (after - before) * 1000 / count if before is not None and count else None
+            results.append((test, rate, cpu, note))
+
+        def connections(kind):
+            rate, reused = connection_rate(args.port, kind, cert, args.max_version, args.duration, args.procs)
+            return rate, rate * args.duration, f"{reused:.0%} resumed" if kind != 'tcp' else ""
+
+        def messages():
+            tls = client_context(cert) if tls_workers is not None else None
+            return asyncio.run(message_rate(args.port, args.messages, args.window, tls)), args.messages, ""
+        try:
+            time.sleep(1.0)
+            for kind in ('tcp',) if tls_workers is None else ('full', 'resumed'):
+                measure(f"{kind} connect", lambda: connections(kind))
+            measure("messages", messages)
+        finally:
+            server.terminate()
+            server.wait()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TLS benchmark.")
+    parser.add_argument('--duration', type=float, default=3.0, help="seconds per connection rate measurement")
+    parser.add_argument('--procs', type=int, default=2, help="connecting load processes")
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--window', type=int, default=256, help="messages in flight")
+    parser.add_argument('--tls-workers', default='2,0', help="handshake thread counts to compare")
+    parser.add_argument('--max-version', choices=('1.2', '1.3'), default='1.3', help="newest TLS version clients offer")
+    parser.add_argument('--port', type=int, default=19992)
+    args = parser.parse_args()
+    args.max_version = ssl.TLSVersion.TLSv1_2 if args.max_version == '1.2' else ssl.TLSVersion.TLSv1_3
+
+    with tempfile.TemporaryDirectory() as certs:
+        cert, key = make_certificate(certs)
+        print(f"{os.cpu_count()} CPUs, {args.procs} connecting processes, {args.messages} messages, "
+              f"clients up to {args.max_version.name}")
+        print(f"{'server':<22} {'test':<16} {'per sec':>8} {'server CPU ms each':>19}")
+        configs = [('TLS off', None)] + [(f"TLS on, {w} hs threads", int(w)) for w in args.tls_workers.split(',')]
+        for name, workers in configs:
+            for test, rate, cpu, note in run(args, cert, key, workers):
+                cpu = f"{cpu:.3f}" if cpu is not None else "-"
+                print(f"{name:<22} {test:<16} {rate:>8.0f} {cpu:>19}  {note}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Compares the framed text protocol with the binary protocol
+(with and without zlib batches): the cost of parsing commands on the server, the
+cost of encoding a message for many recipients, and the bytes sent on the wire for
+chat messages, a long "who" listing and an offline message backlog.
+
+Usage: python -m benchmarks.bench_wire [--commands N] [--recipients N] [--backlog N]
+'''
+
+# Using Python version 3.12.0
+
+import argparse
+import time
+
+from chat_binary import (BinarySession, FrameDecoder, compress_frames, decode_command, encode_command,
+                         frame_strings, OP_NOTICE)
+from chat_protocol import HEADER, FrameDecoder as TextFrameDecoder, SharedMessage, encode_frame
+from chat_serverV2 import commands as command_table
+
+
+class Recipient:
+    """
+    Just the attributes SharedMessage.encode_for() looks at.
+    """
+    def __init__(self, framed, binary):
+        self.framed = framed
+        self.binary = binary
+
+
+def sample_commands(count):
+    """
+    A mix of the commands a busy server sees, as (command, arguments) pairs.
+    """
+    commands = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            commands.append(('send', ['all', f"hello everyone, this is message number {i}"]))
+        elif kind == 1:
+            commands.append(('send', [f"user{i % 100:03d}", f"direct message {i} with a little text"]))
+        elif kind == 2:
+            commands.append(('send', ['#lobby', f"room message {i}"]))
+        else:
+            commands.append(('who', []))
+    return commands
+
+
+def timed(function, repeat):
+    """
+    Returns the best of 'repeat' runs in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_parse(commands, repeat):
+    """
+    Server-side cost of turning received bytes into (command, arguments).
+    """
+    text = b"".join(encode_frame(" ".join([cmd] + args).encode('utf-8')) for cmd, args in commands)
+    binary = b"".join(encode_command(cmd, *args) for cmd, args in commands)
+
+    def parse_text():
+        for payload in TextFrameDecoder(max_frame=len(text)).feed(text):
+            command_table.parse(payload.decode('utf-8', errors='ignore').strip())
+
+    def parse_binary():
+        for op, body in FrameDecoder().feed(binary):
+            decode_command(op, body)
+
+    n = len(commands)
+    print(f"{'parse':<10} {'ns/command':>12} {'bytes/command':>15}")
+    print(f"{'text':<10} {timed(parse_text, repeat) / n * 1e9:>12.0f} {len(text) / n:>15.1f}")
+    print(f"{'binary':<10} {timed(parse_binary, repeat) / n * 1e9:>12.0f} {len(binary) / n:>15.1f}")
+
+
+def bench_fan_out(recipients, repeat):
+    """
+    Cost of encoding one "send all" message for every recipient, including the
+    first-time DEFINE of the sender on binary connections.
+    """
+    print(f"\n{'fan-out':<10} {'ns/recipient':>12} {'bytes/recipient':>15}")
+    for name, framed, compress in (('text', True, None), ('binary', True, False)):
+        def run():
+            clients = [Recipient(framed, None if compress is None else BinarySession(compress))
+                       for _ in range(recipients)]
+            sizes = 0
+            for _ in range(10):
+                shared = SharedMessage("alice: hello everyone", 'all', 'alice', "hello everyone")
+                for client in clients:
+                    sizes += len(shared.encode_for(client))
+            return sizes
+        size = run() / (recipients * 10)
+        elapsed = timed(run, repeat)
+        print(f"{name:<10} {elapsed / (recipients * 10) * 1e9:>12.0f} {size:>15.1f}")
+
+
+def wire_bytes(label, texts):
+    """
+    Bytes needed to send the same notices with each protocol, as one write.
+    """
+    text = sum(HEADER.size + len(line.encode('utf-8')) for line in texts)
+    frames = b"".join(frame_strings(OP_NOTICE, line) for line in texts)
+    zipped = compress_frames(frames, BinarySession(compress=True))
+    print(f"{label:<22} {text:>10} {len(frames):>10} {len(zipped):>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Text vs binary wire format benchmark.")
+    parser.add_argument('--commands', type=int, default=100000)
+    parser.add_argument('--recipients', type=int, default=10000)
+    parser.add_argument('--backlog', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    bench_parse(sample_commands(args.commands), args.repeat)
+    bench_fan_out(args.recipients, args.repeat)
+
+    print(f"\n{'bytes on the wire':<22} {'text':>10} {'binary':>10} {'binary+zlib':>12}")
+    wire_bytes("who (1000 users)", [", ".join(f"user{i:05d}" for i in range(1000))])
+    wire_bytes(f"backlog ({args.backlog} msgs)",
+               [f"bob: offline message {i} about the weekly meeting" for i in range(args.backlog)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Measures how message throughput scales with the number of
+server worker processes. For every worker count it starts chat_serverV2.py with
+--workers N on a scratch sqlite user store, logs in a set of framed clients spread
+over several load processes, lets every client send unicast messages to random users
+(most of them on other workers) for a fixed time and reports delivered messages/sec.
+
+Usage: python -m benchmarks.bench_workers [--workers 1,2,4] [--clients 64] [--duration 5]
+'''
+
+# Using Python version 3.12.0
+
+import argparse
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from chat_protocol import FrameDecoder, encode_frame, negotiate_client
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'chat_serverV2.py')
+
+
+def connect(port, user, password, create):
+    """
+    Opens a framed connection and logs in, creating the account first if asked to.
+    """
+    sock = socket.create_connection(('127.0.0.1', port))
+    framed, leftover = negotiate_client(sock)
+    assert framed, "server did not accept the framed protocol"
+    decoder = FrameDecoder()
+    decoder.feed(leftover)
+    if create:
+        sock.sendall(encode_frame(f"newuser {user} {password}".encode()))
+        wait_for(sock, decoder, b"New user account created.")
+    sock.sendall(encode_frame(f"login {user} {password}".encode()))
+    wait_for(sock, decoder, b"login confirmed")
+    return sock, decoder
+
+
+def wait_for(sock, decoder, expected):
+    while True:
+        for frame in decoder.feed(sock.recv(65536)):
+            if frame == expected:
+                return
+            if frame.startswith(b"Denied") or frame.startswith(b"Error"):
+                raise RuntimeError(frame.decode())
+
+
+def load_process(port, users, all_users, duration, start_at, results):
+    """
+    Logs in 'users', then sends unicast messages to random users as fast as the
+    connections accept them and counts delivered messages. Other frames (responses,
+    errors such as a rate limit) are not deliveries; throttled commands are counted
+    on their own.
+    """
+    rng = random.Random(hash(users[0]))
+    conns = [connect(port, user, 'pass', False) for user in users]
+    selector = selectors.DefaultSelector()
+    for index, (sock, decoder) in enumerate(conns):
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, index)
+    payload = b"x" * 64
+    delivered = b": " + payload
+    received = 0
+    throttled = 0
+    sent = 0
+    while time.time() < start_at:
+        time.sleep(0.001)
+    deadline = start_at + duration
+    counting = True
+    while time.time() < deadline + 1.0:
+        if counting and time.time() >= deadline:
+            counting = False
+            for index, (sock, _) in enumerate(conns):
+                selector.modify(sock, selectors.EVENT_READ, index)
+        for key, mask in selector.select(0.1):
+            sock = key.fileobj
+            if mask & selectors.EVENT_READ:
+                try:
+                    data = sock.recv(262144)
+                except BlockingIOError:
+                    data = None
+                if data:
+                    for frame in conns[key.data][1].feed(data):
+                        if frame.endswith(delivered):
+                            received += 1
+                        elif frame.startswith(b"Error: Rate limit"):
+                            throttled += 1
+            if counting and mask & selectors.EVENT_WRITE:
+                target = rng.choice(all_users)
+                try:
+                    sock.send(encode_frame(b"send " + target.encode() + b" " + payload))
+                    sent += 1
+                except BlockingIOError:
+                    pass
+    results.put((sent, received, throttled))
+
+
+def run(workers, clients, procs, duration, port):
+    """
+    Runs one measurement against a server with the given number of workers.
+    Returns (messages sent per second, messages delivered per second, commands
+    throttled). The server runs without per-user limits, so the throughput of the
+    workers is measured rather than the rate limiter.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        server = subprocess.Popen(
+            [sys.executable, SERVER, '--workers', str(workers), '--port', str(port),
+             '--user-store', f"sqlite:{os.path.join(tmp, 'users.db')}", '--hash-iterations', '1000',
+             '--user-commands', '0', '--user-bytes', '0'],
+            cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            time.sleep(1.0)
+            users = [f"bench{i:04d}" for i in range(clients)]
+            for user in users:
+                sock, _ = connect(port, user, 'pass', True)
+                sock.close()
+            results = multiprocessing.Queue()
+            start_at = time.time() + 2.0
+            groups = [users[i::procs] for i in range(procs)]
+            loaders = [multiprocessing.Process(target=load_process,
+                                               args=(port, group, users, duration, start_at, results))
+                       for group in groups]
+            for loader in loaders:
+                loader.start()
+            totals = [results.get() for _ in loaders]
+            for loader in loaders:
+                loader.join()
+        finally:
+            server.terminate()
+            server.wait()
+    sent = sum(t[0] for t in totals)
+    received = sum(t[1] for t in totals)
+    throttled = sum(t[2] for t in totals)
+    return sent / duration, received / duration, throttled
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker scaling benchmark.")
+    parser.add_argument('--workers', default='1,2,4')
+    parser.add_argument('--clients', type=int, default=64)
+    parser.add_argument('--procs', type=int, default=4, help="load generator processes")
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--port', type=int, default=19990)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs, {args.clients} clients, {args.duration}s per run")
+    print(f"{'workers':>8} {'sent msg/s':>12} {'delivered msg/s':>16} {'throttled':>10}")
+    for workers in (int(w) for w in args.workers.split(',')):
+        sent, delivered, throttled = run(workers, args.clients, args.procs, args.duration, args.port)
+        print(f"{workers:>8} {sent:>12.0f} {delivered:>16.0f} {throttled:>10}")
+
+
+if __name__ == "__main__":
+    main()
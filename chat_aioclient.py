@@ -0,0 +1,522 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: asyncio client library for the chat room server, for bots,
+integrations and the command line client.
+A ChatSession is one connection. Its commands are coroutines that return the
+server's response to that very command; every command carries a request id that
+the server puts on its response, so any number of commands can be in flight at
+once (e.g. with asyncio.gather) without waiting for each other. Incoming
+messages and notices go to handlers and to async iterators. A dropped connection
+is opened again, and the session logs back in and rejoins its rooms; a server that
+shuts down says how long to wait first, so its clients do not all come back at
+once. Reconnect delays are randomized for the same reason. Sessions share
+nothing, so one process can hold as many as it likes.
+Against a server that only speaks the legacy protocol, commands return None and
+every line the server sends arrives as a notice.
+With 'tls', an SSL context from chat_tls.client_context(), the connection is
+encrypted, and a reconnect resumes the previous TLS session.
+
+Usage:
+    async with await connect('127.0.0.1', 19953, 'Tom', 'Tom11') as session:
+        await session.send('David', 'hello')
+        async for message in session.messages():
+            print(message)
+'''
+
+# Using Python version 3.12.0
+
+import asyncio
+import itertools
+import random
+
+from chat_binary import HELLO_BINARY, HELLO_BINARY_ZLIB, PONG_FRAME, ClientDecoder, encode_command
+from chat_protocol import FRAMED_RECV_SIZE, LEGACY_RECV_SIZE
+from chat_rooms import parse_room
+
+# Default server address and port
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 19953
+
+# Seconds the server has to answer the protocol hello
+HELLO_TIMEOUT = 2.0
+# Seconds before the first reconnect attempt; the delay doubles up to the maximum
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 10.0
+# Share of each reconnect delay that is random, so clients that lost their server
+# together do not retry in step
+RECONNECT_JITTER = 0.5
+# Messages an async iterator holds before the oldest ones are dropped
+QUEUE_SIZE = 10000
+
+
+class ChatError(Exception):
+    """
+    Base class of the errors raised by a ChatSession.
+    """
+
+
+class ConnectionLost(ChatError):
+    """
+    Raised for commands whose connection went away before the response arrived,
+    and for commands issued while the session is not connected.
+    """
+
+
+class LoginError(ChatError):
+    """
+    Raised when the server refuses a login.
+    """
+
+
+class RateLimited(ChatError):
+    """
+    Raised when the server refused a command because of a rate limit; the command
+    may be sent again after 'retry_after' seconds.
+    """
+    def __init__(self, scope, retry_after):
+        super().__init__(f"rate limit exceeded ({scope}), retry after {retry_after:g} s")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class Message:
+    """
+    Something the server sent that is not a command response. 'kind' is 'msg'
+    (a direct message), 'all', 'room', 'notice' (e.g. "X joins.") or 'status', which
+    the session itself reports when the connection is lost or restored.
+    Notices and status messages only have 'text'.
+    """
+    __slots__ = ('kind', 'text', 'sender', 'room')
+
+    def __init__(self, kind, text, sender=None, room=None):
+        self.kind = kind
+        self.text = text
+        self.sender = sender
+        self.room = room
+
+    def __str__(self):
+        # The way the text protocol shows it
+        if self.kind == 'room':
+            return f"{self.room} {self.sender}: {self.text}"
+        if self.sender is not None:
+            return f"{self.sender}: {self.text}"
+        return self.text
+
+    def __repr__(self):
+        return f"Message({self.kind!r}, {self.text!r}, sender={self.sender!r}, room={self.room!r})"
+
+
+def split_command(command_line):
+    """
+    Splits a text command line into the command name and its arguments the way the
+    server's command table does (CommandTable.parse); the message of "send" keeps
+    its spacing.
+    """
+    head = command_line.split(None, 1)
+    if not head:
+        return "", []
+    cmd = head[0].lower()
+    if len(head) == 1:
+        return cmd, []
+    if cmd == "send":
+        return cmd, head[1].split(' ', 1)
+    return cmd, head[1].split()
+
+
+class ChatSession:
+    """
+    One connection to the chat server. All methods must be called from the event loop
+    the session was connected on. With 'reconnect', a lost connection is opened again
+    until close() is called; commands issued in between raise ConnectionLost.
+    """
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, reconnect=True, compress=True, tls=None):
+        self.host = host
+        self.port = port
+        self.reconnect = reconnect
+        self.compress = compress
+        self.tls = tls
+        self.binary = False  # False once connected to a server without the binary protocol
+        self.reader = None
+        self.writer = None
+        self.decoder = None
+        # Commands waiting for their response by request id:
+        # (future, replayed lines or None)
+        self.pending = {}
+        self.request_ids = itertools.count(1)
+        self.handlers = []
+        self.queues = []
+        # What is restored after a reconnect
+        self.user = None
+        self.password = None
+        self.rooms = set()
+        self.closed = False
+        self.task = None
+        # Seconds the server asked to wait before reconnecting, when it said goodbye
+        self.reconnect_after = None
+
+    async def __aenter__(self):
+        if self.task is None:
+            await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    async def connect(self):
+        """
+        Opens the connection and starts reading from it. Raises OSError if the server
+        cannot be reached.
+        """
+        leftover = await self.open()
+        self.task = asyncio.get_running_loop().create_task(self.run(leftover))
+        return self
+
+    async def open(self):
+        """
+        Connects and negotiates the protocol. Returns any bytes received after the hello.
+        """
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.tls)
+        hello = HELLO_BINARY_ZLIB if self.compress else HELLO_BINARY
+        writer.write(hello)
+        data = b""
+        try:
+            while len(data) < len(hello) and hello.startswith(data):
+                chunk = await asyncio.wait_for(reader.read(LEGACY_RECV_SIZE), HELLO_TIMEOUT)
+                if not chunk:
+                    writer.close()
+                    raise ConnectionResetError("server closed the connection")
+                data += chunk
+        except asyncio.TimeoutError:
+            pass
+        # A legacy server answers the hello with an error message, which is discarded
+        self.binary = data.startswith(hello)
+        self.decoder = ClientDecoder()
+        self.reader, self.writer = reader, writer
+        return data[len(hello):] if self.binary else b""
+
+    async def run(self, data):
+        """
+        Reads from the server until the session is closed, reconnecting when allowed.
+        """
+        delay = RECONNECT_DELAY
+        reason = None  # Why the connection ended, unless the session was closed on purpose
+        try:
+            while True:
+                try:
+                    await self.read_loop(data)
+                    reason = None if self.closed else "Server closed the connection."
+                except (OSError, ValueError) as e:
+                    reason = f"Connection to server lost: {e}"
+                self.drop(reason or "Session closed.")
+                if self.closed or not self.reconnect:
+                    break
+                self.publish(Message('status', f"{reason} Reconnecting..."))
+                wait, self.reconnect_after = self.reconnect_after, None
+                # Try again until a connection works; close() cancels the wait
+                while True:
+                    if wait is None:
+                        wait = delay * (1 - RECONNECT_JITTER * random.random())
+                    await asyncio.sleep(wait)
+                    wait = None
+                    try:
+                        data = await self.open()
+                    except OSError:
+                        delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                        continue
+                    break
+                delay = RECONNECT_DELAY
+                asyncio.get_running_loop().create_task(self.restore())
+        finally:
+            if not self.closed and reason is not None:
+                self.publish(Message('status', reason))
+            self.closed = True
+            self.drop(reason or "Session closed.")
+            for queue in self.queues:
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(None)  # Ends the iterators
+
+    async def read_loop(self, data):
+        reader = self.reader
+        while True:
+            if data:
+                if self.binary:
+                    for event in self.decoder.feed(data):
+                        self.dispatch(event)
+                else:
+                    # Legacy protocol: every recv is one message
+                    self.publish(Message('notice', data.decode('utf-8', errors='ignore').strip()))
+            data = await reader.read(FRAMED_RECV_SIZE if self.binary else LEGACY_RECV_SIZE)
+            if not data:
+                return
+
+    def dispatch(self, event):
+        """
+        Hands one decoded server event to the command it answers or to the handlers.
+        """
+        kind = event[0]
+        if kind == 'ping':
+            self.writer.write(PONG_FRAME)
+        elif kind == 'resp' or kind == 'throttle':
+            entry = self.pending.pop(event[-1], None)
+            if entry is None:
+                return  # Answer to a command sent before a reconnect
+            future, replay = entry
+            if future.done():
+                return  # Cancelled by the caller
+            if kind == 'throttle':
+                future.set_exception(RateLimited(event[1], event[2] / 1000))
+            else:
+                future.set_result((event[1], replay))
+        elif kind == 'goodbye':
+            # The server closes the connection next; the wait already has its jitter
+            self.reconnect_after = event[2] / 1000
+            self.publish(Message('notice', event[1]))
+        elif kind == 'replay':
+            # Output of the command with that request id, e.g. history lines
+            entry = self.pending.get(event[2]) if len(event) == 3 else None
+            if entry is not None and entry[1] is not None:
+                entry[1].append(event[1])
+            else:
+                self.publish(Message('notice', event[1]))
+        elif kind == 'notice':
+            self.publish(Message('notice', event[1]))
+        elif kind == 'room':
+            self.publish(Message('room', event[3], sender=event[1], room=event[2]))
+        else:
+            self.publish(Message(kind, event[2], sender=event[1]))
+
+    def publish(self, message):
+        """
+        Passes a message to the handlers and the iterators. Handlers run soon after,
+        so a command that was answered before the message sees its response first.
+        """
+        loop = asyncio.get_running_loop()
+        for handler in self.handlers:
+            loop.call_soon(self.call_handler, handler, message)
+        for queue in self.queues:
+            if queue.full():
+                queue.get_nowait()  # A consumer that falls behind loses the oldest messages
+            queue.put_nowait(message)
+
+    def call_handler(self, handler, message):
+        result = handler(message)
+        if asyncio.iscoroutine(result):
+            asyncio.get_running_loop().create_task(result)
+
+    def drop(self, reason):
+        """
+        Forgets a connection that is gone; its unanswered commands fail.
+        """
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+        pending, self.pending = self.pending, {}
+        for future, _ in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionLost(reason))
+
+    async def restore(self):
+        """
+        Logs in again and rejoins the rooms after a reconnect.
+        """
+        try:
+            if self.password is not None:
+                await self.login(self.user, self.password)
+            for room in sorted(self.rooms):
+                await self.join(room)
+        except LoginError as e:
+            # E.g. the account was removed; later reconnects do not try again
+            self.user = self.password = None
+            self.rooms.clear()
+            self.publish(Message('status', f"Could not log in again: {e}"))
+            return
+        except ChatError as e:
+            self.publish(Message('status', f"Could not restore the session: {e}"))
+            return
+        self.publish(Message('status', "Reconnected."))
+
+    def add_handler(self, handler):
+        """
+        Calls handler(message) for every Message; it may be a coroutine function.
+        """
+        self.handlers.append(handler)
+
+    def remove_handler(self, handler):
+        self.handlers.remove(handler)
+
+    def messages(self):
+        """
+        Returns an async iterator over the Messages received from now on; it ends when
+        the session is closed.
+        """
+        queue = asyncio.Queue(QUEUE_SIZE)
+        if self.closed:
+            queue.put_nowait(None)
+        else:
+            self.queues.append(queue)
+        return self.iterate(queue)
+
+    async def iterate(self, queue):
+        try:
+            while True:
+                message = await queue.get()
+                if message is None:
+                    return
+                yield message
+        finally:
+            if queue in self.queues:
+                self.queues.remove(queue)
+
+    async def command(self, cmd, *args):
+        """
+        Sends a command and returns the server's response text (None on a legacy server).
+        Raises RateLimited if the server refused it and ConnectionLost if the
+        connection went away first.
+        """
+        response, _ = await self.request(cmd, args, False)
+        return response
+
+    async def command_line(self, command_line):
+        """
+        Sends a command typed as text, e.g. "send all hi", and returns the response.
+        """
+        cmd, args = split_command(command_line)
+        return await self.command(cmd, *args)
+
+    async def request(self, cmd, args, replay):
+        """
+        Sends a command; returns the response and, with 'replay', the lines the server
+        replayed for this command before its response (e.g. history).
+        """
+        if self.writer is None:
+            raise ConnectionLost("not connected")
+        args = tuple(args)
+        if self.binary:
+            future = asyncio.get_running_loop().create_future()
+            request_id = next(self.request_ids)
+            self.pending[request_id] = (future, [] if replay else None)
+            self.writer.write(encode_command(cmd, *args, request_id=request_id))
+        else:
+            self.writer.write(" ".join((cmd,) + args).encode('utf-8'))
+            future = None
+        try:
+            await self.writer.drain()
+        except OSError as e:
+            if future is not None:
+                future.cancel()
+            raise ConnectionLost(str(e))
+        if future is None:
+            self.track(cmd, args, None)
+            return None, []
+        response, notices = await future
+        self.track(cmd, args, response)
+        return response, notices
+
+    def track(self, cmd, args, response):
+        """
+        Remembers the login and the rooms, which a reconnect restores.
+        """
+        if cmd == 'login' and response == "login confirmed":
+            self.user, self.password = args
+        elif cmd == 'join' and response and response.startswith(("Joined ", "Error: Already in ")):
+            self.rooms.add(parse_room(args[0]))
+        elif cmd == 'leave' and response and response.startswith("Left "):
+            self.rooms.discard(parse_room(args[0]))
+        elif cmd == 'logout':
+            # The server closes the connection after a logout
+            self.user = self.password = None
+            self.rooms.clear()
+            self.closed = True
+
+    async def login(self, user, password):
+        """
+        Logs in. Raises LoginError if the server refuses.
+        """
+        response = await self.command('login', user, password)
+        if self.binary and response != "login confirmed":
+            raise LoginError(response)
+        return response
+
+    async def newuser(self, user, password):
+        return await self.command('newuser', user, password)
+
+    async def send(self, target, text):
+        """
+        Sends text to a user, to 'all' or to a '#room'. Returns the response, empty
+        when the message was delivered.
+        """
+        return await self.command('send', target, text)
+
+    async def who(self):
+        """
+        Returns the names of the users online.
+        """
+        response = await self.command('who')
+        return response.split(", ") if response else []
+
+    async def join(self, room):
+        return await self.command('join', room)
+
+    async def leave(self, room):
+        return await self.command('leave', room)
+
+    async def list_rooms(self):
+        return await self.command('rooms')
+
+    async def history(self, peer=None, count=None):
+        """
+        Returns the replayed history lines, a title line first, or just the response
+        when there is nothing to replay. 'peer' is a user name or None for "send all"
+        messages.
+        """
+        args = [peer or 'all'] + ([str(count)] if count is not None else [])
+        response, notices = await self.request('history', args, True)
+        if notices:
+            return notices
+        return [response] if response else []
+
+    async def logout(self):
+        """
+        Logs out, which ends the session.
+        """
+        try:
+            return await self.command('logout')
+        finally:
+            await self.close()
+
+    async def close(self):
+        """
+        Closes the connection and stops reconnecting. Pending commands fail.
+        """
+        self.closed = True
+        if self.task is None or self.task is asyncio.current_task():
+            return
+        if self.writer is not None:
+            self.writer.close()  # The reader sees the end of the connection
+        else:
+            self.task.cancel()  # Waiting to reconnect
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+
+async def connect(host=DEFAULT_HOST, port=DEFAULT_PORT, user=None, password=None, **options):
+    """
+    Returns a connected ChatSession, logged in if a user is given.
+    """
+    session = ChatSession(host, port, **options)
+    await session.connect()
+    if user is not None:
+        try:
+            await session.login(user, password)
+        except BaseException:
+            await session.close()
+            raise
+    return session
@@ -0,0 +1,200 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Password hashing and login verification for the chat room server.
+Passwords are stored as salted PBKDF2 hashes. The slow hash runs in a worker pool so
+the server's I/O never waits for it, recently verified logins are answered from a
+keyed in-memory cache, and failed login attempts are rate limited per user.
+'''
+
+# Using Python version 3.12.0
+
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import chat_metrics as metrics
+
+# Stored hash format: pbkdf2_sha256$<iterations>$<salt>$<digest>
+HASH_SCHEME = 'pbkdf2_sha256'
+HASH_ITERATIONS = 100000
+SALT_BYTES = 16
+
+# Worker threads for hashing; hashlib releases the GIL while it runs
+AUTH_WORKERS = 4
+
+# Successful verifications are remembered this long (seconds), for this many users
+CACHE_TTL = 600
+CACHE_SIZE = 100000
+
+# Failed login attempts per user: a burst of ATTEMPT_BURST, refilled at ATTEMPT_RATE per second
+ATTEMPT_BURST = 5
+ATTEMPT_RATE = 0.5
+
+
+def b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def hash_password(password, iterations=HASH_ITERATIONS):
+    """
+    Returns a salted PBKDF2 hash string for a password.
+    """
+    salt = os.urandom(SALT_BYTES)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return f"{HASH_SCHEME}${iterations}${b64(salt)}${b64(digest)}"
+
+
+def is_hashed(stored):
+    """
+    Tells whether a stored password is a hash rather than a legacy plaintext password.
+    """
+    return stored.startswith(HASH_SCHEME + '$')
+
+
+def verify_password(stored, password):
+    """
+    Checks a password against a stored hash, or against a legacy plaintext password.
+    """
+    if not is_hashed(stored):
+        return hmac.compare_digest(stored.encode('utf-8'), password.encode('utf-8'))
+    try:
+        _, iterations, salt, digest = stored.split('$')
+        salt = base64.b64decode(salt)
+        digest = base64.b64decode(digest)
+        iterations = int(iterations)
+    except ValueError:
+        return False
+    candidate = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return hmac.compare_digest(candidate, digest)
+
+
+class LoginRateLimiter:
+    """
+    Token bucket per user id that limits how often a login can be attempted.
+    """
+    def __init__(self, burst=ATTEMPT_BURST, rate=ATTEMPT_RATE, max_users=CACHE_SIZE):
+        self.burst = burst
+        self.rate = rate
+        self.max_users = max_users
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()  # user -> (tokens, last update time)
+
+    def allow(self, user, now=None):
+        """
+        Takes one token from the user's bucket. Returns False if the bucket is empty.
+        """
+        if not self.burst:
+            return True
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            tokens, last = self.buckets.pop(user, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[user] = (tokens, now)
+            # Forget the least recently seen users; their buckets would be full again anyway
+            while len(self.buckets) > self.max_users:
+                self.buckets.popitem(last=False)
+            return allowed
+
+    def refund(self, user):
+        """
+        Gives back the token of an attempt that succeeded, so only failed logins count
+        against the limit.
+        """
+        if not self.burst:
+            return
+        with self.lock:
+            entry = self.buckets.get(user)
+            if entry is not None:
+                self.buckets[user] = (min(self.burst, entry[0] + 1), entry[1])
+
+
+class Authenticator:
+    """
+    Verifies logins off the I/O path.
+    verify() returns a Future so callers can wait or attach a callback, and a cache
+    of recent successes lets a reconnect storm skip the slow hash entirely.
+    """
+    def __init__(self, workers=AUTH_WORKERS, iterations=HASH_ITERATIONS,
+                 cache_ttl=CACHE_TTL, cache_size=CACHE_SIZE, limiter=None):
+        self.iterations = iterations
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='auth')
+        self.limiter = limiter if limiter is not None else LoginRateLimiter()
+        # Cache entries hold a keyed digest of the password, never the password itself
+        self.secret = os.urandom(32)
+        self.cache_lock = threading.Lock()
+        self.cache = OrderedDict()  # user -> (stored hash, keyed digest, expiry time)
+
+    def allow_attempt(self, user):
+        return self.limiter.allow(user)
+
+    def fast_digest(self, user, password):
+        return hmac.new(self.secret, f"{user}\0{password}".encode('utf-8'), hashlib.sha256).digest()
+
+    def cached(self, user, password, stored):
+        """
+        Returns True if this exact password was verified recently for this stored hash.
+        """
+        with self.cache_lock:
+            entry = self.cache.get(user)
+        if entry is None:
+            return False
+        cached_stored, digest, expires = entry
+        if cached_stored != stored or expires < time.monotonic():
+            return False
+        return hmac.compare_digest(digest, self.fast_digest(user, password))
+
+    def remember(self, user, password, stored):
+        entry = (stored, self.fast_digest(user, password), time.monotonic() + self.cache_ttl)
+        with self.cache_lock:
+            self.cache.pop(user, None)
+            self.cache[user] = entry
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def verify(self, user, password, stored, on_upgrade=None):
+        """
+        Checks a login in the worker pool and returns a Future with the result.
+        Cached successes complete immediately. When a legacy plaintext password matches,
+        on_upgrade(user, new_hash) is called from the worker to store a hash instead.
+        A successful login gets its allow_attempt() token back.
+        """
+        start = time.perf_counter()
+        if self.cached(user, password, stored):
+            self.limiter.refund(user)
+            metrics.auth_seconds.observe(time.perf_counter() - start)
+            future = Future()
+            future.set_result(True)
+            return future
+        future = self.pool.submit(self.verify_now, user, password, stored, on_upgrade)
+        future.add_done_callback(lambda done: metrics.auth_seconds.observe(time.perf_counter() - start))
+        return future
+
+    def verify_now(self, user, password, stored, on_upgrade=None):
+        ok = verify_password(stored, password)
+        if ok:
+            if on_upgrade is not None and not is_hashed(stored):
+                stored = hash_password(password, self.iterations)
+                on_upgrade(user, stored)
+            self.remember(user, password, stored)
+            self.limiter.refund(user)
+        return ok
+
+    def submit(self, func, *args):
+        """
+        Runs other slow account work (e.g. hashing plus storing) in the worker pool.
+        """
+        return self.pool.submit(func, *args)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,413 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Compact binary wire format for the chat room server.
+A connection opts in with its own hello (HELLO_BINARY, or HELLO_BINARY_ZLIB to also
+allow compression). Every frame is a varint length, a one-byte opcode and fields;
+strings are a varint length plus UTF-8. Commands arrive already split into fields,
+chat messages carry a small per-connection user id instead of the sender's name
+(introduced once with a DEFINE frame), and bulk output such as offline message
+backlogs and long "who" listings can be sent as one zlib-compressed batch.
+A command may carry a request id (OP_REQUEST); its response then carries the same id
+(OP_RESP_ID, OP_THROTTLE_ID), so a client can have many commands in flight and match
+every response without relying on order. Lines a command replays before its
+response (e.g. "history") are typed frames of their own (OP_REPLAY, OP_REPLAY_ID),
+so they cannot be mixed up with notices that arrive meanwhile. The server still
+runs each connection's commands one after another. A server that shuts down says
+goodbye (OP_GOODBYE) with the time the client should wait before it reconnects.
+'''
+
+# Using Python version 3.12.0
+
+import threading
+import zlib
+
+# Hellos of the binary protocol; same length as the framed text hello
+HELLO_BINARY = b"\x00CHATBN1"
+HELLO_BINARY_ZLIB = b"\x00CHATBZ1"
+
+# Client -> server opcodes; the fields are the command's arguments as strings
+COMMAND_OPS = {
+    0x01: 'login',
+    0x02: 'newuser',
+    0x03: 'send',
+    0x04: 'who',
+    0x05: 'logout',
+    0x06: 'join',
+    0x07: 'leave',
+    0x08: 'rooms',
+    0x09: 'history',
+}
+COMMAND_CODES = {cmd: op for op, cmd in COMMAND_OPS.items()}
+OP_TEXT = 0x0F  # One field holding a text command line, for anything else
+OP_PONG = 0x10  # No fields: answer to a heartbeat, never passed on as a command
+OP_REQUEST = 0x11  # varint request id, then the opcode and fields of a command
+
+# Server -> client opcodes
+OP_RESP = 0x40    # text: the response to one command, sent for every command (may be empty)
+OP_DEFINE = 0x41  # id, name: introduces a user id on this connection
+OP_MSG = 0x42     # sender id, text: direct message
+OP_ALL = 0x43     # sender id, text: "send all" message
+OP_ROOM = 0x44    # sender id, room, text: room message
+OP_NOTICE = 0x45  # text: any other server event, e.g. "X joins."
+OP_PING = 0x46    # no fields: heartbeat, the client answers with OP_PONG
+OP_THROTTLE = 0x47  # scope, varint milliseconds: sent instead of OP_RESP for a rate-limited command
+OP_RESP_ID = 0x48  # varint request id, text: OP_RESP for a command sent with OP_REQUEST
+OP_THROTTLE_ID = 0x49  # varint request id, scope, varint milliseconds: OP_THROTTLE likewise
+OP_GOODBYE = 0x4A  # text, varint milliseconds: the server shuts down; reconnect after that long
+OP_REPLAY = 0x4B  # text: one line replayed by the command being run (e.g. history), before its OP_RESP
+OP_REPLAY_ID = 0x4C  # varint request id, text: OP_REPLAY for a command sent with OP_REQUEST
+OP_ZBATCH = 0x7F  # zlib-compressed sequence of complete frames
+
+# Outgoing bulk data is compressed from this size on, on connections that allow it
+COMPRESS_MIN = 512
+COMPRESS_LEVEL = 1
+# Largest decompressed batch accepted
+MAX_BATCH = 16 * 1024 * 1024
+# Largest frame accepted from the network
+MAX_FRAME = 64 * 1024
+
+
+class ProtocolError(ValueError):
+    """
+    Raised when a peer sends bytes that are not valid in the binary protocol.
+    """
+
+
+def encode_varint(value):
+    """
+    Encodes a non-negative integer in 7-bit groups, low group first.
+    """
+    if value < 0x80:
+        return bytes((value,))
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(data, pos):
+    """
+    Returns (value, next position), or (None, pos) if the varint is incomplete.
+    """
+    value = 0
+    shift = 0
+    end = len(data)
+    while pos < end:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+        if shift > 35:
+            raise ProtocolError("varint is too long")
+    return None, pos
+
+
+def encode_string(text):
+    data = text.encode('utf-8')
+    return encode_varint(len(data)) + data
+
+
+def decode_string(data, pos):
+    length, pos = decode_varint(data, pos)
+    if length is None or pos + length > len(data):
+        raise ProtocolError("truncated string")
+    return data[pos:pos + length].decode('utf-8', errors='replace'), pos + length
+
+
+def frame(op, body=b""):
+    """
+    Returns one frame: varint length of opcode plus body, the opcode, the body.
+    """
+    return encode_varint(len(body) + 1) + bytes((op,)) + body
+
+
+def frame_strings(op, *fields):
+    return frame(op, b"".join(encode_string(field) for field in fields))
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for varint-length frames. Returns (opcode, body) pairs.
+    """
+    def __init__(self, max_frame=MAX_FRAME):
+        self.max_frame = max_frame
+        self.buf = bytearray()
+        self.pos = 0
+
+    def feed(self, data):
+        buf = self.buf
+        buf += data
+        frames = []
+        pos = self.pos
+        end = len(buf)
+        while pos < end:
+            length = buf[pos]
+            if length < 0x80:
+                start = pos + 1  # Fast path: one-byte length
+            else:
+                length, start = decode_varint(buf, pos)
+                if length is None:
+                    break  # Partial length
+            if length == 0 or length > self.max_frame:
+                raise ProtocolError(f"invalid frame length {length}")
+            if end - start < length:
+                break  # Partial frame; wait for more data
+            frames.append((buf[start], bytes(buf[start + 1:start + length])))
+            pos = start + length
+        if pos == end:
+            buf.clear()
+            pos = 0
+        elif pos > 65536 and pos * 2 > end:
+            del buf[:pos]
+            pos = 0
+        self.pos = pos
+        return frames
+
+
+def decode_fields(body):
+    """
+    Splits a command body into its string fields.
+    """
+    fields = []
+    pos = 0
+    end = len(body)
+    while pos < end:
+        length = body[pos]
+        if length < 0x80:
+            pos += 1  # Fast path: one-byte length
+        else:
+            length, pos = decode_varint(body, pos)
+            if length is None:
+                raise ProtocolError("truncated string")
+        if pos + length > end:
+            raise ProtocolError("truncated string")
+        fields.append(body[pos:pos + length].decode('utf-8', errors='replace'))
+        pos += length
+    return fields
+
+
+def decode_command(op, body):
+    """
+    Turns a client frame into (command, arguments) for the server, or a text
+    command line for OP_TEXT frames. A command with a request id becomes
+    (command, arguments, request id), or (command line, None, request id).
+    """
+    if op == OP_TEXT:
+        return decode_string(body, 0)[0].strip()
+    if op == OP_REQUEST:
+        request_id, pos = decode_varint(body, 0)
+        if request_id is None or pos >= len(body):
+            raise ProtocolError("truncated request")
+        op = body[pos]
+        if op == OP_TEXT:
+            return decode_string(body, pos + 1)[0].strip(), None, request_id
+        cmd = COMMAND_OPS.get(op)
+        if cmd is None:
+            raise ProtocolError(f"unknown command opcode {op:#x}")
+        return cmd, decode_fields(body[pos + 1:]), request_id
+    cmd = COMMAND_OPS.get(op)
+    if cmd is None:
+        raise ProtocolError(f"unknown command opcode {op:#x}")
+    return cmd, decode_fields(body)
+
+
+def encode_command(cmd, *args, request_id=None):
+    """
+    Client side: encodes a command and its arguments, with a request id if given.
+    Commands without an opcode are sent as a text command line.
+    """
+    op = COMMAND_CODES.get(cmd)
+    if op is None:
+        op, args = OP_TEXT, (" ".join((cmd,) + args),)
+    if request_id is None:
+        return frame_strings(op, *args)
+    return frame(OP_REQUEST, encode_varint(request_id) + bytes((op,)) + b"".join(encode_string(arg) for arg in args))
+
+
+def compress_frames(data, session):
+    """
+    Wraps already encoded frames in one compressed batch if the connection allows it
+    and it is worth it; otherwise returns them unchanged.
+    """
+    if not session.compress or len(data) < COMPRESS_MIN:
+        return data
+    return frame(OP_ZBATCH, zlib.compress(data, COMPRESS_LEVEL))
+
+
+class InternTable:
+    """
+    Process-wide user name -> id table. The DEFINE frame of every user is built once.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.defines = []
+        self.lock = threading.Lock()
+
+    def intern(self, name):
+        user_id = self.ids.get(name)
+        if user_id is None:
+            with self.lock:
+                user_id = self.ids.get(name)
+                if user_id is None:
+                    user_id = len(self.defines)
+                    self.defines.append(frame(OP_DEFINE, encode_varint(user_id) + encode_string(name)))
+                    self.ids[name] = user_id
+        return user_id
+
+    def define(self, user_id):
+        return self.defines[user_id]
+
+    def names(self):
+        """
+        Returns every interned name in id order; interning them in this order in a new
+        process gives the same ids.
+        """
+        with self.lock:
+            return sorted(self.ids, key=self.ids.get)
+
+
+USER_IDS = InternTable()
+
+# Heartbeat frames
+PING_FRAME = frame(OP_PING)
+PONG_FRAME = frame(OP_PONG)
+
+
+class BinarySession:
+    """
+    Per-connection state of the binary protocol: which user ids the peer knows,
+    whether it accepts compressed batches and the request id of the command being run.
+    """
+    __slots__ = ('compress', 'defined', 'request_id')
+
+    def __init__(self, compress=False):
+        self.compress = compress
+        self.defined = set()
+        self.request_id = None  # Set by the server for every command; None if it came without one
+
+    @property
+    def hello(self):
+        return HELLO_BINARY_ZLIB if self.compress else HELLO_BINARY
+
+    def response(self, text):
+        if self.request_id is None:
+            return compress_frames(frame_strings(OP_RESP, text), self)
+        return compress_frames(frame(OP_RESP_ID, encode_varint(self.request_id) + encode_string(text)), self)
+
+    def notice(self, text):
+        return frame_strings(OP_NOTICE, text)
+
+    def replay(self, text):
+        if self.request_id is None:
+            return frame_strings(OP_REPLAY, text)
+        return frame(OP_REPLAY_ID, encode_varint(self.request_id) + encode_string(text))
+
+    def ping(self):
+        return PING_FRAME
+
+    def throttle(self, scope, wait):
+        body = encode_string(scope) + encode_varint(int(wait * 1000) + 1)
+        if self.request_id is None:
+            return frame(OP_THROTTLE, body)
+        return frame(OP_THROTTLE_ID, encode_varint(self.request_id) + body)
+
+    def goodbye(self, text, wait):
+        return frame(OP_GOODBYE, encode_string(text) + encode_varint(int(wait * 1000)))
+
+
+def encode_event(kind, sender_id, body, room=None):
+    """
+    Encodes a chat message from a user; shared by every binary recipient.
+    """
+    head = encode_varint(sender_id)
+    if kind == 'room':
+        return frame(OP_ROOM, head + encode_string(room) + encode_string(body))
+    return frame(OP_ALL if kind == 'all' else OP_MSG, head + encode_string(body))
+
+
+class ClientDecoder:
+    """
+    Client side: decodes server frames into events, resolving user ids and batches.
+    Events are tuples: ('resp', text), ('notice', text), ('msg', sender, text),
+    ('all', sender, text), ('room', sender, room, text), ('throttle', scope,
+    milliseconds), ('replay', text), ('goodbye', text, milliseconds) and ('ping',);
+    the client should answer a ping with PONG_FRAME.
+    Responses to commands sent with a request id have it as an extra last field:
+    ('resp', text, request id), ('throttle', scope, milliseconds, request id) and
+    ('replay', text, request id).
+    """
+    def __init__(self):
+        self.frames = FrameDecoder(max_frame=MAX_BATCH)
+        self.names = {}
+
+    def feed(self, data):
+        events = []
+        for op, body in self.frames.feed(data):
+            self.decode(op, body, events)
+        return events
+
+    def decode(self, op, body, events):
+        if op == OP_ZBATCH:
+            inflater = zlib.decompressobj()
+            data = inflater.decompress(body, MAX_BATCH)
+            if inflater.unconsumed_tail:
+                raise ProtocolError("compressed batch is too large")
+            inner = FrameDecoder(max_frame=MAX_BATCH)
+            for inner_op, inner_body in inner.feed(data):
+                self.decode(inner_op, inner_body, events)
+        elif op == OP_DEFINE:
+            user_id, pos = decode_varint(body, 0)
+            self.names[user_id] = decode_string(body, pos)[0]
+        elif op in (OP_MSG, OP_ALL, OP_ROOM):
+            user_id, pos = decode_varint(body, 0)
+            sender = self.names.get(user_id, f"#{user_id}")
+            if op == OP_ROOM:
+                room, pos = decode_string(body, pos)
+                events.append(('room', sender, room, decode_string(body, pos)[0]))
+            else:
+                events.append(('msg' if op == OP_MSG else 'all', sender, decode_string(body, pos)[0]))
+        elif op == OP_RESP:
+            events.append(('resp', decode_string(body, 0)[0]))
+        elif op == OP_NOTICE:
+            events.append(('notice', decode_string(body, 0)[0]))
+        elif op == OP_PING:
+            events.append(('ping',))
+        elif op == OP_THROTTLE:
+            scope, pos = decode_string(body, 0)
+            events.append(('throttle', scope, decode_varint(body, pos)[0]))
+        elif op == OP_RESP_ID:
+            request_id, pos = decode_varint(body, 0)
+            events.append(('resp', decode_string(body, pos)[0], request_id))
+        elif op == OP_THROTTLE_ID:
+            request_id, pos = decode_varint(body, 0)
+            scope, pos = decode_string(body, pos)
+            events.append(('throttle', scope, decode_varint(body, pos)[0], request_id))
+        elif op == OP_REPLAY:
+            events.append(('replay', decode_string(body, 0)[0]))
+        elif op == OP_REPLAY_ID:
+            request_id, pos = decode_varint(body, 0)
+            events.append(('replay', decode_string(body, pos)[0], request_id))
+        elif op == OP_GOODBYE:
+            text, pos = decode_string(body, 0)
+            events.append(('goodbye', text, decode_varint(body, pos)[0]))
+        else:
+            raise ProtocolError(f"unknown opcode {op:#x}")
+
+
+def event_text(event):
+    """
+    Renders a decoded event the way the text protocol shows it.
+    """
+    kind = event[0]
+    if kind in ('resp', 'notice', 'replay', 'goodbye'):
+        return event[1]
+    if kind == 'throttle':
+        return f"Error: Rate limit exceeded ({event[1]}). Retry after {event[2]} ms."
+    if kind == 'room':
+        return f"{event[2]} {event[1]}: {event[3]}"
+    return f"{event[1]}: {event[2]}"
@@ -0,0 +1,108 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Traffic capture for the chat room server. With --capture FILE
+the server records every command it receives, so a real workload can be played
+back later against another build of the server (see chat_replay.py). The trace is
+JSON lines: the first line describes the capture, every other line is
+[seconds since the capture started, connection number, command], where the command
+is the text command line as received, or [command, arguments] for commands of the
+binary protocol; a connection that went away gets a null command. Connections are
+numbered in the order their first command arrived and only appear once they sent
+one. Lines are buffered and written out at least once a second.
+The trace holds what clients typed, passwords included, so only its owner may read it.
+'''
+
+# Using Python version 3.12.0
+
+import json
+import os
+import threading
+import time
+
+# Version of the trace format; chat_replay.py refuses traces of another version
+TRACE_VERSION = 1
+# Seconds buffered lines may wait before they are written to the file
+FLUSH_INTERVAL = 1.0
+
+
+class TrafficCapture:
+    """
+    Appends the commands of every connection to a trace file. Safe to use from the
+    handler threads of the threaded mode.
+    """
+    def __init__(self, path):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        self.file = os.fdopen(fd, 'w', encoding='utf-8')
+        self.path = path
+        self.lock = threading.Lock()
+        self.connections = {}  # Client -> connection number
+        self.numbers = 0
+        self.started = time.monotonic()
+        self.flushed = self.started
+        self.write({'trace': TRACE_VERSION, 'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'pid': os.getpid()})
+
+    def command(self, client, command):
+        """
+        Records a command as process_command() gets it: a text command line, or a
+        (command, arguments[, request id]) tuple of the binary protocol.
+        """
+        if type(command) is not str:
+            cmd, args = command[0], command[1]
+            # A text command line sent with a request id arrives without its arguments
+            command = cmd if args is None else [cmd, list(args)]
+        with self.lock:
+            number = self.connections.get(client)
+            if number is None:
+                self.numbers += 1
+                number = self.connections[client] = self.numbers
+            self.record(number, command)
+
+    def closed(self, client):
+        """
+        Records the end of a connection that sent commands.
+        """
+        with self.lock:
+            number = self.connections.pop(client, None)
+            if number is not None:
+                self.record(number, None)
+
+    def record(self, number, command):
+        now = time.monotonic()
+        self.write([round(now - self.started, 6), number, command])
+        if now - self.flushed >= FLUSH_INTERVAL:
+            self.file.flush()
+            self.flushed = now
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry, separators=(',', ':'), ensure_ascii=False) + "\n")
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+def read_trace(path):
+    """
+    Returns (description, events) of a trace file, the events as (seconds, connection
+    number, command) tuples in the order they were recorded. Raises ValueError for a
+    file that is not a trace of this version.
+    """
+    with open(path, encoding='utf-8') as f:
+        try:
+            description = json.loads(f.readline())
+        except ValueError:
+            raise ValueError(f"{path} is not a traffic capture")
+        if not isinstance(description, dict) or description.get('trace') != TRACE_VERSION:
+            raise ValueError(f"{path} is not a traffic capture of version {TRACE_VERSION}")
+        events = []
+        for number, line in enumerate(f, 2):
+            try:
+                seconds, connection, command = json.loads(line)
+            except ValueError:
+                if not line.endswith("\n"):
+                    break  # Cut off while the server was writing it
+                raise ValueError(f"{path}:{number}: not a trace entry")
+            events.append((seconds, connection, command))
+    return description, events
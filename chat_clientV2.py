@@ -3,148 +3,215 @@ Nolan Rink
 CS 4850 Project V2
 Due: 3/21/2025
 Program Description: This is the client component of a chat room application.
+It is a thin command line front end to the client library in chat_aioclient.py.
 '''
 
 # Using Python version 3.12.0
-import socket
+import argparse
+import asyncio
+import os
+import ssl
 import sys
 import threading
 
-# Default server address and port
-SERVER_HOST = '127.0.0.1'
-SERVER_PORT = 19953
-
-if len(sys.argv) >= 2:
-    SERVER_HOST = sys.argv[1]
-if len(sys.argv) >= 3:
-    try:
-        SERVER_PORT = int(sys.argv[2])
-    except ValueError:
-        print("Invalid port number. Using default 19953.")
-        SERVER_PORT = 19953
+from chat_aioclient import DEFAULT_HOST, DEFAULT_PORT, ChatSession, ConnectionLost, RateLimited
+from chat_tls import client_context
 
-# Global client state
-logged_in = False
-current_user = None
-running = True
-
-# Connect to the server
-client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-try:
-    client_sock.connect((SERVER_HOST, SERVER_PORT))
-except Exception as e:
-    print(f"Could not connect to server {SERVER_HOST}:{SERVER_PORT} -> {e}")
-    sys.exit(1)
+# Default server address and port
+SERVER_HOST = DEFAULT_HOST
+SERVER_PORT = DEFAULT_PORT
 
-print("\nMy chat room client. Version Two.\n")
+# Commands that need a logged in user
+LOGGED_IN_COMMANDS = ("send", "logout", "who", "join", "leave", "rooms", "history")
 
 def clear_line():
     # Overwrite the current line with spaces and return the cursor to the beginning.
     sys.stdout.write("\r" + " " * 80 + "\r")
     sys.stdout.flush()
 
-def listen_for_messages(sock):
-    global running, logged_in, current_user
-    while running:
+def read_input(loop, lines):
+    """
+    Reads typed lines on a thread of its own; None means end of input. Uses os.read()
+    rather than input(), whose stdin lock would hold up the exit while it waits.
+    """
+    pending = b""
+    while True:
         try:
-            data = sock.recv(1024)
-            if not data:
-                clear_line()
-                sys.stdout.write("Server closed the connection.\n")
-                sys.stdout.flush()
-                running = False
+            data = os.read(sys.stdin.fileno(), 4096)
+        except OSError:
+            data = b""
+        if not data:
+            if pending:
+                loop.call_soon_threadsafe(lines.put_nowait, pending.decode('utf-8', errors='ignore'))
+            loop.call_soon_threadsafe(lines.put_nowait, None)
+            return
+        *complete, pending = (pending + data).split(b"\n")
+        for line in complete:
+            loop.call_soon_threadsafe(lines.put_nowait, line.decode('utf-8', errors='ignore'))
+
+class Console:
+    """
+    Checks typed commands, sends them through a ChatSession and prints whatever the
+    server sends back. With the binary protocol the login state comes from the session,
+    which knows which response answers which command; on a legacy server it can only
+    be guessed from the text the server sends.
+    """
+    def __init__(self, session):
+        self.session = session
+        self.logged_in = False
+        self.current_user = None
+
+    def show(self, message):
+        """
+        Session handler: prints an incoming message or a connection status change.
+        """
+        if message.kind == 'status' and self.session.binary and self.session.user is None:
+            self.logged_in = False  # Logging in again after a reconnect failed
+        self.handle_server_message(str(message))
+
+    def handle_server_message(self, message):
+        clear_line()
+        sys.stdout.write(message + "\n")
+        sys.stdout.flush()
+        if self.session.binary:
+            return
+        if message.lower() == "login confirmed":
+            self.logged_in = True
+        if self.current_user and message.lower() == f"{self.current_user.lower()} left.":
+            self.logged_in = False
+            self.current_user = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        lines = asyncio.Queue()
+        threading.Thread(target=read_input, args=(loop, lines), daemon=True).start()
+        while not self.session.closed:
+            # Stop waiting for input when the session ends
+            next_line = loop.create_task(lines.get())
+            await asyncio.wait((next_line, self.session.task), return_when=asyncio.FIRST_COMPLETED)
+            if not next_line.done():
+                next_line.cancel()
                 break
-            message = data.decode('utf-8', errors='ignore').strip()
-            clear_line()
-            sys.stdout.write(message + "\n")
-            sys.stdout.flush()
-            if message.lower() == "login confirmed":
-                logged_in = True
-            if current_user and message.lower() == f"{current_user.lower()} left.":
-                logged_in = False
-                current_user = None
-        except Exception as e:
-            clear_line()
-            sys.stdout.write("Connection to server lost.\n")
-            sys.stdout.flush()
-            running = False
-            break
-
-# Start a listener thread for asynchronous messages
-listener_thread = threading.Thread(target=listen_for_messages, args=(client_sock,), daemon=True)
-listener_thread.start()
-
-try:
-    while running:
-        try:
-            user_input = input("")  # Removed prompt
-        except EOFError:
-            break
-        if user_input is None:
-            continue
+            user_input = next_line.result()
+            if user_input is None:
+                break
+            if not await self.handle_input(user_input):
+                break
+
+    async def handle_input(self, user_input):
+        """
+        Runs one typed command. Returns False when the client should exit.
+        """
         command_line = user_input.strip()
         if command_line == "":
-            continue
+            return True
 
         tokens = command_line.split()
         cmd = tokens[0].lower()
 
         # - When logged out: only "login" and "newuser" are allowed.
-        # - When logged in: only "send", "logout", and "who" are allowed.
-        if not logged_in:
+        # - When logged in: "send", "logout", "who", "history" and the room commands are allowed.
+        if not self.logged_in:
             if cmd not in ("login", "newuser"):
-                if cmd in ("send", "logout", "who"):
+                if cmd in LOGGED_IN_COMMANDS:
                     print("Denied. Please login first.")
                 else:
                     print("Error: Unknown command")
-                continue
+                return True
         else:
-            if cmd not in ("send", "logout", "who"):
+            if cmd not in LOGGED_IN_COMMANDS:
                 print("Denied. Please login first.")
-                continue
+                return True
 
         # Enforce argument count and length restrictions for login and newuser
         if cmd in ("login", "newuser"):
             if len(tokens) != 3:
                 print(f"Usage: {cmd} <UserID> <Password>")
-                continue
+                return True
             _, user_id, pwd = tokens
             if len(user_id) < 3 or len(user_id) > 32:
                 print("UserID must be 3-32 characters long")
-                continue
+                return True
             if len(pwd) < 4 or len(pwd) > 8:
                 print("Password must be 4-8 characters long")
-                continue
+                return True
 
         # For "send", enforce nonempty message and length restrictions.
         if cmd == "send":
             message_content = command_line[4:].strip()
             if message_content == "":
                 print("Denied. Message is empty")
-                continue
+                return True
             if len(message_content) < 1 or len(message_content) > 256:
                 print("Denied. Message must be between 1 and 256 characters long")
-                continue
+                return True
 
         if cmd == "login":
-            current_user = tokens[1]
+            self.current_user = tokens[1]
 
         try:
-            client_sock.sendall(command_line.encode('utf-8'))
-        except Exception as e:
+            response = await self.session.command_line(command_line)
+        except RateLimited as e:
+            response = f"Error: Rate limit exceeded ({e.scope}). Retry after {round(e.retry_after * 1000)} ms."
+        except ConnectionLost:
             print("Connection to server lost.")
-            running = False
-            break
+            return not self.session.closed
+        if response:
+            self.handle_server_message(response)
+        if self.session.binary:
+            self.logged_in = self.session.user is not None
 
         # If logout was issued, stop the loop.
         if cmd == "logout":
-            logged_in = False
-            current_user = None
-            running = False
-            break
-
-except KeyboardInterrupt:
-    pass
-finally:
-    running = False
-    client_sock.close()
+            self.logged_in = False
+            self.current_user = None
+            return False
+        return True
+
+async def run_client(host, port, tls=None):
+    session = ChatSession(host, port, tls=tls)
+    try:
+        await session.connect()
+    except OSError as e:
+        print(f"Could not connect to server {host}:{port} -> {e}")
+        sys.exit(1)
+
+    print("\nMy chat room client. Version Two.\n")
+    console = Console(session)
+    session.add_handler(console.show)
+    try:
+        await console.run()
+    finally:
+        await session.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chat room client, version two.")
+    parser.add_argument('host', nargs='?', default=SERVER_HOST)
+    parser.add_argument('port', nargs='?', default=str(SERVER_PORT))
+    parser.add_argument('--tls', action='store_true', help="encrypt the connection")
+    parser.add_argument('--tls-ca', default=None,
+                        help="certificate (PEM) the server's certificate must be signed with; implies --tls")
+    parser.add_argument('--tls-insecure', action='store_true',
+                        help="accept any server certificate (testing only); implies --tls")
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    host = args.host
+    try:
+        port = int(args.port)
+    except ValueError:
+        print("Invalid port number. Using default 19953.")
+        port = SERVER_PORT
+    tls = None
+    if args.tls or args.tls_ca or args.tls_insecure:
+        try:
+            tls = client_context(args.tls_ca, verify=not args.tls_insecure)
+        except (OSError, ssl.SSLError) as e:
+            print(f"Could not load the CA certificate {args.tls_ca}: {e}")
+            sys.exit(1)
+    try:
+        asyncio.run(run_client(host, port, tls))
+    except KeyboardInterrupt:
+        pass
+
+# Entry point of the program
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Connection states and the command dispatch table of the chat
+room server. Every connection is a Session that is unauthenticated until a login
+succeeds, authenticated until it logs out, and closing from then on (or when the
+server drops it). Commands are registered in a CommandTable with the states they
+are allowed in, their number of arguments and their usage text, so the handlers
+only deal with valid requests and new commands plug in without touching the
+others. A text command line is split once: the command name is looked up first,
+and its entry decides how the rest of the line is split.
+'''
+
+# Using Python version 3.12.0
+
+import sys
+
+# Connection states
+UNAUTHENTICATED = 'unauthenticated'
+AUTHENTICATED = 'authenticated'
+CLOSING = 'closing'
+
+# Response to a command that needs a logged in user
+LOGIN_FIRST = "Denied. Please login first."
+
+
+class Session:
+    """
+    Login state of one client connection; the base class of the server's client
+    classes. 'closing' stays a plain flag for the code that only needs to know
+    whether the connection is on its way out.
+    """
+    __slots__ = ('user', 'state', 'limits')
+
+    def __init__(self):
+        self.user = None
+        self.state = UNAUTHENTICATED
+        self.limits = None  # Rate limit buckets (see chat_ratelimit.py)
+
+    @property
+    def closing(self):
+        return self.state is CLOSING
+
+    @closing.setter
+    def closing(self, closing):
+        if closing:
+            self.state = CLOSING
+        elif self.state is CLOSING:
+            self.state = AUTHENTICATED if self.user else UNAUTHENTICATED
+
+    def login(self, user):
+        self.user = user
+        if self.state is not CLOSING:
+            self.state = AUTHENTICATED
+
+    def logout(self):
+        """
+        Forgets the user; the connection is closed after the confirmation is sent.
+        """
+        self.user = None
+        self.state = CLOSING
+
+
+class Command:
+    """
+    Entry of the dispatch table. 'handler(client, args)' returns the response text
+    like process_command() does. With 'rest' the last argument is the remainder of
+    a text command line with its spacing kept (the message of "send").
+    """
+    __slots__ = ('name', 'handler', 'states', 'min_args', 'max_args', 'usage', 'denied', 'rest')
+
+    def __init__(self, name, handler, states, min_args, max_args, usage, denied, rest):
+        self.name = name
+        self.handler = handler
+        self.states = states
+        self.min_args = min_args
+        self.max_args = max_args
+        self.usage = usage
+        self.denied = denied
+        self.rest = rest
+
+
+class CommandTable:
+    """
+    Registered commands by name.
+    """
+    def __init__(self):
+        self.commands = {}
+
+    def register(self, name, handler, states=(AUTHENTICATED,), args=(0, None), usage=None, denied=LOGIN_FIRST,
+                 rest=False):
+        """
+        Adds or replaces a command. 'args' is the (minimum, maximum) number of
+        arguments, maximum None for any number; 'denied' is the response in the other
+        states (except while closing), formatted with the client's {user}.
+        """
+        min_args, max_args = args
+        if rest and not max_args:
+            raise ValueError(f"Command {name} needs a maximum number of arguments to split off the rest")
+        if max_args is None:
+            max_args = sys.maxsize
+        self.commands[name] = Command(name, handler, frozenset(states), min_args, max_args, usage, denied, rest)
+
+    def command(self, name, **options):
+        """
+        Decorator that registers a handler function; see register().
+        """
+        def decorate(handler):
+            self.register(name, handler, **options)
+            return handler
+        return decorate
+
+    def names(self):
+        return tuple(self.commands)
+
+    def lookup(self, name):
+        return self.commands.get(name)
+
+    def parse(self, line):
+        """
+        Splits a text command line. Returns (entry or None, command name, arguments).
+        """
+        head = line.split(None, 1)
+        if not head:
+            return None, "", ()
+        name = head[0].lower()
+        command = self.commands.get(name)
+        if len(head) == 1:
+            return command, name, ()
+        if command is not None and command.rest:
+            return command, name, head[1].split(' ', command.max_args - 1)
+        return command, name, head[1].split()
+
+    def dispatch(self, client, command, args):
+        """
+        Runs a command for a client, after checking the connection's state and the
+        number of arguments. Commands arriving while the connection closes are dropped.
+        """
+        state = client.state
+        if state not in command.states:
+            return None if state is CLOSING else command.denied.format(user=client.user)
+        if not command.min_args <= len(args) <= command.max_args:
+            return command.usage
+        return command.handler(client, args)
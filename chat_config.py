@@ -0,0 +1,115 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Settings file and live reload for the chat room server.
+Every command line option can also be set in the [server] section of an INI file
+given with --config, named like the option without its dashes, e.g.
+"queue-limit = 1048576". Options on the command line win over the file.
+A reload (SIGHUP, or POST /config on the admin endpoint) reads the file again,
+applies the settings that can change while the server runs, and logs the ones
+that only take effect after a restart.
+'''
+
+# Using Python version 3.12.0
+
+import configparser
+from concurrent.futures import Future
+
+from chat_logging import log
+
+# Section of the settings file that holds the server options
+SECTION = 'server'
+# Seconds an admin request waits for a reload to be applied
+RELOAD_TIMEOUT = 10.0
+
+
+def read_config(path):
+    """
+    Returns the options set in a settings file as command line arguments, so they
+    are checked and converted exactly like the command line.
+    """
+    parser = configparser.ConfigParser(interpolation=None)
+    with open(path, 'r') as f:
+        parser.read_file(f)
+    if not parser.has_section(SECTION):
+        raise ValueError(f"{path} has no [{SECTION}] section")
+    argv = []
+    for name, value in parser.items(SECTION):
+        argv += ['--' + name.replace('_', '-'), value]
+    return argv
+
+
+def format_setting(value):
+    if isinstance(value, tuple):
+        return "/".join(f"{item:g}" for item in value)
+    return str(value)
+
+
+class Reloader:
+    """
+    Keeps the current settings and replaces them on reload.
+    'parse()' returns the new settings (an argparse namespace) and may raise
+    SystemExit on bad options; 'apply(old, new)' puts them into effect and returns
+    the names of changed settings that need a restart; 'schedule(func)' runs func
+    where the server's state may be changed, e.g. on the event loop thread.
+    Published on the admin endpoint: GET shows the settings, POST reloads them.
+    """
+    def __init__(self, args, parse, apply, schedule=None):
+        self.args = args
+        self.parse = parse
+        self.apply = apply
+        self.schedule = schedule or (lambda func: func())
+
+    def settings(self):
+        return {name: format_setting(value) for name, value in sorted(vars(self.args).items())}
+
+    def configure(self, **options):
+        """
+        Admin endpoint: reloads the settings and waits until they are applied.
+        """
+        if options:
+            raise ValueError("a reload takes no parameters; change the settings file instead")
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(self.reload())
+            except Exception as e:
+                future.set_exception(e)
+        self.schedule(run)
+        future.result(RELOAD_TIMEOUT)
+
+    def request_reload(self, *signal_args):
+        """
+        Signal handler: reloads as soon as the server gets to it. Errors are logged.
+        """
+        def run():
+            try:
+                self.reload()
+            except ValueError as e:
+                log.error(f"Reload failed: {e}")
+        self.schedule(run)
+
+    def reload(self):
+        """
+        Reads the settings again and applies what changed. Raises ValueError, and
+        keeps the current settings, if the new ones are not valid.
+        """
+        try:
+            new = self.parse()
+        except (OSError, configparser.Error) as e:
+            raise ValueError(f"cannot read the settings: {e}")
+        except SystemExit:
+            # argparse already printed what is wrong
+            raise ValueError("invalid settings")
+        old = self.args
+        changed = [name for name in vars(new) if getattr(old, name, None) != getattr(new, name)]
+        restart = self.apply(old, new)
+        # Settings that need a restart keep their running value and are reported again next time
+        for name in restart:
+            setattr(new, name, getattr(old, name))
+        self.args = new
+        applied = [name for name in changed if name not in restart]
+        log.warning(f"Settings reloaded; changed: {', '.join(applied) or 'nothing'}"
+                    + (f"; needs a restart: {', '.join(restart)}" if restart else ""))
+        return changed
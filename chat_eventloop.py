@@ -0,0 +1,823 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Single-threaded event-loop server mode for the chat room server.
+All client sockets are multiplexed with the selectors module, so thousands of mostly
+idle connections cost one small object each instead of one OS thread each.
+Output to framed clients is coalesced: their messages are queued and written together
+with one system call once the current batch of events is handled, or after a short delay.
+Timeouts run on a timer wheel advanced by the loop itself.
+For a restart the loop can be frozen and its connections detached, and a new loop
+can adopt connections handed over by another process (see chat_handoff.py).
+For a shutdown it drains instead: it stops accepting and reading, lets every client
+know, and closes the connections a batch at a time once their output is written.
+With TLS every accepted connection starts with a non-blocking handshake; its
+expensive steps run in a thread pool while the loop serves everybody else.
+'''
+
+# Using Python version 3.12.0
+
+import errno
+import selectors
+import socket
+import ssl
+import threading
+import time
+from collections import deque
+
+import chat_metrics as metrics
+from chat_commands import Session
+from chat_logging import log
+from chat_outbound import (COALESCE_MAX_BYTES, DEFAULT_COALESCE_DELAY, DEFAULT_POLICY, DEFAULT_QUEUE_BYTES,
+                           OutboundQueue, SlowConsumerError, tune_socket, write_queued)
+from chat_protocol import PING_FRAME, CommandReader, encode_message
+from chat_ratelimit import PAUSE_MAX, throttle_text
+from chat_timers import TimerWheel
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Maximum number of connections accepted per readiness event on the listening socket
+ACCEPT_BATCH = 256
+# Chunks of a stream written per loop iteration, and the queued bytes that pause a stream
+STREAM_BATCHES = 4
+STREAM_LOW_WATER = 64 * 1024
+
+
+def handshake_step(sock):
+    """
+    Runs a TLS handshake as far as the data received so far allows. Returns the
+    selector events to wait for, 0 once the handshake is complete, or the error
+    that ended it.
+    """
+    try:
+        sock.do_handshake()
+    except ssl.SSLWantReadError:
+        return selectors.EVENT_READ
+    except ssl.SSLWantWriteError:
+        return selectors.EVENT_WRITE
+    except (OSError, ValueError) as e:
+        return e
+    return 0
+
+
+def raise_fd_limit(wanted):
+    """
+    Raises the soft open-file limit towards the hard limit so the loop can hold
+    'wanted' client sockets. Returns the resulting soft limit.
+    """
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    # Leave some room for the listening socket, log files and the selector itself
+    target = wanted + 64
+    if hard != resource.RLIM_INFINITY:
+        target = min(target, hard)
+    if target > soft:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+class EventClient(Session):
+    """
+    Per-connection state for the event-loop mode.
+    Provides the same send()/session interface as the threaded client wrapper.
+    """
+    __slots__ = ('server', 'sock', 'addr', 'closed', 'connected', 'last_seen', 'pinged', 'outq', 'want_write',
+                 'paused', 'events', 'reader', 'framed', 'binary', 'commands', 'busy', 'streaming', 'handshaking',
+                 'handshake_started', 'handshake_events', 'handshake_step')
+    remote = False  # Connected to this process, unlike users on other workers
+    def __init__(self, server, sock, addr):
+        super().__init__()
+        self.server = server
+        self.sock = sock
+        self.addr = addr
+        self.closed = False
+        # When the connection was opened and last received data (see chat_timers.py)
+        self.connected = self.last_seen = time.monotonic()
+        self.pinged = 0.0
+        self.outq = OutboundQueue(server.queue_limit, server.slow_client_policy)
+        self.want_write = False
+        self.paused = False  # Not read from for a while after a throttled command
+        self.events = selectors.EVENT_READ  # What the selector watches for
+        self.reader = CommandReader()
+        self.framed = False
+        self.binary = None  # BinarySession for clients of the binary protocol
+        # Received commands wait here while an earlier command is still in progress
+        self.commands = deque()
+        self.busy = False
+        # Iterator of encoded chunks being streamed, e.g. an offline message backlog
+        self.streaming = None
+        # TLS: nothing is read or written until the handshake is done. Its next step
+        # waits for handshake_events, or runs in the handshake pool (handshake_step)
+        self.handshaking = False
+        self.handshake_started = False
+        self.handshake_events = selectors.EVENT_READ
+        self.handshake_step = None
+
+    def send(self, text):
+        """
+        Sends a server notice, e.g. "X joins.".
+        """
+        if self.binary is not None:
+            self.server.write(self, self.binary.notice(text))
+        else:
+            self.server.write(self, encode_message(text, self.framed))
+
+    def respond(self, text):
+        """
+        Sends the response to a command. Binary clients get one for every command,
+        the text protocols skip empty responses.
+        """
+        if self.binary is not None:
+            self.server.write(self, self.binary.response(text))
+        elif text:
+            self.server.write(self, encode_message(text, self.framed))
+
+    def deliver(self, shared):
+        """
+        Sends a SharedMessage in this client's protocol.
+        """
+        self.server.write(self, shared.encode_for(self))
+
+    def ping(self):
+        """
+        Sends a heartbeat; framed and binary clients answer it.
+        """
+        try:
+            self.server.write(self, self.binary.ping() if self.binary is not None else PING_FRAME)
+        except ConnectionError:
+            pass  # Already being closed
+
+    def expire(self, text):
+        """
+        Tells the client why and closes its connection, e.g. after a timeout.
+        A peer that does not read any more is not waited for.
+        """
+        if self.closing or self.closed:
+            return
+        try:
+            self.send(text)
+        except ConnectionError:
+            return
+        self.closing = True
+        self.server.flush(self)
+        if self.outq:
+            self.server.pending_close.add(self)
+
+    def throttle(self, scope, wait):
+        """
+        Answers a command refused by a rate limit, then stops reading from the client
+        for a while, so a flood backs up in its own socket buffers.
+        """
+        if self.binary is not None:
+            self.server.write(self, self.binary.throttle(scope, wait))
+        else:
+            self.server.write(self, encode_message(throttle_text(scope, wait), self.framed))
+        self.server.pause(self, wait)
+
+    def goodbye(self, text, wait):
+        """
+        Tells the client the server is shutting down and to reconnect after 'wait' seconds.
+        """
+        if self.binary is not None:
+            self.server.write(self, self.binary.goodbye(text, wait))
+        else:
+            self.server.write(self, encode_message(text, self.framed))
+
+    def enqueue(self, data):
+        self.server.write(self, data)
+
+    def stream(self, chunks):
+        """
+        Sends an iterable of encoded chunks, paced by the client's outbound queue.
+        """
+        self.server.stream(self, chunks)
+
+    def defer(self, future, callback):
+        """
+        Finishes a command when work running elsewhere (e.g. password hashing) is done.
+        Returns the response right away if the future is already complete; otherwise the
+        connection stops running commands until callback(result) has sent its response.
+        """
+        if future.done():
+            return callback(future.result())
+        self.busy = True
+        future.add_done_callback(
+            lambda done: self.server.call_soon_threadsafe(self.server.resume, self, done, callback))
+        return None
+
+
+class EventLoopServer:
+    """
+    Serves every client connection from one selectors-based event loop.
+    'handler(client, command)' runs a command and returns the response text (None if
+    the response was already sent or comes later),
+    'on_disconnect(client)' cleans up shared state after a connection goes away,
+    'on_connect(client)', if set, runs for every accepted connection.
+    With 'tls', an SSLContext, accepted connections are encrypted; 'handshake_pool'
+    (an executor) runs the handshakes, which otherwise run on the loop thread.
+    """
+    def __init__(self, server_sock, handler, on_disconnect, max_clients=0,
+                 queue_limit=DEFAULT_QUEUE_BYTES, slow_client_policy=DEFAULT_POLICY,
+                 coalesce_delay=DEFAULT_COALESCE_DELAY, nodelay=True, sndbuf=0, rcvbuf=0, keepalive=0,
+                 on_connect=None, tls=None, handshake_pool=None):
+        self.server_sock = server_sock
+        self.handler = handler
+        self.on_disconnect = on_disconnect
+        self.on_connect = on_connect
+        self.max_clients = max_clients
+        self.queue_limit = queue_limit
+        self.slow_client_policy = slow_client_policy
+        self.coalesce_delay = coalesce_delay
+        self.socket_options = (nodelay, sndbuf, rcvbuf, keepalive)
+        self.tls = tls
+        self.handshake_pool = handshake_pool
+        self.timers = TimerWheel()
+        # Clients with queued output that is not written yet, mapped to when it is due.
+        # Every entry gets the same delay, so the dict is ordered by due time.
+        self.dirty = {}
+        self.selector = selectors.DefaultSelector()
+        self.clients = {}
+        # Callbacks handed over from other threads, plus a socket pair to wake the loop
+        self.calls = deque()
+        self.calls_lock = threading.Lock()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        # Connections that failed while another client was being served; closed after the event
+        self.pending_close = set()
+        # While frozen no connections are accepted and no commands are read or run
+        self.frozen = False
+        self.draining = False
+        self.stopped = False
+        if max_clients:
+            raise_fd_limit(max_clients)
+
+    def serve_forever(self):
+        """
+        Runs the event loop until interrupted.
+        """
+        self.server_sock.setblocking(False)
+        # Special sockets carry their handler as selector data; clients carry their state
+        self.selector.register(self.server_sock, selectors.EVENT_READ, self.accept)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, self.run_calls)
+        try:
+            while not self.stopped:
+                for key, mask in self.selector.select(self.select_timeout()):
+                    if self.stopped:
+                        break  # Detached; the remaining events belong to connections that are gone
+                    client = key.data
+                    if callable(client):
+                        client(mask)
+                        continue
+                    if client.handshaking:
+                        self.handshake(client)
+                        self.close_pending()
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        self.read(client)
+                    if mask & selectors.EVENT_WRITE and not client.closed:
+                        self.flush(client)
+                    self.close_pending()
+                if self.timers:
+                    self.run_timers()
+                if self.dirty:
+                    self.flush_due()
+        finally:
+            for client in list(self.clients.values()):
+                self.close(client)
+            self.selector.close()
+            self.wake_r.close()
+            self.wake_w.close()
+
+    def select_timeout(self):
+        """
+        Returns how long select() may wait: until the oldest queued output or the
+        next timer is due.
+        """
+        timeout = self.timers.timeout()
+        if self.dirty:
+            due = max(0.0, next(iter(self.dirty.values())) - time.monotonic())
+            timeout = due if timeout is None else min(timeout, due)
+        return timeout
+
+    def call_later(self, delay, callback, *args):
+        """
+        Runs callback(*args) on the loop thread after 'delay' seconds. Returns a
+        Timer whose cancel() stops it. Must be called on the loop thread.
+        """
+        return self.timers.call_later(delay, callback, *args)
+
+    def run_timers(self):
+        """
+        Runs the timers that are due.
+        """
+        for timer in self.timers.advance():
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                log.exception("Timer callback failed")
+        self.close_pending()
+
+    def flush_due(self):
+        """
+        Writes the queued output whose coalescing delay has passed.
+        """
+        now = time.monotonic()
+        dirty = self.dirty
+        while dirty:
+            client, due = next(iter(dirty.items()))
+            if due > now:
+                break
+            self.flush(client)
+        self.close_pending()
+
+    def add_handler(self, sock, handler, events=selectors.EVENT_READ):
+        """
+        Watches an extra socket (e.g. a link to other server processes);
+        handler(mask) runs on the loop thread whenever it is ready.
+        """
+        self.selector.register(sock, events, handler)
+
+    def call_soon_threadsafe(self, func, *args):
+        """
+        Schedules func(*args) to run on the loop thread. Safe to call from any thread.
+        """
+        with self.calls_lock:
+            self.calls.append((func, args))
+            wake = len(self.calls) == 1
+        if wake:
+            try:
+                self.wake_w.send(b"\0")
+            except (BlockingIOError, InterruptedError):
+                pass  # The loop is already being woken up
+
+    def run_calls(self, mask=None):
+        """
+        Runs callbacks scheduled from other threads.
+        """
+        try:
+            while self.wake_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        with self.calls_lock:
+            calls = list(self.calls)
+            self.calls.clear()
+        for func, args in calls:
+            func(*args)
+        self.close_pending()
+
+    def accept(self, mask=None):
+        """
+        Accepts a batch of pending connections from the listening socket.
+        """
+        for _ in range(ACCEPT_BATCH):
+            try:
+                sock, addr = self.server_sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # Out of file descriptors: leave the rest in the backlog for now
+                if e.errno in (errno.EMFILE, errno.ENFILE):
+                    return
+                raise
+            if self.max_clients and len(self.clients) >= self.max_clients:
+                try:
+                    sock.send(b"Error: Server is full")
+                except OSError:
+                    pass
+                sock.close()
+                continue
+            sock.setblocking(False)
+            tune_socket(sock, *self.socket_options)
+            if self.tls is not None:
+                try:
+                    sock = self.tls.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+                except OSError:
+                    sock.close()  # Already gone
+                    continue
+            metrics.connections.inc()
+            metrics.connections_total.inc()
+            client = EventClient(self, sock, addr)
+            client.handshaking = self.tls is not None
+            self.clients[sock.fileno()] = client
+            self.selector.register(sock, selectors.EVENT_READ, client)
+            if self.on_connect is not None:
+                self.on_connect(client)
+
+    def read(self, client):
+        """
+        Reads available data from a client socket and runs every complete command in it.
+        """
+        try:
+            data = client.sock.recv(client.reader.recv_size())
+        except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except OSError:
+            self.close(client)
+            return
+        if not data:
+            self.close(client)  # Client has disconnected
+            return
+        metrics.bytes_in.inc(len(data))
+        client.last_seen = time.monotonic()
+        if client.closing:
+            return
+        try:
+            commands = client.reader.feed(data)
+            if client.reader.framed and not client.framed:
+                # The client asked for the framed or binary protocol; confirm before any response
+                client.framed = True
+                client.binary = client.reader.binary
+                self.write(client, client.reader.hello)
+        except Exception as e:
+            # A protocol error only drops its own connection
+            log.debug(f"Protocol error from {client.addr}: {e}")
+            self.pending_close.add(client)
+            return
+        client.commands.extend(commands)
+        self.run_commands(client)
+        self.read_buffered(client)
+
+    def read_buffered(self, client):
+        """
+        Reads what is left of a TLS record that was only partly read. It is already
+        out of the kernel's buffer, so the selector would never report it.
+        """
+        if self.tls is not None and not (client.closed or client.closing or client.paused or self.frozen) \
+                and client.sock.pending():
+            self.read(client)
+
+    def handshake(self, client):
+        """
+        Runs the next step of a client's TLS handshake. The first step, which answers
+        the client's hello and does the expensive key exchange and signature, runs in
+        the handshake pool if there is one; the rest are cheap.
+        """
+        first = not client.handshake_started
+        client.handshake_started = True
+        if self.handshake_pool is None or not first:
+            self.finish_step(client, handshake_step(client.sock))
+            return
+        # Nothing to watch while the step runs; the pool thread has the socket to itself
+        client.handshake_events = 0
+        self.update_events(client)
+        client.handshake_step = self.handshake_pool.submit(handshake_step, client.sock)
+        client.handshake_step.add_done_callback(
+            lambda step: self.call_soon_threadsafe(self.finish_step, client, step.result()))
+
+    def finish_step(self, client, result):
+        """
+        Continues after a handshake step: waits for the peer, fails the connection,
+        or starts serving it.
+        """
+        client.handshake_step = None
+        if client.closed:
+            return
+        if isinstance(result, Exception):
+            metrics.tls_handshake_failures.inc()
+            log.debug(f"TLS handshake with {client.addr} failed: {result}")
+            self.close(client)
+            return
+        if result:
+            client.handshake_events = result
+            self.update_events(client)
+            return
+        client.handshaking = False
+        metrics.tls_handshakes.inc('resumed' if client.sock.session_reused else 'full')
+        self.update_events(client)
+        if client.outq:
+            self.flush(client)
+        self.read_buffered(client)
+
+    def run_commands(self, client):
+        """
+        Runs a client's queued commands in order until one of them has to wait.
+        """
+        commands = client.commands
+        try:
+            while commands and not client.busy and not client.closing and not self.frozen:
+                command_line = commands.popleft()
+                if not command_line:
+                    continue  # Ignore empty commands
+                response = self.handler(client, command_line)
+                if response is not None:
+                    client.respond(response)
+        except Exception:
+            # A failing command only drops its own connection, never the loop
+            metrics.command_errors.inc()
+            log.exception(f"Command from {client.addr} failed")
+            self.pending_close.add(client)
+            return
+        if client.closing and not client.outq:
+            self.pending_close.add(client)
+
+    def resume(self, client, future, callback):
+        """
+        Completes a deferred command on the loop thread and continues with the next ones.
+        """
+        client.busy = False
+        if client.closed:
+            return
+        try:
+            response = callback(future.result())
+            if response is not None:
+                client.respond(response)
+        except Exception:
+            metrics.command_errors.inc()
+            log.exception(f"Deferred command from {client.addr} failed")
+            self.pending_close.add(client)
+            return
+        self.run_commands(client)
+
+    def stream(self, client, chunks):
+        """
+        Starts writing a long sequence of chunks to a client a few at a time. The
+        client's next command waits until the stream is written, so responses to
+        pipelined commands keep their order.
+        """
+        if client.closed:
+            raise ConnectionError("client connection is closed")
+        client.streaming = iter(chunks)
+        client.busy = True
+        self.pump(client)
+
+    def pump(self, client):
+        """
+        Writes the next chunks of a client's stream. Stops while the client's queue
+        is backed up (flush() resumes it) and yields to other clients after
+        STREAM_BATCHES chunks, so a large stream never monopolizes the loop.
+        """
+        low_water = self.queue_limit // 2 if self.queue_limit else STREAM_LOW_WATER
+        try:
+            for _ in range(STREAM_BATCHES):
+                if client.closed or client.streaming is None:
+                    return
+                if client.outq.pending() > low_water:
+                    return
+                chunk = next(client.streaming, None)
+                if chunk is None:
+                    client.streaming = None
+                    client.busy = False
+                    self.run_commands(client)
+                    return
+                self.write(client, chunk)
+        except Exception as e:
+            log.debug(f"Stream to {client.addr} failed: {e}")
+            client.streaming = None
+            self.pending_close.add(client)
+            return
+        self.call_soon_threadsafe(self.pump, client)
+
+    def write(self, client, data):
+        """
+        Queues data for a client without blocking. The queue is written together with
+        whatever else the client gets in the same batch of work, once the coalescing
+        delay has passed or the queue is large enough; if the kernel does not take it
+        all, the rest is written when the socket becomes writable. A slow client never
+        holds up the caller.
+        """
+        if client.closed:
+            raise ConnectionError("client connection is closed")
+        outq = client.outq
+        if outq:
+            metrics.send_queue_bytes.observe(outq.pending())
+        try:
+            if not outq.push(data):
+                metrics.slow_consumers.inc()
+        except SlowConsumerError:
+            metrics.slow_consumers.inc()
+            outq.clear()
+            self.pending_close.add(client)
+            raise
+        if client.want_write:
+            return  # Waiting for the socket to become writable
+        if not client.framed or outq.pending() >= COALESCE_MAX_BYTES:
+            self.flush(client, resume=False)
+        elif client not in self.dirty:
+            self.dirty[client] = time.monotonic() + self.coalesce_delay
+
+    def flush(self, client, resume=True):
+        """
+        Writes queued output until the queue is empty or the kernel buffer is full.
+        Legacy clients get one write per message. Failed connections are closed after
+        the current event. With 'resume' a paused stream continues once the queue is empty.
+        """
+        self.dirty.pop(client, None)
+        if client.closed or client.handshaking:
+            return
+        outq = client.outq
+        try:
+            while outq:
+                if not write_queued(client.sock, outq, client.framed):
+                    self.want_write_events(client, True)
+                    return  # Kernel buffer is full
+        except (BlockingIOError, InterruptedError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+            self.want_write_events(client, True)
+            return
+        except OSError:
+            self.pending_close.add(client)
+            return
+        if client.closing:
+            self.pending_close.add(client)
+        else:
+            self.want_write_events(client, False)
+            if resume and client.streaming is not None:
+                self.pump(client)
+
+    def want_write_events(self, client, enabled):
+        """
+        Turns writable notifications for a client socket on or off.
+        """
+        if client.want_write == enabled:
+            return
+        client.want_write = enabled
+        self.update_events(client)
+
+    def update_events(self, client):
+        """
+        Watches a client socket for reads unless it is paused, and for writes while
+        output is waiting for the socket.
+        """
+        if client.handshaking:
+            events = client.handshake_events
+        else:
+            reading = not client.paused and not self.frozen
+            events = (selectors.EVENT_READ if reading else 0) | (selectors.EVENT_WRITE if client.want_write else 0)
+        if events == client.events:
+            return
+        if not events:
+            self.selector.unregister(client.sock)
+        elif not client.events:
+            self.selector.register(client.sock, events, client)
+        else:
+            self.selector.modify(client.sock, events, client)
+        client.events = events
+
+    def pause(self, client, seconds):
+        """
+        Stops reading and running commands from a client for a while (at most PAUSE_MAX seconds).
+        """
+        if client.paused or client.closed:
+            return
+        client.paused = True
+        client.busy = True
+        self.update_events(client)
+        self.call_later(min(seconds, PAUSE_MAX), self.unpause, client)
+
+    def unpause(self, client):
+        client.paused = False
+        client.busy = False
+        if client.closed:
+            return
+        self.update_events(client)
+        self.run_commands(client)
+        self.read_buffered(client)
+
+    def freeze(self):
+        """
+        Stops accepting connections and reading or running commands; output keeps
+        being written. Commands already in progress (see defer()) still finish.
+        """
+        self.frozen = True
+        self.selector.unregister(self.server_sock)
+        for client in self.clients.values():
+            self.update_events(client)
+
+    def thaw(self):
+        """
+        Undoes freeze().
+        """
+        self.frozen = False
+        self.selector.register(self.server_sock, selectors.EVENT_READ, self.accept)
+        for client in list(self.clients.values()):
+            self.update_events(client)
+            self.run_commands(client)
+        self.close_pending()
+
+    def drain(self, goodbye, timeout, batch, interval):
+        """
+        Shuts down gracefully: stops accepting and reading, calls goodbye(client) for
+        every connection, then marks 'batch' connections as closing every 'interval'
+        seconds; each one is closed once its output is written. Whatever is still open
+        after 'timeout' seconds is closed as it is, and the loop stops.
+        """
+        if self.draining:
+            return
+        self.draining = True
+        started = time.monotonic()
+        self.freeze()
+        self.server_sock.close()  # Refuse new connections instead of leaving them in the backlog
+        clients = deque(self.clients.values())
+        log.warning(f"Draining {len(clients)} connections.")
+        for client in clients:
+            if client.handshaking or client.closing:
+                continue
+            try:
+                goodbye(client)
+            except ConnectionError:
+                pass  # Dropped as a slow consumer
+        self.drain_step(clients, started, timeout, batch, interval)
+
+    def drain_step(self, clients, started, timeout, batch, interval):
+        elapsed = time.monotonic() - started
+        metrics.drain_seconds.set(elapsed)
+        if elapsed < timeout:
+            for _ in range(min(batch, len(clients))):
+                client = clients.popleft()
+                if client.closed:
+                    continue
+                if client.handshaking:
+                    self.close(client)
+                    continue
+                client.closing = True
+                self.flush(client, resume=False)  # Closes it if nothing is left to write
+            self.close_pending()
+            if self.clients:
+                self.call_later(interval, self.drain_step, clients, started, timeout, batch, interval)
+                return
+        forced = list(self.clients.values())
+        for client in forced:
+            self.close(client)
+        metrics.drain_forced.inc(len(forced))
+        elapsed = time.monotonic() - started
+        metrics.drain_seconds.set(elapsed)
+        log.warning(f"Drain done in {elapsed:.2f} s; {len(forced)} connections closed by the timeout.")
+        self.stopped = True
+
+    def quiescent(self):
+        """
+        Tells whether no client is waiting for a deferred command to finish.
+        Unfinished streams are handed over with the rest of the output.
+        """
+        return not any(client.busy and not client.paused and client.streaming is None
+                       for client in self.clients.values())
+
+    def detach(self):
+        """
+        Stops the loop and returns its clients without closing their sockets or
+        calling on_disconnect(), e.g. after they were handed to another process.
+        """
+        clients = list(self.clients.values())
+        for client in clients:
+            try:
+                self.selector.unregister(client.sock)
+            except (KeyError, ValueError):
+                pass
+        self.clients.clear()
+        self.dirty.clear()
+        self.pending_close.clear()
+        self.stopped = True
+        return clients
+
+    def adopt(self, sock, addr):
+        """
+        Serves a connection that was accepted by another process.
+        """
+        sock.setblocking(False)
+        metrics.connections.inc()
+        client = EventClient(self, sock, addr)
+        self.clients[sock.fileno()] = client
+        self.selector.register(sock, selectors.EVENT_READ, client)
+        if self.on_connect is not None:
+            self.on_connect(client)
+        return client
+
+    def close_pending(self):
+        """
+        Closes connections that were marked as failed during the last event.
+        """
+        while self.pending_close:
+            self.close(self.pending_close.pop())
+
+    def close(self, client):
+        """
+        Closes a client connection and removes it from the loop.
+        """
+        if client.closed:
+            return
+        client.closed = True
+        metrics.connections.dec()
+        self.pending_close.discard(client)
+        self.dirty.pop(client, None)
+        self.clients.pop(client.sock.fileno(), None)
+        try:
+            self.selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        if client.handshake_step is not None:
+            # A pool thread is using the socket; it is closed when the step is done
+            client.handshake_step.add_done_callback(lambda step: client.sock.close())
+        else:
+            client.sock.close()
+        self.on_disconnect(client)
@@ -0,0 +1,341 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Federation of separate chat room servers, e.g. several
+chat_serverV2.py processes on different ports or machines. Every server listens on a
+federation port and keeps one persistent link to each of its peers (a full mesh:
+every server lists the others with --peers, or is listed by them). The links carry
+the same framed messages as the multi-worker mode (see chat_workers.py), and only
+changes: when a link comes up each side announces the users connected to it once,
+after that only logins, logouts, room joins and leaves as they happen. Users of other
+servers appear in the local presence and rooms as PeerUser entries, so "who" lists
+everybody and a direct message to one of them goes straight to the server that holds
+the user. A "send all" or room message goes once to every peer (for rooms, every peer
+with members in the room), which fans it out to its own users. Nothing is passed on,
+so every server only announces its own users and messages.
+A peer that closes its link or stays silent for the peer timeout is gone: its users
+are dropped from the presence and rooms, and a peer that was dialed is dialed again
+with a growing delay until it is back, when the announcements start over.
+Accounts, offline messages and the history stay with each server. The links are not
+authenticated or encrypted, so servers should only peer over trusted networks.
+'''
+
+# Using Python version 3.12.0
+
+import errno
+import selectors
+import socket
+import time
+
+import chat_metrics as metrics
+from chat_logging import log
+from chat_workers import BusLink, listening_socket
+
+# Version of the messages exchanged between servers; peers must use the same
+FEDERATION_VERSION = 1
+# Seconds without any message from a peer before its link is closed; pings are sent
+# three times as often
+PEER_TIMEOUT = 15.0
+# First delay before a lost or refused peer is dialed again, doubled up to the maximum
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX = 10.0
+# Listen backlog of the federation port
+FEDERATION_BACKLOG = 16
+
+
+def parse_address(text, default_host='127.0.0.1'):
+    """
+    Parses "host:port" or just "port". Raises ValueError for anything else.
+    """
+    host, _, port = text.strip().rpartition(':')
+    return host or default_host, int(port)
+
+
+class PeerUser:
+    """
+    Presence and room entry for a user connected to a peer server. Sending to it
+    goes over the link to that server.
+    """
+    remote = True
+    framed = False
+    binary = None
+
+    def __init__(self, user, peer):
+        self.user = user
+        self.peer = peer
+
+    def send(self, text):
+        self.peer.send('unicast', self.user, (text, None, None, None, None))
+
+    def deliver(self, shared):
+        self.peer.send('unicast', self.user, shared.fields())
+
+
+class Peer:
+    """
+    One link to another server and what that server announced over it.
+    """
+    def __init__(self, link, address=None):
+        self.link = link
+        self.address = address  # Where it was dialed; None for links the peer opened
+        self.name = None  # Known once its hello arrives
+        self.users = set()
+        self.rooms = {}  # Room -> the peer's users in it
+        self.last_seen = time.monotonic()
+
+    def send(self, *message):
+        if self.link.closed:
+            raise ConnectionError(f"The link to {self.name} is down")
+        self.link.send(*message)
+        metrics.federation_messages.inc(message[0])
+
+
+class Federation:
+    """
+    This server's side of the federation, running on the event loop. The server
+    calls online/offline/join/leave/broadcast/room for its own users; messages from
+    peers are handed to deliver(user, fields), broadcast(fields) and
+    room_deliver(room, fields), with messages as SharedMessage field tuples.
+    """
+    def __init__(self, name, loop, presence, rooms, deliver, broadcast, room_deliver, listen_address=None,
+                 peers=(), timeout=PEER_TIMEOUT):
+        self.name = name
+        self.loop = loop
+        self.presence = presence
+        self.rooms = rooms
+        self.deliver = deliver
+        self.local_broadcast = broadcast
+        self.room_deliver = room_deliver
+        self.timeout = timeout
+        self.links = {}  # BusLink -> Peer, including links still waiting for their hello
+        self.peers = {}  # Server name -> Peer whose link is up
+        self.dialed = {}  # Dialed address -> name of the server that answered there
+        self.listen_sock = None
+        if listen_address is not None:
+            # Raises OSError if the port is taken, before anything is dialed
+            self.listen_sock = listening_socket(*listen_address, FEDERATION_BACKLOG, False)
+            self.listen_sock.setblocking(False)
+            loop.add_handler(self.listen_sock, self.accept)
+        for address in peers:
+            self.dial(address)
+        if timeout:
+            loop.call_later(timeout / 3, self.tick)
+
+    # Announcements of this server's users
+
+    def publish(self, *message):
+        for peer in list(self.peers.values()):
+            peer.send(*message)
+
+    def online(self, user):
+        self.publish('online', user)
+
+    def offline(self, user):
+        self.publish('offline', user)
+        self.restore(user)
+
+    def join(self, room, user):
+        self.publish('join', room, user)
+
+    def leave(self, room, user):
+        self.publish('leave', room, user)
+
+    def broadcast(self, fields):
+        # One copy per server, however many users it serves
+        self.publish('broadcast', fields)
+
+    def room(self, room, fields):
+        for peer in list(self.peers.values()):
+            if room in peer.rooms:
+                peer.send('room', room, fields)
+
+    # Links
+
+    def accept(self, mask):
+        try:
+            sock, addr = self.listen_sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            log.warning(f"Failed to accept a federation link: {e}")
+            return
+        self.open_link(sock)
+
+    def dial(self, address, delay=RECONNECT_DELAY):
+        """
+        Connects to a peer without blocking the loop; a failure is retried after 'delay'.
+        """
+        name = self.dialed.get(address)
+        if name is not None and name in self.peers:
+            # The peer dialed this server first; check again later in case that link goes
+            self.loop.call_later(RECONNECT_MAX, self.dial, address)
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            error = sock.connect_ex(address)
+        except OSError as e:  # e.g. a host name that does not resolve
+            error = e.errno or errno.EINVAL
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self.redial(address, delay)
+            return
+        self.loop.add_handler(sock, lambda mask: self.connected(sock, address, delay), selectors.EVENT_WRITE)
+
+    def connected(self, sock, address, delay):
+        self.loop.selector.unregister(sock)
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            sock.close()
+            self.redial(address, delay)
+            return
+        self.open_link(sock, address)
+
+    def redial(self, address, delay):
+        self.loop.call_later(delay, self.dial, address, min(delay * 2, RECONNECT_MAX))
+
+    def open_link(self, sock, address=None):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        link = BusLink(sock, self.loop.selector, self.on_message, self.on_close)
+        self.links[link] = Peer(link, address)
+        link.send('hello', self.name, FEDERATION_VERSION)
+
+    def hello(self, peer, name, version):
+        """
+        Puts a link into service once the peer has said who it is.
+        """
+        if peer.address is not None:
+            self.dialed[peer.address] = name
+        if version != FEDERATION_VERSION or name == self.name:
+            log.warning(f"Refusing the federation link to {name}: "
+                        f"{'same server name' if name == self.name else f'version {version}'}")
+            peer.link.close()
+            return
+        existing = self.peers.get(name)
+        if existing is not None:
+            # Both servers dialed each other; both keep the link dialed by the smaller name
+            if (peer.address is not None) != (self.name < name):
+                peer.link.close()
+                return
+            existing.link.close()
+        peer.name = name
+        self.peers[name] = peer
+        metrics.federation_peers.set(len(self.peers))
+        log.warning(f"Federation link to {name} is up.")
+        # Everything the peer needs to know so far; only changes follow
+        users = [(client.user, self.rooms.rooms_of(client.user)) for client in self.presence.recipients()]
+        peer.send('sync', users)
+
+    def on_message(self, link, message):
+        peer = self.links.get(link)
+        if peer is None:
+            return
+        peer.last_seen = time.monotonic()
+        op = message[0]
+        if peer.name is None:
+            if op == 'hello':
+                self.hello(peer, message[1], message[2])
+            else:
+                link.close()
+        elif op == 'sync':
+            for user, joined in message[1]:
+                self.peer_online(peer, user)
+                for room in joined:
+                    self.peer_join(peer, room, user)
+        elif op == 'online':
+            self.peer_online(peer, message[1])
+        elif op == 'offline':
+            self.peer_offline(peer, message[1])
+        elif op == 'join':
+            self.peer_join(peer, message[1], message[2])
+        elif op == 'leave':
+            self.peer_leave(peer, message[1], message[2])
+        elif op == 'unicast':
+            self.deliver(message[1], message[2])
+        elif op == 'broadcast':
+            self.local_broadcast(message[1])
+        elif op == 'room':
+            self.room_deliver(message[1], message[2])
+
+    def on_close(self, link):
+        peer = self.links.pop(link, None)
+        if peer is None:
+            return
+        if peer.name is not None and self.peers.get(peer.name) is peer:
+            del self.peers[peer.name]
+            for user in list(peer.users):
+                self.peer_offline(peer, user)
+            metrics.federation_peers.set(len(self.peers))
+            log.warning(f"Federation link to {peer.name} is down.")
+        if peer.address is not None and self.dialed.get(peer.address) != self.name:
+            self.redial(peer.address, RECONNECT_DELAY)
+
+    def tick(self):
+        """
+        Pings every peer and closes the links of peers that stopped answering.
+        """
+        now = time.monotonic()
+        for peer in list(self.links.values()):
+            if now - peer.last_seen > self.timeout:
+                log.warning(f"Federation peer {peer.name or 'connecting'} timed out.")
+                peer.link.close()
+            else:
+                peer.link.send('ping')
+        self.loop.call_later(self.timeout / 3, self.tick)
+
+    # What peers announce
+
+    def peer_online(self, peer, user):
+        peer.users.add(user)
+        current = self.presence.get(user)
+        # A local session of the same user stays reachable here
+        if current is None or current.remote:
+            self.presence.add(user, PeerUser(user, peer))
+
+    def peer_offline(self, peer, user):
+        peer.users.discard(user)
+        for room in [room for room, users in peer.rooms.items() if user in users]:
+            self.forget_member(peer, room, user)
+        current = self.presence.get(user)
+        if current is not None and current.remote and current.peer is peer:
+            self.rooms.leave_all(user, current)
+            self.presence.remove(user, current)
+            self.restore(user)
+
+    def restore(self, user):
+        """
+        Points a user who just went offline somewhere at another server they are still on.
+        """
+        for peer in self.peers.values():
+            if user in peer.users:
+                entry = PeerUser(user, peer)
+                self.presence.add(user, entry)
+                for room, users in peer.rooms.items():
+                    if user in users:
+                        self.join_room(room, user, entry)
+                return
+
+    def peer_join(self, peer, room, user):
+        peer.rooms.setdefault(room, set()).add(user)
+        current = self.presence.get(user)
+        if current is not None and current.remote and current.peer is peer:
+            self.join_room(room, user, current)
+
+    def peer_leave(self, peer, room, user):
+        self.forget_member(peer, room, user)
+        current = self.presence.get(user)
+        if current is not None and current.remote and current.peer is peer:
+            self.rooms.leave(room, user, current)
+
+    def forget_member(self, peer, room, user):
+        users = peer.rooms.get(room)
+        if users is not None:
+            users.discard(user)
+            if not users:
+                del peer.rooms[room]
+
+    def join_room(self, room, user, entry):
+        try:
+            self.rooms.join(room, user, entry)
+        except ValueError:
+            pass  # The peer enforces its own room limits
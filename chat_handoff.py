@@ -0,0 +1,167 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Zero-downtime restart for the chat room server.
+A running event-loop server listens on a Unix-domain control socket. A new server
+process started with --takeover connects to it, and the old process passes over its
+listening socket and every client connection (SCM_RIGHTS), together with the state
+of each connection: the logged in user, the negotiated protocol, unread commands,
+unsent output and room memberships. The TCP connections themselves never close, so
+clients only notice a short pause. Once the new process has everything, the old one
+closes its stores for the new one to open and exits.
+'''
+
+# Using Python version 3.12.0
+
+import errno
+import marshal
+import os
+import socket
+import struct
+
+from chat_logging import log
+
+# Default path of the control socket, relative to the server's directory
+CONTROL_SOCKET = 'chat_server.sock'
+# Message header: payload length, number of file descriptors that came with it
+HEADER = struct.Struct('!II')
+# Descriptors per message; Linux passes at most 253 in one SCM_RIGHTS message
+FDS_PER_MESSAGE = 250
+# Seconds either side waits for the other during a handoff
+HANDOFF_TIMEOUT = 10.0
+# Seconds the old process waits for commands in progress (e.g. logins) to finish
+QUIESCE_TIMEOUT = 5.0
+
+
+class HandoffError(ConnectionError):
+    """
+    Raised when the other process breaks off a handoff.
+    """
+
+
+def send_message(sock, message, fds=()):
+    """
+    Sends a tuple of builtin types, with open file descriptors attached.
+    """
+    data = marshal.dumps(message)
+    packet = HEADER.pack(len(data), len(fds)) + data
+    sent = socket.send_fds(sock, [packet], list(fds)) if fds else sock.send(packet)
+    if sent < len(packet):
+        sock.sendall(packet[sent:])
+
+
+def recv_exactly(sock, count):
+    data = b""
+    while len(data) < count:
+        chunk = sock.recv(count - len(data))
+        if not chunk:
+            raise HandoffError("the other process closed the control connection")
+        data += chunk
+    return data
+
+
+def recv_message(sock):
+    """
+    Receives one message. Returns (message, list of file descriptors).
+    """
+    header, fds, flags, _ = socket.recv_fds(sock, HEADER.size, FDS_PER_MESSAGE)
+    if not header:
+        raise HandoffError("the other process closed the control connection")
+    if flags & getattr(socket, 'MSG_CTRUNC', 0):
+        for fd in fds:
+            os.close(fd)
+        raise HandoffError("file descriptors were lost in transit")
+    header += recv_exactly(sock, HEADER.size - len(header))
+    length, count = HEADER.unpack(header)
+    if count != len(fds):
+        for fd in fds:
+            os.close(fd)
+        raise HandoffError(f"expected {count} file descriptors, got {len(fds)}")
+    return marshal.loads(recv_exactly(sock, length)), fds
+
+
+def expect(sock, kind):
+    message, fds = recv_message(sock)
+    if message[0] != kind:
+        for fd in fds:
+            os.close(fd)
+        raise HandoffError(f"expected '{kind}', got '{message[0]}'")
+    return message, fds
+
+
+def listen_control(path):
+    """
+    Opens the control socket of a running server. A socket file left behind by a
+    server that is gone is replaced; one that still answers belongs to a live server.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+    except OSError as e:
+        if e.errno != errno.EADDRINUSE:
+            raise
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)  # Stale
+            sock.bind(path)
+        else:
+            sock.close()
+            raise OSError(errno.EADDRINUSE, f"a server is already listening on {path}")
+        finally:
+            probe.close()
+    sock.listen(1)
+    return sock
+
+
+def hand_over(conn, listener, clients, shared, release):
+    """
+    Old process side: passes the listening socket and 'clients', a list of
+    (socket, state) pairs, to the process on 'conn', then calls release() so the
+    new process can open the stores. Raises HandoffError, with nothing handed over,
+    if the new process fails before it confirmed having everything.
+    """
+    conn.settimeout(HANDOFF_TIMEOUT)
+    send_message(conn, ('listener',), [listener.fileno()])
+    for start in range(0, len(clients), FDS_PER_MESSAGE):
+        batch = clients[start:start + FDS_PER_MESSAGE]
+        send_message(conn, ('clients', [state for _, state in batch]), [sock.fileno() for sock, _ in batch])
+    send_message(conn, ('done', shared))
+    expect(conn, 'received')
+    # From here on the new process owns the connections
+    try:
+        release()
+    finally:
+        try:
+            send_message(conn, ('released',))
+        except OSError as e:
+            log.warning(f"Could not tell the new process that the stores are free: {e}")
+
+
+def take_over(path):
+    """
+    New process side: asks the server on the control socket at 'path' to hand over.
+    Returns (listening socket, [(socket, state)], shared state) once the old process
+    has released its stores.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(HANDOFF_TIMEOUT)
+    try:
+        conn.connect(path)
+        send_message(conn, ('takeover', os.getpid()))
+        _, fds = expect(conn, 'listener')
+        listener = socket.socket(fileno=fds[0])
+        clients = []
+        while True:
+            message, fds = recv_message(conn)
+            if message[0] == 'done':
+                shared = message[1]
+                break
+            clients += [(socket.socket(fileno=fd), state) for fd, state in zip(fds, message[1])]
+        send_message(conn, ('received',))
+        # Wait for the old process to close the stores (and for it to go away)
+        expect(conn, 'released')
+    finally:
+        conn.close()
+    return listener, clients, shared
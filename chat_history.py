@@ -0,0 +1,444 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Persistent message history for the chat room server.
+"send all" messages and direct messages are appended to a log split into segment
+files. Every segment is created at its full size and memory-mapped, so appending
+a record is a copy into the map and replaying reads only the pages it needs.
+Each segment keeps a sparse index of (sequence number, timestamp, offset) for every
+INDEX_EVERY records, which lets "history" start near the end of the log and walk
+back one block at a time; a small bit mask of the users in each block lets it skip
+blocks without a matching direct message. A background thread forces appended records to disk in
+groups and drops segments that are past the retention time or the size limit.
+'''
+
+# Using Python version 3.12.0
+
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+
+from chat_logging import log
+from chat_userstore import SYNC_POLICIES
+
+# Record header: crc32 of the rest of the record, sequence number, timestamp, kind,
+# sender, target and body lengths; followed by sender, target and body.
+# Segments are created full of zeros, and sequence number 0 marks the end of the data.
+RECORD = struct.Struct('!IQdBBBH')
+# Sparse index entries as stored in a segment's .idx file: sequence number, timestamp,
+# offset, and the mask of the block's contents (see block_mask())
+INDEX_ENTRY = struct.Struct('!QdIQ')
+
+ALL = 1  # "send all" message; no target
+MSG = 2  # Direct message to 'target'
+KINDS = {'all': ALL, 'msg': MSG}
+
+# Bit of a block mask set when the block has a "send all" message; the other bits
+# stand for the names in its direct messages
+ALL_BIT = 1 << 63
+
+# Bytes per segment file
+SEGMENT_SIZE = 16 * 1024 * 1024
+# Records per sparse index entry
+INDEX_EVERY = 64
+# Seconds a message is kept (30 days)
+RETENTION = 30 * 24 * 3600
+# Total bytes of all segments; the oldest segments are dropped beyond this
+MAX_BYTES = 1024 * 1024 * 1024
+
+# Messages replayed by "history" when no count is given, and at most
+DEFAULT_COUNT = 20
+MAX_COUNT = 500
+
+# Seconds between background syncs for the 'batch' policy
+SYNC_INTERVAL = 0.05
+# Seconds between retention passes
+MAINTENANCE_INTERVAL = 60.0
+
+
+class Segment:
+    """
+    One segment file, mapped into memory for its whole size. Records are only ever
+    appended, by one thread at a time; readers only look below 'size', which is
+    advanced after a record is complete.
+    """
+    def __init__(self, path, first_seq, capacity=SEGMENT_SIZE):
+        self.path = path
+        self.first_seq = first_seq
+        self.last_seq = first_seq - 1
+        self.last_stamp = 0.0
+        self.size = 0
+        self.seqs = array('Q')
+        self.stamps = array('d')
+        self.offsets = array('I')
+        self.masks = array('Q')
+        self.count = 0  # Records since the last index entry was added
+        self.dirty = False
+        self.sealed = False
+        self.indexed = False  # Whether the .idx file is up to date
+        created = not os.path.exists(path)
+        with open(path, 'a+b') as f:
+            if f.seek(0, os.SEEK_END) < capacity:
+                f.truncate(capacity)  # Sparse: the zeros take no disk space until written
+            self.map = mmap.mmap(f.fileno(), 0)
+        self.capacity = len(self.map)
+        if not created and not self.load_index():
+            self.scan()
+
+    def index_path(self):
+        return os.path.splitext(self.path)[0] + '.idx'
+
+    def load_index(self):
+        """
+        Reads the sparse index written when the segment was sealed. Returns False if
+        there is none, then the segment is scanned instead.
+        """
+        try:
+            with open(self.index_path(), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        if len(data) < INDEX_ENTRY.size or len(data) % INDEX_ENTRY.size:
+            return False
+        entries = [INDEX_ENTRY.unpack_from(data, pos) for pos in range(0, len(data), INDEX_ENTRY.size)]
+        # The last entry is the end of the data rather than a record
+        self.last_seq, self.last_stamp, self.size, _ = entries.pop()
+        for seq, stamp, offset, mask in entries:
+            self.add_index(seq, stamp, offset, mask)
+        self.sealed = self.indexed = True
+        return True
+
+    def scan(self):
+        """
+        Rebuilds the index by reading every record. A damaged record ends the data.
+        """
+        data = self.map
+        pos = 0
+        seq = self.first_seq - 1
+        while pos + RECORD.size <= self.capacity:
+            crc, rec_seq, stamp, kind, sender_len, target_len, body_len = RECORD.unpack_from(data, pos)
+            end = pos + RECORD.size + sender_len + target_len + body_len
+            if rec_seq == 0:
+                break
+            if rec_seq <= seq or end > self.capacity or zlib.crc32(data[pos + 4:end]) != crc:
+                log.warning(f"History {self.path}: ignoring {self.capacity - pos} bytes after a damaged record")
+                data[pos:pos + RECORD.size] = bytes(RECORD.size)
+                break
+            names = pos + RECORD.size
+            self.note(rec_seq, stamp, pos, record_mask(kind, data[names:names + sender_len],
+                                                      data[names + sender_len:names + sender_len + target_len]))
+            seq = rec_seq
+            pos = end
+        self.size = pos
+
+    def add_index(self, seq, stamp, offset, mask=0):
+        self.seqs.append(seq)
+        self.stamps.append(stamp)
+        self.offsets.append(offset)
+        self.masks.append(mask)
+
+    def note(self, seq, stamp, offset, mask):
+        """
+        Accounts for a record at 'offset', indexing every INDEX_EVERY-th one.
+        """
+        if self.count == 0:
+            self.add_index(seq, stamp, offset)
+        self.masks[-1] |= mask
+        self.count = (self.count + 1) % INDEX_EVERY
+        self.last_seq = seq
+        self.last_stamp = stamp
+
+    def append(self, record, seq, stamp, mask):
+        """
+        Copies an encoded record into the map. Returns False if it does not fit.
+        """
+        end = self.size + len(record)
+        if end > self.capacity:
+            return False
+        self.map[self.size:end] = record
+        self.note(seq, stamp, self.size, mask)
+        self.size = end  # Readers see the record from here on
+        self.dirty = True
+        return True
+
+    def seal(self):
+        self.sealed = True
+
+    def write_index(self):
+        """
+        Saves the sparse index of a sealed segment, so opening it needs no scan.
+        """
+        entries = [INDEX_ENTRY.pack(seq, stamp, offset, mask)
+                   for seq, stamp, offset, mask in zip(self.seqs, self.stamps, self.offsets, self.masks)]
+        entries.append(INDEX_ENTRY.pack(self.last_seq, self.last_stamp, self.size, 0))
+        tmp = self.index_path() + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(b"".join(entries))
+        os.replace(tmp, self.index_path())
+        self.indexed = True
+
+    def sync(self):
+        """
+        Forces the appended records to disk.
+        """
+        if self.dirty:
+            self.dirty = False
+            self.map.flush()
+
+    def blocks(self):
+        """
+        Yields (first timestamp, mask, start, end) of the index blocks, newest first.
+        Only records that were complete when the walk started are included.
+        """
+        end = self.size
+        offsets = self.offsets
+        for i in range(len(offsets) - 1, -1, -1):
+            start = offsets[i]
+            if start < end:
+                yield self.stamps[i], self.masks[i], start, end
+            end = start
+
+    def records(self, start, end):
+        """
+        Yields (seq, stamp, kind, sender, target, body) for the records in [start, end),
+        with the names and body still as bytes.
+        """
+        data = self.map
+        header = RECORD.size
+        pos = start
+        while pos < end:
+            _, seq, stamp, kind, sender_len, target_len, body_len = RECORD.unpack_from(data, pos)
+            names = pos + header
+            body = names + sender_len + target_len
+            yield (seq, stamp, kind, data[names:names + sender_len], data[names + sender_len:body],
+                   data[body:body + body_len])
+            pos = body + body_len
+
+    def close(self):
+        self.map.close()
+
+    def remove(self):
+        for path in (self.path, self.index_path()):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def name_mask(name):
+    """
+    Two bits out of 63 that stand for a user name (as bytes) in block masks.
+    """
+    crc = zlib.crc32(name)
+    return (1 << (crc % 63)) | (1 << ((crc >> 8) % 63))
+
+
+def record_mask(kind, sender, target):
+    if kind == ALL:
+        return ALL_BIT
+    return name_mask(sender) | name_mask(target)
+
+
+def encode_record(seq, stamp, kind, sender, target, body):
+    names = sender + target + body
+    rest = RECORD.pack(0, seq, stamp, kind, len(sender), len(target), len(body))[4:] + names
+    return struct.pack('!I', zlib.crc32(rest)) + rest
+
+
+def render(stamp, kind, sender, target, body):
+    """
+    Formats one replayed message, e.g. "[14:02:11] alice: hi" or
+    "[14:02:11] alice (to bob): hi".
+    """
+    clock = time.strftime('%H:%M:%S', time.localtime(stamp))
+    if kind == MSG:
+        return f"[{clock}] {sender} (to {target}): {body}"
+    return f"[{clock}] {sender}: {body}"
+
+
+class History:
+    """
+    The message log in 'directory'. append() may be called from any thread;
+    recent() reads concurrently with appends.
+    """
+    def __init__(self, directory, sync='batch', retention=RETENTION, max_bytes=MAX_BYTES,
+                 segment_size=SEGMENT_SIZE):
+        if sync not in SYNC_POLICIES:
+            raise ValueError(f"unknown sync policy: {sync}")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.sync = sync
+        self.retention = retention
+        self.max_bytes = max_bytes
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.segments = []
+        for name in sorted(os.listdir(directory)):
+            if name.startswith('segment-') and name.endswith('.log'):
+                first_seq = int(name[len('segment-'):-len('.log')])
+                self.segments.append(Segment(os.path.join(directory, name), first_seq, segment_size))
+        # Only the newest segment takes appends; the others are complete
+        for segment in self.segments[:-1]:
+            segment.seal()
+        self.next_seq = self.segments[-1].last_seq + 1 if self.segments else 1
+        if not self.segments or self.segments[-1].sealed:
+            self.segments.append(self.new_segment())
+        # Dropped segments stay mapped until the next pass, so a replay still reading one can finish
+        self.retired = []
+        self.expire()
+        self.stopped = threading.Event()
+        self.maintainer = threading.Thread(target=self.maintain_loop, name='history', daemon=True)
+        self.maintainer.start()
+
+    def new_segment(self):
+        path = os.path.join(self.directory, f"segment-{self.next_seq:016d}.log")
+        return Segment(path, self.next_seq, self.segment_size)
+
+    def size(self):
+        return sum(segment.size for segment in self.segments)
+
+    def append(self, kind, sender, target, body, now=None):
+        """
+        Logs one message; 'kind' is 'all' or 'msg'. Returns its sequence number.
+        """
+        stamp = time.time() if now is None else now
+        code = KINDS[kind]
+        sender = sender.encode('utf-8')[:255]
+        target = (target or "").encode('utf-8')[:255]
+        body = body.encode('utf-8')[:65535]
+        with self.lock:
+            seq = self.next_seq
+            record = encode_record(seq, stamp, code, sender, target, body)
+            mask = record_mask(code, sender, target)
+            active = self.segments[-1]
+            if not active.append(record, seq, stamp, mask):
+                # Full: later records go to a new segment; the old one is indexed in the background
+                active.seal()
+                active = self.new_segment()
+                self.segments.append(active)
+                active.append(record, seq, stamp, mask)
+            self.next_seq = seq + 1
+            if self.sync == 'always':
+                active.sync()
+        return seq
+
+    def recent(self, count=DEFAULT_COUNT, user=None, peer=None, now=None):
+        """
+        Returns up to 'count' of the newest messages, oldest first, as rendered text.
+        Without 'peer' these are "send all" messages; with it, the direct messages
+        between 'user' and 'peer'. Walks the index blocks backwards from the end, so
+        only the newest part of the log is read, and skips blocks whose mask shows
+        they cannot hold a match.
+        """
+        if count <= 0:
+            return []
+        cutoff = (time.time() if now is None else now) - self.retention if self.retention else 0.0
+        if peer is None:
+            need = ALL_BIT
+
+            def wanted(kind, sender, target):
+                return kind == ALL
+        else:
+            me = user.encode('utf-8')
+            them = peer.encode('utf-8')
+            need = name_mask(me) | name_mask(them)
+
+            def wanted(kind, sender, target):
+                return kind == MSG and ((sender == me and target == them) or (sender == them and target == me))
+        with self.lock:
+            segments = list(self.segments)
+        found = []  # Lists of matches per block, newest block first
+        total = 0
+        for segment in reversed(segments):
+            if segment.last_stamp < cutoff:
+                break
+            for first_stamp, mask, start, end in segment.blocks():
+                if mask & need != need:
+                    if first_stamp < cutoff:
+                        break
+                    continue
+                block = [(stamp, kind, sender, target, body)
+                         for _, stamp, kind, sender, target, body in segment.records(start, end)
+                         if stamp >= cutoff and wanted(kind, sender, target)]
+                found.append(block)
+                total += len(block)
+                if total >= count or first_stamp < cutoff:
+                    break
+            if total >= count:
+                break
+        messages = [message for block in reversed(found) for message in block][-count:]
+        return [render(stamp, kind, sender.decode('utf-8', errors='replace'),
+                       target.decode('utf-8', errors='replace'), body.decode('utf-8', errors='replace'))
+                for stamp, kind, sender, target, body in messages]
+
+    def expire(self, now=None):
+        """
+        Drops whole segments that are past the retention time or beyond the size limit,
+        oldest first. The segment taking appends is always kept.
+        """
+        cutoff = (time.time() if now is None else now) - self.retention if self.retention else None
+        with self.lock:
+            total = sum(segment.capacity for segment in self.segments)
+            while len(self.segments) > 1:
+                oldest = self.segments[0]
+                if not ((cutoff is not None and oldest.last_stamp < cutoff)
+                        or (self.max_bytes and total > self.max_bytes)):
+                    break
+                self.segments.pop(0)
+                total -= oldest.capacity
+                self.retired.append(oldest)
+                oldest.remove()
+                log.info(f"History: dropped {os.path.basename(oldest.path)}")
+
+    def maintain_loop(self):
+        """
+        Background thread: group syncs, indexes of sealed segments and retention.
+        """
+        interval = SYNC_INTERVAL if self.sync == 'batch' else MAINTENANCE_INTERVAL
+        next_maintenance = time.monotonic() + MAINTENANCE_INTERVAL
+        while not self.stopped.wait(interval):
+            try:
+                if self.sync == 'batch':
+                    self.flush()
+                if time.monotonic() >= next_maintenance:
+                    next_maintenance = time.monotonic() + MAINTENANCE_INTERVAL
+                    self.maintain()
+            except (OSError, ValueError) as e:
+                log.error(f"History maintenance failed: {e}")
+
+    def maintain(self):
+        with self.lock:
+            retired, self.retired = self.retired, []
+            sealed = [segment for segment in self.segments if segment.sealed and not segment.indexed]
+        for segment in retired:
+            segment.close()
+        for segment in sealed:
+            segment.sync()
+            segment.write_index()
+        self.expire()
+
+    def flush(self):
+        """
+        Forces appended messages to disk. A sealed segment is synced once more after
+        its last append.
+        """
+        with self.lock:
+            segments = [segment for segment in self.segments if segment.dirty]
+        for segment in segments:
+            segment.sync()
+
+    def close(self):
+        self.stopped.set()
+        self.maintainer.join()
+        with self.lock:
+            segments = self.segments + self.retired
+            self.segments = []
+            self.retired = []
+        for segment in segments:
+            if segment.dirty:
+                segment.sync()
+            segment.close()
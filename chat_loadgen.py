@@ -0,0 +1,346 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Headless load generator for the chat room server.
+Simulates N users over the framed protocol (newuser + login), drives a configurable
+mix of unicast sends, "send all" broadcasts and "who" requests at a fixed open-loop
+rate, and reports throughput plus p50/p99/p999 end-to-end latency. Every choice
+(targets, operation mix, send times) comes from a seeded random generator, so two
+runs with the same options issue the same workload. Results can be written as JSON.
+
+Usage: python chat_loadgen.py --users 200 --rate 2000 --duration 10 --mix unicast=8,broadcast=1,who=1
+'''
+
+# Using Python version 3.12.0
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import time
+from array import array
+
+from chat_protocol import HELLO, FrameDecoder, encode_frame
+
+# Marker that identifies load generator messages inside chat text
+MARKER = "lg"
+DEFAULT_MIX = "unicast=8,broadcast=1,who=1"
+OPERATIONS = ('unicast', 'broadcast', 'who')
+PERCENTILES = (('p50', 0.50), ('p90', 0.90), ('p99', 0.99), ('p999', 0.999))
+
+
+def parse_mix(text):
+    """
+    Parses "unicast=8,broadcast=1,who=1" into a dict of relative weights.
+    """
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"unknown operation in mix: {name}")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("operation mix is empty")
+    return mix
+
+
+def percentiles(samples):
+    """
+    Returns a dict with count, mean, max and the latency percentiles in milliseconds.
+    """
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+    n = len(ordered)
+    result = {'count': n, 'mean_ms': sum(ordered) / n / 1e6, 'max_ms': ordered[-1] / 1e6}
+    for name, q in PERCENTILES:
+        result[name + '_ms'] = ordered[min(n - 1, int(q * n))] / 1e6
+    return result
+
+
+class SimUser:
+    """
+    One simulated user: a framed connection plus its latency bookkeeping.
+    """
+    def __init__(self, name, password, stats):
+        self.name = name
+        self.password = password
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+        self.decoder = FrameDecoder()
+        self.responses = asyncio.Queue()
+        self.pending_who = []  # send times of "who" requests awaiting a reply
+        self.logged_in = False
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(HELLO)
+        reply = await self.reader.readexactly(len(HELLO))
+        if reply != HELLO:
+            raise RuntimeError("server does not support the framed protocol")
+        asyncio.get_running_loop().create_task(self.listen())
+
+    async def request(self, command):
+        """
+        Sends a command during setup and waits for its response.
+        """
+        self.writer.write(encode_frame(command.encode('utf-8')))
+        return await self.responses.get()
+
+    async def login(self, create):
+        if create:
+            reply = await self.request(f"newuser {self.name} {self.password}")
+            if reply not in ("New user account created.", "Denied. User account already exists."):
+                raise RuntimeError(f"newuser {self.name}: {reply}")
+        reply = await self.request(f"login {self.name} {self.password}")
+        if reply != "login confirmed":
+            raise RuntimeError(f"login {self.name}: {reply}")
+        self.logged_in = True
+
+    def send(self, command):
+        self.writer.write(encode_frame(command.encode('utf-8')))
+
+    async def listen(self):
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                now = time.monotonic_ns()
+                for frame in self.decoder.feed(data):
+                    self.handle(frame.decode('utf-8', errors='replace'), now)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    def handle(self, text, now):
+        stats = self.stats
+        sender, sep, body = text.partition(': ')
+        if sep and body.startswith(MARKER + ' '):
+            # "<sender>: lg <kind> <send time>"
+            parts = body.split(' ', 3)
+            if len(parts) >= 3:
+                kind = 'broadcast' if parts[1] == 'b' else 'unicast'
+                stats.latency[kind].append(now - int(parts[2]))
+                stats.delivered[kind] += 1
+            return
+        if text.endswith(" joins.") or text.endswith(" left."):
+            return  # Presence notifications of other simulated users
+        if not self.logged_in:
+            self.responses.put_nowait(text)
+            return
+        if text.startswith("Error") or text.startswith("Denied"):
+            stats.errors += 1
+            if stats.errors <= 5:
+                print(f"{self.name}: {text}", file=sys.stderr)
+            return
+        if self.pending_who:
+            stats.latency['who'].append(now - self.pending_who.pop(0))
+            stats.delivered['who'] += 1
+
+
+class Stats:
+    def __init__(self):
+        self.latency = {op: array('q') for op in OPERATIONS}
+        self.delivered = {op: 0 for op in OPERATIONS}
+        self.issued = {op: 0 for op in OPERATIONS}
+        self.errors = 0
+        self.late = 0  # operations issued behind schedule because the generator lagged
+
+
+async def run_users(opts, names, seed, ready, start):
+    """
+    Runs one share of the simulated users inside one asyncio loop.
+    Reports on 'ready' once logged in and waits for the shared start time.
+    """
+    stats = Stats()
+    users = [SimUser(name, opts.password, stats) for name in names]
+    # Connect and log in with bounded concurrency so the server's accept queue is not flooded
+    gate = asyncio.Semaphore(opts.connect_concurrency)
+
+    async def setup(user):
+        async with gate:
+            await user.connect(opts.host, opts.port)
+            await user.login(opts.create)
+    await asyncio.gather(*(setup(user) for user in users))
+    ready.put(len(users))
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, start.wait)
+
+    rng = random.Random(seed)
+    mix = parse_mix(opts.mix)
+    ops = list(mix)
+    weights = [mix[op] for op in ops]
+    all_names = opts.all_names
+    padding = 'x' * max(0, opts.size)
+    rate = opts.rate / opts.procs
+    # Every process starts the same seeded schedule at the same moment
+    await asyncio.sleep(max(0.0, start.start_at.value - time.time()))
+    begin = time.monotonic()
+    next_at = 0.0
+    while next_at < opts.duration:
+        delay = begin + next_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        elif delay < -0.01:
+            stats.late += 1
+        user = users[rng.randrange(len(users))]
+        op = rng.choices(ops, weights)[0]
+        now = time.monotonic_ns()
+        if op == 'unicast':
+            target = all_names[rng.randrange(len(all_names))]
+            user.send(f"send {target} {MARKER} u {now} {padding}")
+        elif op == 'broadcast':
+            user.send(f"send all {MARKER} b {now} {padding}")
+        else:
+            user.pending_who.append(now)
+            user.send("who")
+        stats.issued[op] += 1
+        # Poisson arrivals at the requested rate
+        next_at += rng.expovariate(rate)
+    # Give in-flight deliveries time to arrive
+    await asyncio.sleep(opts.drain)
+    for user in users:
+        user.writer.close()
+    return stats
+
+
+class StartSignal:
+    """
+    Shared start time for all load generator processes.
+    """
+    def __init__(self):
+        self.event = multiprocessing.Event()
+        self.start_at = multiprocessing.Value('d', 0.0)
+
+    def wait(self):
+        self.event.wait()
+
+    def fire(self, delay):
+        self.start_at.value = time.time() + delay
+        self.event.set()
+
+
+def worker(opts, names, seed, ready, start, results):
+    try:
+        stats = asyncio.run(run_users(opts, names, seed, ready, start))
+    except Exception as e:
+        ready.put(0)
+        results.put({'error': f"{type(e).__name__}: {e}"})
+        return
+    results.put({
+        'latency': {op: stats.latency[op].tobytes() for op in OPERATIONS},
+        'delivered': stats.delivered,
+        'issued': stats.issued,
+        'errors': stats.errors,
+        'late': stats.late,
+    })
+
+
+def merge(parts, opts, setup_seconds):
+    """
+    Combines the per-process results into one report.
+    """
+    report = {
+        'config': {key: value for key, value in vars(opts).items() if key != 'all_names'},
+        'host': {'platform': platform.platform(), 'python': platform.python_version(),
+                 'cpus': os.cpu_count()},
+        'setup_seconds': setup_seconds,
+        'operations': {},
+        'errors': sum(part['errors'] for part in parts),
+        'late_operations': sum(part['late'] for part in parts),
+    }
+    total_delivered = 0
+    for op in OPERATIONS:
+        samples = array('q')
+        for part in parts:
+            samples.frombytes(part['latency'][op])
+        issued = sum(part['issued'][op] for part in parts)
+        delivered = sum(part['delivered'][op] for part in parts)
+        total_delivered += delivered
+        entry = {'issued': issued, 'delivered': delivered,
+                 'issued_per_sec': issued / opts.duration,
+                 'delivered_per_sec': delivered / opts.duration}
+        entry['latency'] = percentiles(samples)
+        report['operations'][op] = entry
+    report['delivered_per_sec'] = total_delivered / opts.duration
+    return report
+
+
+def print_report(report):
+    print(f"setup {report['setup_seconds']:.2f}s, errors {report['errors']}, "
+          f"late operations {report['late_operations']}")
+    print(f"{'op':>10} {'issued/s':>10} {'delivered/s':>12} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} {'max ms':>8}")
+    for op, entry in report['operations'].items():
+        lat = entry['latency']
+        if not lat['count']:
+            continue
+        print(f"{op:>10} {entry['issued_per_sec']:>10.0f} {entry['delivered_per_sec']:>12.0f} "
+              f"{lat['p50_ms']:>8.2f} {lat['p99_ms']:>8.2f} {lat['p999_ms']:>8.2f} {lat['max_ms']:>8.2f}")
+    print(f"total delivered/s: {report['delivered_per_sec']:.0f}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Load generator for the chat room server.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=19953)
+    parser.add_argument('--users', type=int, default=100, help="number of simulated users")
+    parser.add_argument('--prefix', default='load', help="user name prefix")
+    parser.add_argument('--password', default='load1')
+    parser.add_argument('--no-create', dest='create', action='store_false',
+                        help="log in to existing accounts instead of creating them")
+    parser.add_argument('--rate', type=float, default=1000.0, help="operations per second, all users together")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of load")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="relative weights of unicast, broadcast and who")
+    parser.add_argument('--size', type=int, default=32, help="padding characters per message")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--procs', type=int, default=1, help="load generator processes")
+    parser.add_argument('--connect-concurrency', type=int, default=64)
+    parser.add_argument('--drain', type=float, default=1.0, help="seconds to wait for late deliveries")
+    parser.add_argument('--label', default='', help="free-form label stored with the results, e.g. the server mode")
+    parser.add_argument('--output', help="write the JSON report to this file")
+    opts = parser.parse_args(argv)
+    parse_mix(opts.mix)
+    return opts
+
+
+def main(argv=None):
+    opts = parse_args(argv)
+    opts.all_names = [f"{opts.prefix}{i:05d}" for i in range(opts.users)]
+    groups = [group for group in (opts.all_names[i::opts.procs] for i in range(opts.procs)) if group]
+    ready = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    start = StartSignal()
+    procs = [multiprocessing.Process(target=worker,
+                                     args=(opts, group, opts.seed * 1000 + index, ready, start, results))
+             for index, group in enumerate(groups)]
+    started = time.time()
+    for proc in procs:
+        proc.start()
+    # Wait until every simulated user is logged in before the timed phase
+    for _ in procs:
+        ready.get()
+    setup_seconds = time.time() - started
+    start.fire(0.2)
+    parts = [results.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+    failed = [part['error'] for part in parts if 'error' in part]
+    if failed:
+        print(f"Load generator failed: {failed[0]}")
+        return 1
+    report = merge(parts, opts, setup_seconds)
+    print_report(report)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Asynchronous, level-controlled logging for the chat room server.
+Request-path code only puts a record on an in-memory queue; a background listener
+thread formats it and writes it to the console, so a slow terminal or pipe never
+holds up a client.
+'''
+
+# Using Python version 3.12.0
+
+import logging
+import logging.handlers
+import queue
+import sys
+
+LOG_LEVELS = ('debug', 'info', 'warning', 'error')
+DEFAULT_LEVEL = 'info'
+
+# Records queued beyond this are dropped instead of blocking the caller
+LOG_QUEUE_SIZE = 10000
+
+log = logging.getLogger('chat')
+listener = None
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that discards records when the queue is full.
+    """
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def setup_logging(level=DEFAULT_LEVEL, stream=None):
+    """
+    Routes the 'chat' logger through a queue to a console writer thread.
+    Messages are printed as they are, without a prefix, like the server always did.
+    """
+    global listener
+    stop_logging()
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    console = logging.StreamHandler(stream or sys.stdout)
+    console.setFormatter(logging.Formatter('%(message)s'))
+    log.handlers[:] = [DroppingQueueHandler(records)]
+    log.setLevel(level.upper())
+    log.propagate = False
+    listener = logging.handlers.QueueListener(records, console)
+    listener.start()
+    return log
+
+
+def stop_logging():
+    """
+    Writes out every queued record and stops the writer thread.
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
@@ -0,0 +1,331 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Durable offline mailboxes for the chat room server.
+Messages for users who are not online are appended to a small number of shard log
+files (a user always maps to the same shard) and indexed in memory by user. When the
+user logs in the messages are read back, a delivery record is appended, and the
+server sends them in batches. Messages dropped for the per-user limit or the
+retention time get a record too, so they stay dropped after a restart. Appends are
+fsynced in groups by a background thread, which also enforces the retention time
+and compacts shards that are mostly delivered.
+'''
+
+# Using Python version 3.12.0
+
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+from chat_logging import log
+from chat_userstore import SYNC_POLICIES
+
+# Record header: type, text length, timestamp, user name length; followed by user and text
+RECORD = struct.Struct('!BIdH')
+MESSAGE = 1
+DELIVERED = 2  # Every earlier message of the user was delivered
+DROPPED = 3  # The text is a count N: the user's N oldest messages were dropped
+
+DEFAULT_SHARDS = 16
+# Messages kept per user; the oldest are dropped beyond this
+MAX_MESSAGES = 1000
+# Seconds a message is kept before it expires (7 days)
+RETENTION = 7 * 24 * 3600
+# Total bytes of all shard files; new messages are refused beyond this
+MAX_BYTES = 256 * 1024 * 1024
+
+# Seconds between background fsyncs for the 'batch' policy
+SYNC_INTERVAL = 0.05
+# Seconds between retention and compaction passes
+MAINTENANCE_INTERVAL = 60.0
+# A shard is rewritten when it has at least this many dead bytes and more dead than live bytes
+COMPACT_MIN_BYTES = 1024 * 1024
+
+
+class Shard:
+    """
+    One append-only log file plus the index of the undelivered messages in it.
+    'index' maps user -> deque of (text offset, text length, timestamp).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = {}
+        self.live = 0  # Bytes of records that are still undelivered
+        self.dirty = False
+        self.load()
+        self.file = open(path, 'a+b')
+        self.size = self.file.tell()
+
+    def load(self):
+        """
+        Rebuilds the index by replaying the log. A torn record at the end is cut off.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        pos = 0
+        while pos + RECORD.size <= len(data):
+            kind, text_len, stamp, user_len = RECORD.unpack_from(data, pos)
+            end = pos + RECORD.size + user_len + text_len
+            if end > len(data) or kind not in (MESSAGE, DELIVERED, DROPPED):
+                break
+            try:
+                user = data[pos + RECORD.size:pos + RECORD.size + user_len].decode('utf-8')
+            except UnicodeDecodeError:
+                break
+            if kind == MESSAGE:
+                self.index.setdefault(user, deque()).append((end - text_len, text_len, stamp))
+                self.live += end - pos
+            elif kind == DROPPED:
+                try:
+                    count = int(data[end - text_len:end])
+                except ValueError:
+                    break
+                self.discard(user, count)
+            else:
+                self.forget(user)
+            pos = end
+        if pos < len(data):
+            log.warning(f"Mailbox {self.path}: dropping {len(data) - pos} bytes of a damaged record")
+            with open(self.path, 'r+b') as f:
+                f.truncate(pos)
+
+    def forget(self, user):
+        """
+        Drops a user's index entries. Must be called with the lock held (or while loading).
+        """
+        entries = self.index.pop(user, None)
+        if entries:
+            user_len = len(user.encode('utf-8'))
+            self.live -= sum(RECORD.size + user_len + size for _, size, _ in entries)
+
+    def discard(self, user, count):
+        """
+        Drops a user's 'count' oldest index entries. Must be called with the lock held
+        (or while loading).
+        """
+        entries = self.index.get(user)
+        if not entries:
+            return
+        overhead = RECORD.size + len(user.encode('utf-8'))
+        for _ in range(min(count, len(entries))):
+            self.live -= overhead + entries.popleft()[1]
+        if not entries:
+            del self.index[user]
+
+    def drop(self, user, count):
+        """
+        Drops a user's 'count' oldest messages and records that in the log.
+        Must be called with the lock held.
+        """
+        self.discard(user, count)
+        self.append(DROPPED, user, str(count), time.time())
+
+    def append(self, kind, user, text, stamp):
+        """
+        Writes one record and returns the offset of its text. Must be called with the lock held.
+        """
+        user_bytes = user.encode('utf-8')
+        text_bytes = text.encode('utf-8')
+        self.file.write(RECORD.pack(kind, len(text_bytes), stamp, len(user_bytes)) + user_bytes + text_bytes)
+        offset = self.size + RECORD.size + len(user_bytes)
+        self.size += RECORD.size + len(user_bytes) + len(text_bytes)
+        self.dirty = True
+        return offset, len(text_bytes), RECORD.size + len(user_bytes) + len(text_bytes)
+
+    def read(self, entries):
+        """
+        Reads the texts of index entries back from the log. Must be called with the lock held.
+        """
+        self.file.flush()
+        fd = self.file.fileno()
+        return [os.pread(fd, size, offset).decode('utf-8', errors='replace') for offset, size, _ in entries]
+
+    def sync(self):
+        with self.lock:
+            if not self.dirty or self.file.closed:
+                return
+            self.file.flush()
+            self.dirty = False
+            fd = os.dup(self.file.fileno())
+        # fsync outside the lock so appends keep going while the disk works
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def compact(self):
+        """
+        Rewrites the log with only the undelivered messages, in their original order.
+        """
+        with self.lock:
+            self.file.flush()
+            entries = sorted((offset, size, stamp, user)
+                             for user, items in self.index.items() for offset, size, stamp in items)
+            tmp = self.path + '.tmp'
+            index = {}
+            pos = 0
+            fd = self.file.fileno()
+            with open(tmp, 'wb') as out:
+                for offset, size, stamp, user in entries:
+                    user_bytes = user.encode('utf-8')
+                    out.write(RECORD.pack(MESSAGE, size, stamp, len(user_bytes)) + user_bytes)
+                    out.write(os.pread(fd, size, offset))
+                    pos += RECORD.size + len(user_bytes)
+                    index.setdefault(user, deque()).append((pos, size, stamp))
+                    pos += size
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp, self.path)
+            self.file.close()
+            self.file = open(self.path, 'a+b')
+            self.index = index
+            self.size = self.live = pos
+            self.dirty = False
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+
+class Mailbox:
+    """
+    Offline messages of every user, spread over 'shards' log files in 'directory'.
+    Thread-safe; each shard has its own lock.
+    """
+    def __init__(self, directory, shards=DEFAULT_SHARDS, sync='batch', max_messages=MAX_MESSAGES,
+                 retention=RETENTION, max_bytes=MAX_BYTES):
+        if sync not in SYNC_POLICIES:
+            raise ValueError(f"unknown sync policy: {sync}")
+        os.makedirs(directory, exist_ok=True)
+        self.sync = sync
+        self.max_messages = max_messages
+        self.retention = retention
+        self.max_bytes = max_bytes
+        self.shards = [Shard(os.path.join(directory, f"shard-{i:03d}.log")) for i in range(shards)]
+        self.expire()
+        self.stopped = threading.Event()
+        self.maintainer = threading.Thread(target=self.maintain_loop, name='mailbox', daemon=True)
+        self.maintainer.start()
+
+    def shard(self, user):
+        # crc32 is stable across runs, unlike hash() of a str
+        return self.shards[zlib.crc32(user.encode('utf-8')) % len(self.shards)]
+
+    def size(self):
+        return sum(shard.size for shard in self.shards)
+
+    def has(self, user):
+        """
+        Tells whether a user has undelivered messages. Does not touch the disk.
+        """
+        return user in self.shard(user).index
+
+    def count(self, user):
+        entries = self.shard(user).index.get(user)
+        return len(entries) if entries else 0
+
+    def store(self, user, text, now=None):
+        """
+        Appends a message for an offline user. Returns False if the mailbox store is full.
+        """
+        if self.max_bytes and self.size() >= self.max_bytes:
+            return False
+        stamp = time.time() if now is None else now
+        shard = self.shard(user)
+        with shard.lock:
+            offset, size, record_size = shard.append(MESSAGE, user, text, stamp)
+            entries = shard.index.setdefault(user, deque())
+            entries.append((offset, size, stamp))
+            shard.live += record_size
+            # Keep only the newest messages of a user
+            if self.max_messages and len(entries) > self.max_messages:
+                shard.drop(user, len(entries) - self.max_messages)
+            if self.sync == 'always':
+                shard.file.flush()
+                os.fsync(shard.file.fileno())
+                shard.dirty = False
+        return True
+
+    def take(self, user, now=None):
+        """
+        Removes and returns a user's undelivered messages, oldest first.
+        Expired messages are skipped.
+        """
+        shard = self.shard(user)
+        with shard.lock:
+            entries = shard.index.get(user)
+            if not entries:
+                return []
+            if self.retention:
+                cutoff = (time.time() if now is None else now) - self.retention
+                entries = [entry for entry in entries if entry[2] >= cutoff]
+            texts = shard.read(entries)
+            shard.forget(user)
+            shard.append(DELIVERED, user, "", time.time())
+        return texts
+
+    def expire(self, now=None):
+        """
+        Drops messages older than the retention time, and the oldest messages of users
+        who have more than max_messages (e.g. after the limit was lowered).
+        The bytes are reclaimed by the next compaction.
+        """
+        if not self.retention and not self.max_messages:
+            return
+        cutoff = (time.time() if now is None else now) - self.retention if self.retention else None
+        for shard in self.shards:
+            with shard.lock:
+                for user in list(shard.index):
+                    entries = shard.index[user]
+                    count = 0
+                    if cutoff is not None:
+                        while count < len(entries) and entries[count][2] < cutoff:
+                            count += 1
+                    if self.max_messages:
+                        count = max(count, len(entries) - self.max_messages)
+                    if count:
+                        shard.drop(user, count)
+
+    def maintain_loop(self):
+        """
+        Background thread: group fsyncs, retention and compaction.
+        """
+        interval = SYNC_INTERVAL if self.sync == 'batch' else MAINTENANCE_INTERVAL
+        next_maintenance = time.monotonic() + MAINTENANCE_INTERVAL
+        while not self.stopped.wait(interval):
+            if self.sync == 'batch':
+                self.flush()
+            if time.monotonic() >= next_maintenance:
+                next_maintenance = time.monotonic() + MAINTENANCE_INTERVAL
+                try:
+                    self.expire()
+                    self.compact()
+                except OSError as e:
+                    log.error(f"Mailbox maintenance failed: {e}")
+
+    def compact(self, force=False):
+        for shard in self.shards:
+            dead = shard.size - shard.live
+            if force or (dead >= COMPACT_MIN_BYTES and dead > shard.live):
+                shard.compact()
+
+    def flush(self):
+        """
+        Forces appended messages to disk.
+        """
+        for shard in self.shards:
+            shard.sync()
+
+    def close(self):
+        self.stopped.set()
+        self.maintainer.join()
+        for shard in self.shards:
+            shard.close()
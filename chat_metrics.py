@@ -0,0 +1,312 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Low-overhead metrics for the chat room server.
+Counters, gauges and histograms are plain in-process objects updated on the hot path
+with one uncontended lock at most. An optional admin HTTP endpoint serves them in the
+Prometheus text format, rendered only when somebody scrapes it, and lets settings
+registered with register_settings() be read and changed at runtime.
+'''
+
+# Using Python version 3.12.0
+
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# Histogram buckets in seconds, from 10 microseconds to 10 seconds
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                   0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Buckets for sizes (bytes, recipients)
+SIZE_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+class Registry:
+    """
+    Keeps every metric in registration order and renders the exposition text.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Runtime settings served by the admin endpoint: path -> object with settings() and configure(**values)
+SETTINGS = {}
+
+
+def register_settings(path, target):
+    """
+    Publishes an object's settings on the admin endpoint: GET path shows them and
+    POST path?name=value changes them.
+    """
+    SETTINGS[path] = target
+
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Monotonically increasing count.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [f"{self.name} {format_value(self.value)}"]
+
+
+class LabeledCounter:
+    """
+    Counter split by the value of one label, e.g. the command name.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, label, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, label_value, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def get(self, label_value):
+        return self.values.get(label_value, 0)
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [f'{self.name}{{{self.label}="{value}"}} {format_value(count)}' for value, count in items]
+
+
+class Gauge:
+    """
+    Value that goes up and down. With 'function' the value is read at scrape time.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, function=None, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.value = 0
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+    def samples(self):
+        return [f"{self.name} {format_value(self.get())}"]
+
+
+class Histogram:
+    """
+    Distribution of observed values over fixed buckets.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last slot is +Inf
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """
+        Context manager that observes the elapsed time of a block.
+        """
+        return Timer(self)
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+        lines = []
+        cumulative = 0
+        for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket
+            lines.append(f'{self.name}_bucket{{le="{format_value(bound)}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {format_value(total)}")
+        lines.append(f"{self.name}_count {count}")
+        return lines
+
+
+class Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class TimedLock:
+    """
+    Drop-in for threading.Lock that records how long every acquire had to wait.
+    """
+    __slots__ = ('lock', 'histogram')
+
+    def __init__(self, histogram):
+        self.lock = threading.Lock()
+        self.histogram = histogram
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.histogram.observe(time.perf_counter() - start)
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+        return False
+
+
+# Server metrics
+commands = LabeledCounter('chat_commands_total', "Commands processed, by command.", 'command')
+bytes_in = Counter('chat_bytes_received_total', "Bytes received from clients.")
+bytes_out = Counter('chat_bytes_sent_total', "Bytes written to client sockets.")
+connections = Gauge('chat_connections', "Open client connections.")
+connections_total = Counter('chat_connections_accepted_total', "Client connections accepted.")
+online_users = Gauge('chat_online_users', "Logged in users, including users on other workers.")
+send_queue_bytes = Histogram('chat_send_queue_bytes', "Bytes already queued for a client when a message is added.",
+                             buckets=SIZE_BUCKETS)
+queued_bytes = Gauge('chat_send_queue_pending_bytes', "Bytes queued for all logged in clients of this process.")
+slow_consumers = Counter('chat_slow_consumer_events_total', "Messages dropped or clients disconnected for falling behind.")
+lock_wait = Histogram('chat_lock_wait_seconds', "Time spent waiting for shared server locks.")
+broadcast_seconds = Histogram('chat_broadcast_fanout_seconds', "Time to queue one broadcast for every recipient.")
+broadcast_recipients = Histogram('chat_broadcast_recipients', "Recipients per broadcast.", buckets=SIZE_BUCKETS)
+auth_seconds = Histogram('chat_auth_seconds', "Time from login request to verified password.")
+send_syscalls = Counter('chat_send_syscalls_total', "send()/sendmsg() calls on client sockets.")
+messages_written = Counter('chat_messages_written_total', "Queued messages completely written to client sockets.")
+syscalls_per_message = Gauge('chat_send_syscalls_per_message',
+                             "Write system calls per delivered message since start; below 1 when writes are coalesced.",
+                             function=lambda: send_syscalls.value / messages_written.value if messages_written.value else 0)
+throttled = LabeledCounter('chat_throttled_commands_total', "Commands refused by a rate limit, by limit.", 'scope')
+command_errors = Counter('chat_command_errors_total', "Commands that failed with an unexpected exception.")
+tls_handshakes = LabeledCounter('chat_tls_handshakes_total', "Completed TLS handshakes, by kind (full or resumed).",
+                                'kind')
+tls_handshake_failures = Counter('chat_tls_handshake_failures_total', "TLS handshakes that failed or were abandoned.")
+federation_peers = Gauge('chat_federation_peers', "Federation peers with a working link.")
+federation_messages = LabeledCounter('chat_federation_messages_sent_total', "Messages sent to federation peers, by kind.",
+                                     'kind')
+drain_seconds = Gauge('chat_drain_seconds', "Seconds the shutdown drain has taken so far, or took once it is done.")
+drain_forced = Counter('chat_drain_forced_closes_total',
+                       "Connections the drain timeout closed before their output was written.")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves GET /metrics from the admin endpoint, plus GET and POST for the
+    registered settings.
+    """
+    registry = REGISTRY
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path in SETTINGS:
+            self.send_settings(SETTINGS[path])
+            return
+        if path not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        self.send_text(self.registry.render(), 'text/plain; version=0.0.4; charset=utf-8')
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        target = SETTINGS.get(url.path)
+        if target is None:
+            self.send_error(404)
+            return
+        try:
+            target.configure(**dict(parse_qsl(url.query)))
+        except (TypeError, ValueError) as e:
+            self.send_error(400, str(e))
+            return
+        self.send_settings(target)
+
+    def send_settings(self, target):
+        self.send_text("".join(f"{name} {value}\n" for name, value in target.settings().items()))
+
+    def send_text(self, text, content_type='text/plain; charset=utf-8'):
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes are not worth a log line each
+
+
+def start_metrics_server(host, port, registry=REGISTRY):
+    """
+    Starts the admin HTTP endpoint in a daemon thread and returns the server object.
+    """
+    handler = type('Handler', (MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,269 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Bounded per-connection outbound queues for the chat server.
+Messages for a client are queued here and written by the server's I/O layer, so a
+slow reader only ever delays its own queue, never the sender or other recipients.
+Queued messages of framed connections are written together: one sendmsg() call
+hands the kernel every pending message, instead of one send() per message.
+A broadcast queues the same bytes object for every recipient; the kernel is given
+those bytes directly, and only a message that was partially written is resumed
+through a memoryview of its rest, so no recipient ever gets a copy of its own. Legacy
+connections keep one write per message, since their peers read one message per recv().
+TLS connections cannot write vectors; their pending messages are joined into one
+buffer, which OpenSSL encrypts into as few records as possible.
+'''
+
+# Using Python version 3.12.0
+
+import os
+import socket
+import ssl
+from collections import deque
+from itertools import islice
+
+import chat_metrics as metrics
+
+# What to do when a client's queue is full:
+#   disconnect  - close the slow client's connection
+#   drop-new    - discard the message that did not fit
+#   drop-oldest - discard queued messages that were not started yet until it fits
+POLICIES = ('disconnect', 'drop-new', 'drop-oldest')
+
+# Default number of queued bytes a client may fall behind by
+DEFAULT_QUEUE_BYTES = 256 * 1024
+DEFAULT_POLICY = 'disconnect'
+
+# Seconds a queued message may wait for more messages to the same client, so they
+# leave in one system call; 0 writes at the end of the current batch of work
+DEFAULT_COALESCE_DELAY = 0.001
+# Queued bytes that are written right away without waiting for the delay
+COALESCE_MAX_BYTES = 64 * 1024
+
+# Largest number of buffers passed to one sendmsg() call
+try:
+    IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+# sendmsg() is not available on Windows
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+# Largest buffer of joined messages passed to one TLS write
+TLS_WRITE_BYTES = 256 * 1024
+
+
+class SlowConsumerError(ConnectionError):
+    """
+    Raised when a client's queue is full and the policy is to disconnect it.
+    """
+
+
+class OutboundQueue:
+    """
+    FIFO of encoded messages waiting to be written to one client socket.
+    'offset' counts the bytes of the first message that were already written.
+    Not thread-safe by itself; the owning connection serializes access.
+    """
+    def __init__(self, max_bytes=DEFAULT_QUEUE_BYTES, policy=DEFAULT_POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown slow client policy: {policy}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.items = deque()
+        self.nbytes = 0
+        self.offset = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def pending(self):
+        """
+        Returns the number of bytes still waiting to be written.
+        """
+        return self.nbytes - self.offset
+
+    def push(self, data):
+        """
+        Queues encoded bytes. Returns False if the message was dropped by the policy,
+        raises SlowConsumerError if the client should be disconnected instead.
+        """
+        if self.max_bytes and self.pending() + len(data) > self.max_bytes:
+            if self.policy == 'disconnect':
+                raise SlowConsumerError("client outbound queue is full")
+            if self.policy == 'drop-new':
+                self.dropped += 1
+                return False
+            # drop-oldest: never drop the message that is partially written
+            keep = 1 if self.offset else 0
+            while len(self.items) > keep and self.pending() + len(data) > self.max_bytes:
+                old = self.items[keep]
+                del self.items[keep]
+                self.nbytes -= len(old)
+                self.dropped += 1
+            if self.pending() + len(data) > self.max_bytes:
+                self.dropped += 1
+                return False
+        self.items.append(data)
+        self.nbytes += len(data)
+        return True
+
+    def peek(self):
+        """
+        Returns the unwritten part of the first message: the message itself, or a view
+        of its rest once part of it was written.
+        """
+        if self.offset:
+            return memoryview(self.items[0])[self.offset:]
+        return self.items[0]
+
+    def consume(self, count):
+        """
+        Marks 'count' bytes as written, releasing fully written messages.
+        Returns the number of messages released.
+        """
+        items = self.items
+        released = 0
+        while count and items:
+            remaining = len(items[0]) - self.offset
+            if count < remaining:
+                self.offset += count
+                break
+            count -= remaining
+            self.nbytes -= len(items.popleft())
+            self.offset = 0
+            released += 1
+        return released
+
+    def views(self, limit=IOV_MAX):
+        """
+        Returns the unwritten parts of up to 'limit' queued messages, ready for sendmsg().
+        """
+        items = self.items
+        if len(items) == 1 or limit == 1 or not HAVE_SENDMSG:
+            return [self.peek()]
+        views = list(islice(items, limit))
+        if self.offset:
+            views[0] = self.peek()
+        return views
+
+    def take_all(self):
+        """
+        Removes and returns every queued message, the first one trimmed to its unwritten part.
+        """
+        items = list(self.items)
+        if items and self.offset:
+            items[0] = items[0][self.offset:]
+        self.clear()
+        return items
+
+    def extend(self, items):
+        """
+        Queues messages without applying the limit, e.g. output handed over by another process.
+        """
+        for data in items:
+            self.items.append(data)
+            self.nbytes += len(data)
+
+    def clear(self):
+        self.items.clear()
+        self.nbytes = 0
+        self.offset = 0
+
+
+def write_queued(sock, outq, vectored=True):
+    """
+    Writes as much of a queue as one system call takes to a non-blocking socket,
+    or only the first message without 'vectored'. Returns False if the kernel did
+    not take everything it was offered, i.e. the socket is not writable any more.
+    BlockingIOError passes through.
+    """
+    views = outq.views(IOV_MAX if vectored else 1)
+    if len(views) == 1:
+        sent = sock.send(views[0])
+    elif isinstance(sock, ssl.SSLSocket):
+        # A write that has to be retried gets the same data again, plus whatever was queued since
+        views = [join_views(views, TLS_WRITE_BYTES)]
+        sent = sock.send(views[0])
+    else:
+        sent = sock.sendmsg(views)
+    released = outq.consume(sent)
+    count_write(sent, released)
+    return sent == sum(len(view) for view in views)
+
+
+def join_views(views, limit):
+    """
+    Joins the first buffers, as many as it takes to reach 'limit' bytes.
+    """
+    total = 0
+    for count, view in enumerate(views):
+        total += len(view)
+        if total >= limit:
+            return b"".join(views[:count + 1])
+    return b"".join(views)
+
+
+def write_all(sock, chunks, vectored=True):
+    """
+    Writes a list of messages to a blocking socket, as many per system call as
+    IOV_MAX allows, or one by one without 'vectored'.
+    """
+    if not vectored or not HAVE_SENDMSG:
+        for chunk in chunks:
+            sock.sendall(chunk)
+            count_write(len(chunk), 1)
+        return
+    if isinstance(sock, ssl.SSLSocket) or not isinstance(sock, socket.socket):
+        # TLS (an SSLSocket or chat_tls.SharedTLSSocket) has no vectored write
+        data = b"".join(chunks)
+        sock.sendall(data)
+        count_write(len(data), len(chunks))
+        return
+    views = list(chunks)
+    start = 0
+    while start < len(views):
+        batch = views[start:start + IOV_MAX]
+        sent = written = sock.sendmsg(batch)
+        released = 0
+        # Skip what was written; a partially written message is retried from its rest
+        for view in batch:
+            if written < len(view):
+                views[start + released] = memoryview(view)[written:]
+                break
+            written -= len(view)
+            released += 1
+        count_write(sent, released)
+        start += released
+
+
+def count_write(sent, messages):
+    metrics.send_syscalls.inc()
+    metrics.bytes_out.inc(sent)
+    if messages:
+        metrics.messages_written.inc(messages)
+
+
+def tune_socket(sock, nodelay=True, sndbuf=0, rcvbuf=0, keepalive=0):
+    """
+    Applies the connection options of a client socket. With TCP_NODELAY small
+    messages are not held back by Nagle's algorithm; coalescing is done by the
+    server instead, where it knows when a batch of work is complete.
+    Buffer sizes of 0 keep the system defaults. With 'keepalive' seconds the kernel
+    probes quiet connections, which finds vanished peers that cannot answer
+    application heartbeats (legacy clients).
+    """
+    try:
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if nodelay else 0)
+            if keepalive:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                if hasattr(socket, 'TCP_KEEPIDLE'):  # Linux; elsewhere the system interval applies
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(keepalive)))
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(keepalive) // 3))
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+        if sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    except OSError:
+        pass  # The peer may already be gone
@@ -0,0 +1,133 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Tracks which users are online for the chat room server.
+One insertion-ordered dict keeps the login order with O(1) add and remove. Readers
+such as "who" and broadcasts work from an immutable snapshot that is rebuilt only
+after the membership changes, so they never hold the lock while iterating.
+'''
+
+# Using Python version 3.12.0
+
+import chat_metrics as metrics
+
+# Number of names per page for "who <page>"
+WHO_PAGE_SIZE = 100
+# Number of distinct prefix filters cached per membership snapshot
+PREFIX_CACHE_SIZE = 64
+
+
+class Snapshot:
+    """
+    Immutable view of the online users at one point in time.
+    'clients' only holds connections of this process; users served by other
+    server processes are listed but reached through their own routing.
+    """
+    __slots__ = ('users', 'clients', 'rendered', 'prefixes')
+
+    def __init__(self, clients):
+        self.users = tuple(clients)
+        self.clients = tuple(client for client in clients.values() if not client.remote)
+        self.rendered = None
+        self.prefixes = {}
+
+    def render(self):
+        """
+        Returns the full "who" listing, joined once per snapshot.
+        """
+        if self.rendered is None:
+            self.rendered = ", ".join(self.users)
+        return self.rendered
+
+    def matching(self, prefix):
+        """
+        Returns the users whose name starts with prefix, in login order.
+        """
+        users = self.prefixes.get(prefix)
+        if users is None:
+            users = tuple(user for user in self.users if user.startswith(prefix))
+            if len(self.prefixes) < PREFIX_CACHE_SIZE:
+                self.prefixes[prefix] = users
+        return users
+
+
+class Presence:
+    """
+    Online users in login order, mapped to their client connections.
+    """
+    def __init__(self):
+        self.lock = metrics.TimedLock(metrics.lock_wait)
+        self.clients = {}
+        self.snap = None  # Invalidated on every membership change
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __contains__(self, user):
+        return user in self.clients
+
+    def add(self, user, client):
+        """
+        Marks a user online. A user who logs in again keeps their original position.
+        """
+        with self.lock:
+            self.clients[user] = client
+            self.snap = None
+
+    def remove(self, user, client=None):
+        """
+        Marks a user offline. If client is given, the user is only removed while
+        still bound to that connection, so a stale disconnect cannot log out a newer session.
+        Returns True if the user was removed.
+        """
+        with self.lock:
+            current = self.clients.get(user)
+            if current is None or (client is not None and current is not client):
+                return False
+            del self.clients[user]
+            self.snap = None
+            return True
+
+    def get(self, user):
+        """
+        Returns the connection of an online user, or None.
+        """
+        return self.clients.get(user)
+
+    def snapshot(self):
+        """
+        Returns the current Snapshot, building it if the membership changed.
+        """
+        snap = self.snap
+        if snap is None:
+            with self.lock:
+                snap = self.snap
+                if snap is None:
+                    snap = self.snap = Snapshot(self.clients)
+        return snap
+
+    def recipients(self):
+        """
+        Returns a tuple of every online client connection in this process.
+        """
+        return self.snapshot().clients
+
+    def who(self, prefix=None, page=None, page_size=WHO_PAGE_SIZE):
+        """
+        Renders the "who" listing, optionally filtered by a name prefix and cut into pages
+        (numbered from 1). Returns an empty string when nothing matches.
+        """
+        return render_who(self.snapshot(), prefix, page, page_size)
+
+
+def render_who(snap, prefix=None, page=None, page_size=WHO_PAGE_SIZE):
+    """
+    Renders a "who" listing from a Snapshot. Shared by the global and per-room listings.
+    """
+    if not prefix and page is None:
+        return snap.render()
+    users = snap.matching(prefix) if prefix else snap.users
+    if page is not None:
+        start = (page - 1) * page_size
+        users = users[start:start + page_size]
+    return ", ".join(users)
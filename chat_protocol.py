@@ -0,0 +1,294 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Wire protocol helpers shared by the chat server and client.
+Legacy connections treat every recv() as one command or message. Framed connections
+prefix every message with a 4-byte big-endian length, so pipelined commands, partial
+reads and coalesced writes are all decoded correctly. Binary connections use the
+compact encoding in chat_binary.py.
+'''
+
+# Using Python version 3.12.0
+
+import socket
+import struct
+
+from chat_binary import (HELLO_BINARY, HELLO_BINARY_ZLIB, OP_NOTICE, OP_PONG, USER_IDS, BinarySession,
+                         decode_command, encode_event, frame_strings)
+from chat_binary import FrameDecoder as BinaryFrameDecoder
+
+# Sent by a framed client right after connecting and echoed back by a framed server.
+# Legacy commands are plain text and never start with a NUL byte.
+HELLO = b"\x00CHATLP1"
+# Every hello a server understands; all of them have the same length
+HELLOS = (HELLO, HELLO_BINARY, HELLO_BINARY_ZLIB)
+
+# Length prefix in front of every frame
+HEADER = struct.Struct('!I')
+
+# Heartbeat payloads of the framed protocol. The server sends PING to a quiet
+# connection and the client answers with PONG, which is not a command.
+# No command or message starts with a NUL byte.
+PING = b"\x00ping"
+PONG = b"\x00pong"
+
+# Largest frame accepted from the network
+MAX_FRAME = 64 * 1024
+
+# recv() sizes: legacy peers expect one command per recv, framed peers can batch
+LEGACY_RECV_SIZE = 1024
+FRAMED_RECV_SIZE = 65536
+
+# Consumed bytes at the front of a decode buffer are only discarded past this size,
+# so draining a large backlog does not shift the buffer once per frame
+COMPACT_THRESHOLD = 64 * 1024
+
+
+class FrameError(ValueError):
+    """
+    Raised when a peer sends a frame that violates the framing protocol.
+    """
+
+
+def encode_frame(payload):
+    """
+    Returns the payload bytes with their length prefix.
+    """
+    return HEADER.pack(len(payload)) + payload
+
+
+PING_FRAME = encode_frame(PING)
+PONG_FRAME = encode_frame(PONG)
+
+
+def encode_message(text, framed):
+    """
+    Encodes a text message for a connection using the legacy or the framed protocol.
+    """
+    data = text.encode('utf-8')
+    if framed:
+        return encode_frame(data)
+    return data
+
+
+class SharedMessage:
+    """
+    A message sent to many clients. It is encoded at most once per protocol and
+    the same bytes object is queued for every recipient, so a broadcast to any
+    number of clients holds one copy of each encoding; partial writes resume
+    through a memoryview of it (see chat_outbound.py), never a sliced copy.
+    Chat messages from a user also carry their kind ('msg', 'all' or 'room'), the
+    sender and the bare text, which the binary protocol sends without the text
+    decoration; server notices only have 'text'.
+    """
+    __slots__ = ('text', 'kind', 'sender', 'body', 'room', 'raw', 'framed', 'event', 'introduced',
+                 'sender_id')
+
+    def __init__(self, text, kind=None, sender=None, body=None, room=None):
+        self.text = text
+        self.kind = kind
+        self.sender = sender
+        self.body = body
+        self.room = room
+        self.raw = None
+        self.framed = None
+        self.event = None
+        self.introduced = None  # The DEFINE frame of the sender followed by event
+        self.sender_id = None
+
+    def fields(self):
+        """
+        Returns the message as a tuple of builtin types, e.g. to pass it to another process.
+        """
+        return (self.text, self.kind, self.sender, self.body, self.room)
+
+    def encode_for(self, client):
+        """
+        Returns the bytes to queue for one client, whatever protocol it speaks.
+        """
+        session = client.binary
+        if session is None:
+            return self.encoded(client.framed)
+        if self.event is None:
+            if self.kind is None:
+                self.event = frame_strings(OP_NOTICE, self.text)
+            else:
+                self.sender_id = USER_IDS.intern(self.sender)
+                self.event = encode_event(self.kind, self.sender_id, self.body, self.room)
+        if self.kind is None or self.sender_id in session.defined:
+            return self.event
+        # Every binary recipient that does not know the sender yet gets the same bytes
+        session.defined.add(self.sender_id)
+        if self.introduced is None:
+            self.introduced = USER_IDS.define(self.sender_id) + self.event
+        return self.introduced
+
+    def encoded(self, framed):
+        """
+        Returns the encoded bytes for a legacy or a framed connection.
+        """
+        if self.raw is None:
+            self.raw = self.text.encode('utf-8')
+        if not framed:
+            return self.raw
+        if self.framed is None:
+            self.framed = encode_frame(self.raw)
+        return self.framed
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for length-prefixed frames.
+    Bytes are appended to one buffer and consumed through a read offset, so every
+    byte is looked at once no matter how the stream was split into reads.
+    """
+    def __init__(self, max_frame=MAX_FRAME):
+        self.max_frame = max_frame
+        self.buf = bytearray()
+        self.pos = 0
+
+    def feed(self, data):
+        """
+        Adds received bytes and returns the list of complete frame payloads.
+        """
+        buf = self.buf
+        buf += data
+        frames = []
+        pos = self.pos
+        end = len(buf)
+        while end - pos >= HEADER.size:
+            (length,) = HEADER.unpack_from(buf, pos)
+            if length > self.max_frame:
+                raise FrameError(f"frame of {length} bytes exceeds limit of {self.max_frame}")
+            start = pos + HEADER.size
+            if end - start < length:
+                break  # Partial frame; wait for more data
+            frames.append(bytes(buf[start:start + length]))
+            pos = start + length
+        # Drop consumed bytes, cheaply when everything was used and lazily otherwise
+        if pos == end:
+            buf.clear()
+            pos = 0
+        elif pos > COMPACT_THRESHOLD and pos * 2 > end:
+            del buf[:pos]
+            pos = 0
+        self.pos = pos
+        return frames
+
+    def buffered(self):
+        """
+        Returns the number of received bytes not yet returned as frames.
+        """
+        return len(self.buf) - self.pos
+
+
+class CommandReader:
+    """
+    Server-side reader that detects the protocol from the first bytes of a connection
+    and then turns received data into commands: command lines for the text protocols,
+    (command, arguments) pairs or command lines for the binary protocol.
+    """
+    def __init__(self):
+        self.framed = None  # None until the first bytes decide the protocol
+        self.hello = None  # The hello the client sent, echoed back by the server
+        self.binary = None  # BinarySession once the client chose the binary protocol
+        self.pending = b""
+        self.decoder = None
+
+    def state(self):
+        """
+        Returns what a new process needs to go on reading the connection (see restore()):
+        the protocol decision, the hello and the received bytes not decoded yet.
+        """
+        if self.decoder is None:
+            unread = self.pending
+        else:
+            unread = bytes(self.decoder.buf[self.decoder.pos:])
+        return self.framed, self.hello, unread
+
+    @classmethod
+    def restore(cls, state):
+        """
+        Rebuilds a reader from state(). Returns the reader and any commands completed
+        by the unread bytes.
+        """
+        framed, hello, unread = state
+        reader = cls()
+        if framed is None:
+            reader.pending = unread
+            return reader, []
+        if framed:
+            reader.feed(hello)
+        else:
+            reader.framed = False
+        return reader, reader.feed(unread) if unread else []
+
+    def recv_size(self):
+        """
+        Returns how many bytes the server should ask for in the next recv().
+        """
+        return FRAMED_RECV_SIZE if self.framed else LEGACY_RECV_SIZE
+
+    def feed(self, data):
+        """
+        Returns the list of command lines contained in the received data.
+        After the call, 'framed' tells whether the connection negotiated framing.
+        """
+        if self.framed is None:
+            data = self.pending + data
+            if data[:1] == HELLO[:1]:
+                if len(data) < len(HELLO) and any(hello.startswith(data) for hello in HELLOS):
+                    self.pending = data  # Partial hello; wait for the rest
+                    return []
+                self.pending = b""
+                hello = data[:len(HELLO)]
+                if hello in HELLOS:
+                    self.framed = True
+                    self.hello = hello
+                    data = data[len(HELLO):]
+                    if hello == HELLO:
+                        self.decoder = FrameDecoder()
+                    else:
+                        self.binary = BinarySession(compress=hello == HELLO_BINARY_ZLIB)
+                        self.decoder = BinaryFrameDecoder()
+                else:
+                    self.framed = False
+            else:
+                self.pending = b""
+                self.framed = False
+        # Heartbeat answers only count as activity and are dropped here
+        if self.binary is not None:
+            return [decode_command(op, body) for op, body in self.decoder.feed(data) if op != OP_PONG]
+        if self.framed:
+            return [frame.decode('utf-8', errors='ignore').strip() for frame in self.decoder.feed(data)
+                    if frame != PONG]
+        # Legacy protocol: every recv is exactly one command
+        return [data.decode('utf-8', errors='ignore').strip()]
+
+
+def negotiate_client(sock, timeout=2.0, hello=HELLO):
+    """
+    Asks the server for the framed protocol (or, with another hello, the binary one)
+    right after connecting. Returns (framed, leftover) where leftover holds any bytes
+    received after the reply. A legacy server answers the hello with an error message,
+    which is discarded.
+    """
+    previous = sock.gettimeout()
+    sock.settimeout(timeout)
+    data = b""
+    try:
+        sock.sendall(hello)
+        while len(data) < len(hello):
+            chunk = sock.recv(LEGACY_RECV_SIZE)
+            if not chunk:
+                break
+            data += chunk
+            if not hello.startswith(data[:len(hello)]):
+                break  # Not a hello reply; the server only speaks the legacy protocol
+    except socket.timeout:
+        pass
+    finally:
+        sock.settimeout(previous)
+    if data.startswith(hello):
+        return True, data[len(hello):]
+    return False, b""
@@ -0,0 +1,203 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Token-bucket rate limits on chat commands and bytes.
+Every user has one bucket for commands and one for bytes, shared by all of the
+user's connections. In threaded mode those connections are served by different
+threads, so the buckets have a lock of their own. The process-wide buckets are one
+pair under one lock, so a single busy user can use the whole server budget. A
+message costs its size times the number of recipients, so the fan-out of
+"send all" is what is limited, and commands are checked before any of that work
+is done.
+'''
+
+# Using Python version 3.12.0
+
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+# Default limits as (tokens per second, burst); a rate of 0 turns a limit off
+USER_COMMANDS = (20.0, 40.0)
+USER_BYTES = (256 * 1024.0, 1024 * 1024.0)
+GLOBAL_COMMANDS = (0.0, 0.0)
+GLOBAL_BYTES = (0.0, 0.0)
+
+# Shards of the map of users' buckets, each with its own lock
+USER_SHARDS = 16
+# Users whose buckets are remembered after they log out, so reconnecting does not refill them
+MAX_USERS = 100000
+
+# Longest time a throttled connection is not read from; the rest of the wait is
+# enforced by throttling its next command again
+PAUSE_MAX = 1.0
+
+# Names of the limits, as used on the command line and by the admin endpoint
+LIMITS = ('user_commands', 'user_bytes', 'global_commands', 'global_bytes')
+
+
+def parse_limit(text):
+    """
+    Parses "RATE" or "RATE/BURST" into (rate, burst). The burst defaults to twice the rate.
+    """
+    rate, _, burst = text.partition('/')
+    rate = float(rate)
+    burst = float(burst) if burst else rate * 2
+    if rate < 0 or burst < 0 or (rate and burst < 1):
+        raise ValueError(f"invalid rate limit: {text}")
+    return rate, burst
+
+
+def format_limit(limit):
+    rate, burst = limit
+    return f"{rate:.10g}/{burst:.10g}" if rate else "0"
+
+
+def throttle_text(scope, wait):
+    """
+    The response to a throttled command on the text protocols.
+    """
+    return f"Error: Rate limit exceeded ({scope}). Retry after {int(wait * 1000) + 1} ms."
+
+
+class Bucket:
+    """
+    Token bucket whose rate and burst are passed in, so limits can change at runtime.
+    Tokens may go below zero: a command that costs more than the burst is allowed
+    with a full bucket and leaves a debt that is paid off at the normal rate.
+    """
+    __slots__ = ('tokens', 'stamp')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.stamp = now
+
+    def wait(self, cost, rate, burst, now):
+        """
+        Refills the bucket and returns 0 if 'cost' tokens may be taken, otherwise the
+        seconds until they may.
+        """
+        tokens = self.tokens + (now - self.stamp) * rate
+        if tokens > burst:
+            tokens = burst
+        self.tokens = tokens
+        self.stamp = now
+        need = cost if cost < burst else burst
+        if tokens >= need:
+            return 0.0
+        return (need - tokens) / rate
+
+    def take(self, cost):
+        self.tokens -= cost
+
+
+class UserLimits:
+    """
+    The buckets of one user (or of one connection that has not logged in yet).
+    The lock is held while they are checked and charged, since several connections
+    of the user may be served by different threads.
+    """
+    __slots__ = ('user', 'lock', 'commands', 'bytes')
+
+    def __init__(self, user, now, limiter):
+        self.user = user
+        self.lock = threading.Lock()
+        self.commands = Bucket(limiter.user_commands[1], now)
+        self.bytes = Bucket(limiter.user_bytes[1], now)
+
+
+class RateLimiter:
+    """
+    Per-user and process-wide limits on commands and bytes, each (rate, burst).
+    check() is called for every command; configure() changes limits at runtime.
+    """
+    def __init__(self, user_commands=USER_COMMANDS, user_bytes=USER_BYTES, global_commands=GLOBAL_COMMANDS,
+                 global_bytes=GLOBAL_BYTES, shards=USER_SHARDS, max_users=MAX_USERS):
+        self.user_commands = user_commands
+        self.user_bytes = user_bytes
+        self.global_commands = global_commands
+        self.global_bytes = global_bytes
+        self.max_users = max_users
+        now = time.monotonic()
+        self.global_lock = threading.Lock()
+        self.server_commands = Bucket(global_commands[1], now)
+        self.server_bytes = Bucket(global_bytes[1], now)
+        # Buckets of users by name, split into shards with a lock each; only used at login
+        self.users = [(threading.Lock(), OrderedDict()) for _ in range(shards)]
+
+    def settings(self):
+        return {name: format_limit(getattr(self, name)) for name in LIMITS}
+
+    def configure(self, **limits):
+        """
+        Changes limits, given as (rate, burst) or "RATE/BURST" text. Applies to the
+        next command of every user; the buckets keep their tokens.
+        """
+        parsed = {}
+        for name, value in limits.items():
+            if name not in LIMITS:
+                raise ValueError(f"unknown limit: {name}")
+            parsed[name] = parse_limit(value) if isinstance(value, str) else tuple(value)
+        for name, value in parsed.items():
+            setattr(self, name, value)
+
+    def for_user(self, user):
+        """
+        Returns the buckets of a user, the same ones again after a reconnect.
+        With user None, returns new buckets for a connection that is not logged in.
+        """
+        now = time.monotonic()
+        if user is None:
+            return UserLimits(None, now, self)
+        lock, users = self.users[zlib.crc32(user.encode('utf-8')) % len(self.users)]
+        with lock:
+            limits = users.pop(user, None)
+            if limits is None:
+                limits = UserLimits(user, now, self)
+            users[user] = limits
+            # Forget the least recently seen users; their buckets would be full again anyway
+            while len(users) > self.max_users // len(self.users) + 1:
+                users.popitem(last=False)
+        return limits
+
+    def check(self, limits, cost, now=None):
+        """
+        Charges one command of 'cost' bytes to the user's buckets and to the
+        process-wide buckets. Returns None if it is allowed, otherwise (scope, seconds
+        to wait); nothing is charged then.
+        """
+        now = time.monotonic() if now is None else now
+        rate, burst = self.user_commands
+        byte_rate, byte_burst = self.user_bytes
+        global_rate, global_burst = self.global_commands
+        global_byte_rate, global_byte_burst = self.global_bytes
+        with limits.lock:
+            if rate:
+                wait = limits.commands.wait(1, rate, burst, now)
+                if wait:
+                    return 'user commands', wait
+            if byte_rate:
+                wait = limits.bytes.wait(cost, byte_rate, byte_burst, now)
+                if wait:
+                    return 'user bytes', wait
+            if global_rate or global_byte_rate:
+                with self.global_lock:
+                    if global_rate:
+                        wait = self.server_commands.wait(1, global_rate, global_burst, now)
+                        if wait:
+                            return 'server commands', wait
+                    if global_byte_rate:
+                        wait = self.server_bytes.wait(cost, global_byte_rate, global_byte_burst, now)
+                        if wait:
+                            return 'server bytes', wait
+                    # Buckets of limits that are off are left alone, so turning one on starts without a debt
+                    if global_rate:
+                        self.server_commands.take(1)
+                    if global_byte_rate:
+                        self.server_bytes.take(cost)
+            if rate:
+                limits.commands.take(1)
+            if byte_rate:
+                limits.bytes.take(cost)
+        return None
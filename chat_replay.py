@@ -0,0 +1,269 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Plays traffic recorded with the server's --capture option back
+against a chat room server, so two builds of the server can be compared on the
+same real workload. Every captured connection gets a connection of its own (binary
+protocol, asyncio client library) and sends its commands in the recorded order.
+A command leaves at its recorded time divided by --speed, or with "max" as soon as
+the connection's previous command was answered; it never leaves before that answer,
+so every connection runs its commands in the order the server ran them when they
+were captured. Between connections only the timing keeps the order, unless
+--ordered makes every command wait until everything recorded before it, on any
+connection, was answered: then the responses no longer depend on the speed or on
+the machine, but commands never overlap, so the latencies are those of a single
+client. Several trace files (e.g. FILE.N of every worker) play together.
+Reported: the commands sent, how long that took, the commands that left late, and
+the distribution of the time from sending a command to its response. --save writes
+every response to a file; --compare checks the responses against such a file from
+an earlier run, e.g. of the server before a change, shows the first commands that
+were answered differently and exits with status 1 if there were any.
+The server should start with the same accounts and state as for the saved run,
+otherwise logins and deliveries are answered differently.
+
+Usage: python chat_replay.py capture.jsonl [--speed 1|N|max] [--ordered] [--save run.json] [--compare run.json]
+'''
+
+# Using Python version 3.12.0
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from chat_aioclient import DEFAULT_HOST, DEFAULT_PORT, ChatSession, ConnectionLost, RateLimited
+from chat_capture import read_trace
+from chat_loadgen import percentiles
+
+# Seconds a command waits for its response before it counts as unanswered
+RESPONSE_TIMEOUT = 10.0
+# Seconds after its recorded time a command counts as late
+LATE = 0.01
+# Differing responses printed by --compare
+SHOWN_DIFFERENCES = 10
+
+
+def load_connections(paths):
+    """
+    Returns the commands of every captured connection as a dict of name -> list of
+    (seconds, command, position), with command None where the connection ended and
+    position the place of the command among those of all connections, by time.
+    Connection N of the first file is named "0:N", of the second "1:N" and so on.
+    """
+    events = []
+    for index, path in enumerate(paths):
+        _, recorded = read_trace(path)
+        events.extend((seconds, index, line, f"{index}:{number}", command)
+                      for line, (seconds, number, command) in enumerate(recorded))
+    events.sort(key=lambda event: event[:3])
+    connections = {}
+    for position, (seconds, _, _, name, command) in enumerate(events):
+        connections.setdefault(name, []).append((seconds, command, position))
+    return connections
+
+
+def parse_speed(text):
+    """
+    Returns the replay speed factor, None for "max".
+    """
+    if text == 'max':
+        return None
+    speed = float(text)
+    if speed <= 0:
+        raise ValueError("speed must be positive")
+    return speed
+
+
+class Replay:
+    """
+    One run over a set of captured connections and what came back.
+    """
+    def __init__(self, connections, host, port, speed, ordered=False, timeout=RESPONSE_TIMEOUT):
+        self.connections = connections
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.ordered = ordered
+        self.timeout = timeout
+        self.done = None  # With 'ordered': one event per command, set once it was answered
+        self.responses = {name: [] for name in connections}  # Name -> [command, response] pairs
+        self.latencies = []  # Nanoseconds from sending a command to its response
+        self.late = 0
+        self.start = None
+
+    async def run(self):
+        """
+        Plays every connection and returns the seconds it took.
+        """
+        if self.ordered:
+            self.done = [asyncio.Event() for _ in range(sum(map(len, self.connections.values())))]
+        self.start = time.perf_counter()
+        await asyncio.gather(*(self.play(name, commands) for name, commands in self.connections.items()))
+        return time.perf_counter() - self.start
+
+    async def play(self, name, commands):
+        responses = self.responses[name]
+        session = None
+        try:
+            for seconds, command, position in commands:
+                await self.wait_turn(seconds, position)
+                try:
+                    if command is None:
+                        break  # The captured connection ended here
+                    if session is None:
+                        session = ChatSession(self.host, self.port, reconnect=False)
+                        try:
+                            await session.connect()
+                        except OSError as e:
+                            session = None
+                            responses.append([command, f"(connect failed: {e.strerror or e})"])
+                            continue
+                    responses.append([command, await self.send(session, command)])
+                finally:
+                    if command is None and session is not None:
+                        await session.close()
+                        session = None
+                    if self.done is not None:
+                        self.done[position].set()
+        finally:
+            if session is not None:
+                await session.close()
+
+    async def wait_turn(self, seconds, position):
+        """
+        Waits until a command is due: its recorded time at the replay speed has come
+        and, with 'ordered', every command before it was answered.
+        """
+        if self.speed is not None:
+            delay = self.start + seconds / self.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if self.done is not None and position:
+            await self.done[position - 1].wait()
+        if self.speed is not None and time.perf_counter() - self.start - seconds / self.speed > LATE:
+            self.late += 1
+
+    async def send(self, session, command):
+        """
+        Sends one captured command and returns the response text, or a note in
+        parentheses when there was none.
+        """
+        if type(command) is str:
+            # Goes out as the same text command line
+            cmd, args = command, ()
+        else:
+            cmd, args = command
+        sent = time.perf_counter_ns()
+        try:
+            response = await asyncio.wait_for(session.command(cmd, *args), self.timeout)
+        except RateLimited as e:
+            return f"(throttled: {e.scope})"
+        except ConnectionLost:
+            return "(connection lost)"
+        except asyncio.TimeoutError:
+            return "(no response)"
+        self.latencies.append(time.perf_counter_ns() - sent)
+        return response
+
+    def report(self, elapsed):
+        """
+        Returns the results as a dict for printing and --save.
+        """
+        sent = sum(len(responses) for responses in self.responses.values())
+        return {'connections': len(self.connections), 'commands': sent, 'seconds': elapsed, 'ordered': self.ordered,
+                'late_commands': self.late, 'answered': len(self.latencies),
+                'latency': percentiles(self.latencies), 'responses': self.responses}
+
+
+def compare(responses, baseline):
+    """
+    Returns (number of commands answered the same, list of (connection, index,
+    command, expected, got) for those answered differently). Raises ValueError if the
+    runs did not replay the same traffic.
+    """
+    same = 0
+    different = []
+    if set(responses) != set(baseline):
+        raise ValueError("the runs replayed different connections")
+    for name, pairs in responses.items():
+        expected = baseline[name]
+        for index, (command, response) in enumerate(pairs):
+            if index >= len(expected) or expected[index][0] != command:
+                raise ValueError(f"connection {name} sent different commands in the two runs")
+            if expected[index][1] == response:
+                same += 1
+            else:
+                different.append((name, index, command, expected[index][1], response))
+    return same, different
+
+
+def describe(command):
+    return command if type(command) is str else " ".join([command[0]] + command[1])
+
+
+def print_report(report, speed):
+    print(f"{report['commands']} commands on {report['connections']} connections in {report['seconds']:.2f} s "
+          f"({'max' if speed is None else f'{speed:g}x'} speed{', ordered' if report['ordered'] else ''}, "
+          f"{report['commands'] / max(report['seconds'], 1e-9):.0f} commands/s), "
+          f"{report['late_commands']} late, {report['commands'] - report['answered']} unanswered")
+    latency = report['latency']
+    if latency['count']:
+        print(f"{'latency':>10} {'mean ms':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'p999 ms':>8} {'max ms':>8}")
+        print(f"{'':>10} {latency['mean_ms']:>8.2f} {latency['p50_ms']:>8.2f} {latency['p90_ms']:>8.2f} "
+              f"{latency['p99_ms']:>8.2f} {latency['p999_ms']:>8.2f} {latency['max_ms']:>8.2f}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Replays captured traffic against the chat room server.")
+    parser.add_argument('traces', nargs='+', metavar='TRACE', help="files written by the server's --capture")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--speed', default='1', help="multiple of the recorded pace, or 'max'")
+    parser.add_argument('--ordered', action='store_true',
+                        help="send every command only after all commands recorded before it were answered")
+    parser.add_argument('--timeout', type=float, default=RESPONSE_TIMEOUT,
+                        help="seconds a command waits for its response")
+    parser.add_argument('--save', metavar='FILE', help="write the results and every response to this file")
+    parser.add_argument('--compare', metavar='FILE', help="compare the responses with a file written by --save")
+    opts = parser.parse_args(argv)
+    try:
+        opts.speed = parse_speed(opts.speed)
+    except ValueError:
+        parser.error(f"invalid --speed {opts.speed}; expected a positive number or 'max'")
+    return opts
+
+
+def main(argv=None):
+    opts = parse_args(argv)
+    try:
+        connections = load_connections(opts.traces)
+        baseline = None
+        if opts.compare:
+            with open(opts.compare, encoding='utf-8') as f:
+                baseline = json.load(f)['responses']
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Failed to read the replay input: {e}")
+        return 1
+    replay = Replay(connections, opts.host, opts.port, opts.speed, opts.ordered, opts.timeout)
+    report = replay.report(asyncio.run(replay.run()))
+    report['traces'] = opts.traces
+    print_report(report, opts.speed)
+    if opts.save:
+        with open(opts.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False)
+    if baseline is None:
+        return 0
+    try:
+        same, different = compare(report['responses'], baseline)
+    except ValueError as e:
+        print(f"Cannot compare with {opts.compare}: {e}")
+        return 1
+    print(f"responses: {same} as in {opts.compare}, {len(different)} different")
+    for name, index, command, expected, got in different[:SHOWN_DIFFERENCES]:
+        print(f"  connection {name} command {index + 1} {describe(command)!r}: {expected!r} -> {got!r}")
+    return 1 if different else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Named chat rooms for the chat room server.
+Every room keeps its members in an insertion-ordered dict with a cached immutable
+snapshot, like the global presence list, so a room message only visits the room's
+own members. A second index from user to joined rooms makes joins, leaves and
+disconnect cleanup cost O(1) per membership.
+'''
+
+# Using Python version 3.12.0
+
+import re
+import threading
+
+from chat_presence import WHO_PAGE_SIZE, Snapshot, render_who
+
+# Room names: '#' followed by letters, digits, '-' or '_'
+ROOM_NAME = re.compile(r'#[A-Za-z0-9_-]{1,32}')
+# Rooms one user may be in at the same time
+MAX_ROOMS_PER_USER = 100
+
+
+def parse_room(name):
+    """
+    Returns the canonical (lowercase) form of a room name, or None if it is not one.
+    The leading '#' may be left out when joining or leaving.
+    """
+    if not name.startswith('#'):
+        name = '#' + name
+    if not ROOM_NAME.fullmatch(name):
+        return None
+    return name.lower()
+
+
+class Room:
+    """
+    Members of one room in join order, mapped to their client connections.
+    """
+    __slots__ = ('members', 'snap')
+
+    def __init__(self):
+        self.members = {}
+        self.snap = None  # Invalidated on every membership change
+
+
+class Rooms:
+    """
+    Every room plus the rooms of every user. One lock guards both indexes; readers
+    work from per-room snapshots and never hold it while sending.
+    """
+    def __init__(self, max_rooms_per_user=MAX_ROOMS_PER_USER):
+        self.lock = threading.Lock()
+        self.rooms = {}
+        self.joined = {}  # user -> set of room names
+        self.max_rooms_per_user = max_rooms_per_user
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def join(self, room, user, client):
+        """
+        Adds a user to a room, creating the room if needed.
+        Returns False if the user is already in the room, raises ValueError if the
+        user is in too many rooms.
+        """
+        with self.lock:
+            rooms = self.joined.get(user)
+            if rooms is not None and room in rooms:
+                return False
+            if rooms is None:
+                rooms = self.joined[user] = set()
+            elif self.max_rooms_per_user and len(rooms) >= self.max_rooms_per_user:
+                raise ValueError(f"cannot join more than {self.max_rooms_per_user} rooms")
+            entry = self.rooms.get(room)
+            if entry is None:
+                entry = self.rooms[room] = Room()
+            entry.members[user] = client
+            entry.snap = None
+            rooms.add(room)
+            return True
+
+    def leave(self, room, user, client=None):
+        """
+        Removes a user from a room, optionally only while bound to the given connection.
+        Empty rooms disappear. Returns True if the user was a member.
+        """
+        with self.lock:
+            return self.remove(room, user, client)
+
+    def remove(self, room, user, client=None):
+        """
+        Removes one membership. Must be called with the lock held.
+        """
+        entry = self.rooms.get(room)
+        if entry is None:
+            return False
+        current = entry.members.get(user)
+        if current is None or (client is not None and current is not client):
+            return False
+        del entry.members[user]
+        if entry.members:
+            entry.snap = None
+        else:
+            del self.rooms[room]
+        rooms = self.joined[user]
+        rooms.discard(room)
+        if not rooms:
+            del self.joined[user]
+        return True
+
+    def leave_all(self, user, client=None):
+        """
+        Removes a user from every room they are in, e.g. when they disconnect.
+        Returns the names of the rooms that were left.
+        """
+        with self.lock:
+            rooms = self.joined.get(user)
+            if not rooms:
+                return []
+            return [room for room in list(rooms) if self.remove(room, user, client)]
+
+    def rooms_of(self, user):
+        rooms = self.joined.get(user)
+        return sorted(rooms) if rooms else []
+
+    def is_member(self, room, user):
+        entry = self.rooms.get(room)
+        return entry is not None and user in entry.members
+
+    def snapshot(self, room):
+        """
+        Returns the Snapshot of a room's members, or None if the room does not exist.
+        """
+        entry = self.rooms.get(room)
+        if entry is None:
+            return None
+        snap = entry.snap
+        if snap is None:
+            with self.lock:
+                snap = entry.snap
+                if snap is None:
+                    snap = entry.snap = Snapshot(entry.members)
+        return snap
+
+    def recipients(self, room):
+        """
+        Returns the members of a room connected to this process.
+        """
+        snap = self.snapshot(room)
+        return snap.clients if snap is not None else ()
+
+    def listing(self):
+        """
+        Renders the "rooms" listing: every room with its number of members, by name.
+        """
+        with self.lock:
+            counts = sorted((room, len(entry.members)) for room, entry in self.rooms.items())
+        return ", ".join(f"{room} ({count})" for room, count in counts)
+
+    def who(self, room, prefix=None, page=None, page_size=WHO_PAGE_SIZE):
+        """
+        Renders the members of a room like the global "who" listing.
+        """
+        snap = self.snapshot(room)
+        if snap is None:
+            return ""
+        return render_who(snap, prefix, page, page_size)
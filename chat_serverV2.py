@@ -7,264 +7,1717 @@ Program Description: This is the server component of a chat room application.
 
 # Using Python version 3.12.0
 
+import argparse
+import configparser
+import itertools
+import os
+import random
+import signal
 import socket      
+import ssl
 import sys         
 import threading   
-import os          
+import time
+
+import chat_history
+import chat_metrics as metrics
+from chat_auth import AUTH_WORKERS, HASH_ITERATIONS, Authenticator, hash_password
+from chat_mailbox import MAX_BYTES, MAX_MESSAGES, RETENTION, Mailbox
+from chat_outbound import (COALESCE_MAX_BYTES, DEFAULT_COALESCE_DELAY, DEFAULT_POLICY, DEFAULT_QUEUE_BYTES, POLICIES,
+                           OutboundQueue, SlowConsumerError, tune_socket, write_all)
+from chat_presence import Presence
+from chat_rooms import Rooms, parse_room
+from chat_logging import DEFAULT_LEVEL, LOG_LEVELS, log, setup_logging, stop_logging
+from chat_binary import USER_IDS, compress_frames
+from chat_capture import TrafficCapture
+from chat_commands import UNAUTHENTICATED, CommandTable, Session
+from chat_config import Reloader, read_config
+from chat_federation import PEER_TIMEOUT, Federation, parse_address
+from chat_handoff import (CONTROL_SOCKET, HANDOFF_TIMEOUT, QUIESCE_TIMEOUT, HandoffError, hand_over, listen_control,
+                          recv_message, take_over)
+from chat_protocol import PING_FRAME, CommandReader, SharedMessage, encode_message
+from chat_ratelimit import (GLOBAL_BYTES, GLOBAL_COMMANDS, LIMITS, PAUSE_MAX, USER_BYTES, USER_COMMANDS, RateLimiter,
+                            format_limit, parse_limit, throttle_text)
+from chat_timers import HEARTBEAT_INTERVAL, IDLE_TIMEOUT, LOGIN_TIMEOUT, ConnectionTimeouts, TimerThread
+from chat_tls import HANDSHAKE_WORKERS, SESSION_TICKETS, handshake_pool, server_context, server_handshake
+from chat_userstore import SYNC_POLICIES, open_user_store
 
 # Maximum number of concurrent clients allowed
 MAXCLIENTS = 3
 
+# Defaults for the event-loop server mode, which is meant for many idle clients
+EVENT_MAX_CLIENTS = 20000
+EVENT_BACKLOG = 1024
+
+# Connection limit of this process in the selected mode (0 = unlimited), set by main()
+CLIENT_LIMIT = 0
+
+# Outbound queue limit per client and what happens to clients that fall behind it
+OUTBOUND_QUEUE_BYTES = DEFAULT_QUEUE_BYTES
+SLOW_CLIENT_POLICY = DEFAULT_POLICY
+
+# Seconds queued output waits for more messages to the same client before it is
+# written with one system call, and the options applied to every client socket.
+# Writer threads batch whatever queued up while they were busy even without a delay.
+COALESCE_DELAY = 0.0
+TCP_NODELAY = True
+SOCKET_SNDBUF = 0  # 0 keeps the system default
+SOCKET_RCVBUF = 0
+
+# Seconds before connections that did not log in are closed, of silence before a
+# heartbeat is sent, and of silence before a connection is closed (0 = never)
+LOGIN_TIMEOUT_SECONDS = LOGIN_TIMEOUT
+HEARTBEAT_SECONDS = HEARTBEAT_INTERVAL
+IDLE_TIMEOUT_SECONDS = IDLE_TIMEOUT
+
+# SSL context when connections are encrypted (see chat_tls.py), created by main(), and the
+# threads of the event loop that run handshakes (0 = on the loop thread)
+TLS_CONTEXT = None
+TLS_WORKERS = HANDSHAKE_WORKERS
+
+# Shutdown drain (SIGTERM or the first Ctrl+C): seconds it may take before the remaining
+# connections are closed as they are (0 = close everything at once), connections closed
+# per step and seconds between steps. Every client is told to reconnect after
+# RECONNECT_AFTER seconds plus a random part of RECONNECT_SPREAD seconds.
+DRAIN_TIMEOUT = 10.0
+DRAIN_BATCH = 200
+DRAIN_INTERVAL = 0.05
+RECONNECT_AFTER = 1.0
+RECONNECT_SPREAD = 10.0
+# Set once the drain has started
+draining = False
+
+# Login, heartbeat and idle timeouts: driven by one timer thread in the threaded mode,
+# by the loop's timer wheel in the event mode
+timeouts = None
+
+# The event loop in the event and worker modes, the settings reloader (see chat_config.py),
+# the control socket a new process takes over through (see chat_handoff.py) and the admin endpoint
+event_loop = None
+reloader = None
+control_sock = None
+metrics_server = None
+
 # Server network configuration
 HOST = '127.0.0.1'    # Localhost IP address
 PORT = 19953          
 USERFILE = 'users.txt'  
 
-# Dictionary mapping username -> connection socket for active clients
-active_clients = {}
-active_clients_lock = threading.Lock()  
-
-# List to maintain the login order for the "who" command
-online_order = []
-online_order_lock = threading.Lock()  
-
-# Load existing users from the file formatted as: (UserID, Password)
-users = {}
-try:
-    with open(USERFILE, 'r') as f:
-        for line in f:
-            line = line.strip()  # Remove leading/trailing whitespace
-            if not line:
-                continue  # Skip empty lines
-            if line.startswith("(") and line.endswith(")"):
-                line = line[1:-1]  # Remove surrounding parentheses if present
-            parts = line.split(',')  # Split into username and password parts
-            if len(parts) >= 2:
-                username = parts[0].strip()
-                password = parts[1].strip()
-                users[username] = password  
-except FileNotFoundError:
-    users = {}
+# Commands by name (see chat_commands.py); the handlers are registered below process_command().
+# Metrics count registered commands under their own name and anything else as "unknown".
+commands = CommandTable()
+
+# Online users in login order, mapped to their client connection objects
+presence = Presence()
+
+# Chat rooms and their members (see chat_rooms.py)
+rooms = Rooms()
+
+# Account storage, opened by main(); see chat_userstore.py for the available backends
+USERSTORE = f"text:{USERFILE}"
+user_store = None
+
+# Password verification pool and login rate limiter, created by main()
+authenticator = None
+
+# Rate limits on commands and bytes (see chat_ratelimit.py), created by main()
+limiter = None
+
+# Link to the router process when running as one of several workers (see chat_workers.py)
+bus = None
+
+# Links to other chat servers (see chat_federation.py), created by main() with --peers
+# or --federation-port
+federation = None
+
+# Offline message storage (see chat_mailbox.py); None disables offline messages.
+# In multi-worker mode the router process owns the mailboxes and 'mailbox' stays None.
+MAILBOX_DIR = 'mailboxes'
+mailbox = None
+# Offline messages sent to a client per write when it logs in
+MAILBOX_BATCH = 100
+
+# Log of "send all" and direct messages (see chat_history.py); None disables it.
+# In multi-worker mode the router process owns the log and 'history' stays None.
+HISTORY_DIR = 'history'
+history = None
+
+# Trace of the commands received (see chat_capture.py), opened with --capture; every
+# worker of the multi-worker mode writes its own file, FILE.N for worker N
+capture = None
+
+class ThreadedClient(Session):
+    """
+    Wraps a blocking client socket for the thread-per-connection server mode.
+    The command handlers only need send()/enqueue() and the session state.
+    Outgoing messages go through a bounded queue drained by a writer thread,
+    so other threads never block on this client's socket.
+    """
+    __slots__ = ('conn', 'addr', 'closed', 'reader', 'framed', 'binary', 'connected', 'last_seen', 'pinged', 'outq',
+                 'out_ready', 'writing', 'coalescing', 'writer')
+    remote = False  # Connected to this process, unlike users on other workers
+
+    def __init__(self, conn, addr):
+        super().__init__()
+        self.conn = conn
+        self.addr = addr
+        self.closed = False
+        self.reader = CommandReader()
+        self.framed = False
+        self.binary = None  # BinarySession for clients of the binary protocol
+        # When the connection was opened and last received data (see chat_timers.py)
+        self.connected = self.last_seen = time.monotonic()
+        self.pinged = 0.0
+        self.outq = OutboundQueue(OUTBOUND_QUEUE_BYTES, SLOW_CLIENT_POLICY)
+        self.out_ready = threading.Condition()
+        self.writing = False  # The writer thread is sending chunks it took from the queue
+        self.coalescing = False  # The writer thread is waiting for more messages to batch
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def send(self, text):
+        """
+        Sends a server notice, e.g. "X joins.".
+        """
+        if self.binary is not None:
+            self.enqueue(self.binary.notice(text))
+        else:
+            self.enqueue(encode_message(text, self.framed))
+
+    def respond(self, text):
+        """
+        Sends the response to a command. Binary clients get one for every command,
+        the text protocols skip empty responses.
+        """
+        if self.binary is not None:
+            self.enqueue(self.binary.response(text))
+        elif text:
+            self.enqueue(encode_message(text, self.framed))
+
+    def deliver(self, shared):
+        """
+        Sends a SharedMessage in this client's protocol.
+        """
+        self.enqueue(shared.encode_for(self))
+
+    def defer(self, future, callback):
+        """
+        Waits for work running elsewhere (e.g. password hashing) and returns the
+        response built by callback(result). Only this client's thread waits.
+        """
+        return callback(future.result())
+
+    def ping(self):
+        """
+        Sends a heartbeat; framed and binary clients answer it.
+        """
+        try:
+            self.enqueue(self.binary.ping() if self.binary is not None else PING_FRAME)
+        except ConnectionError:
+            pass  # Already being closed
+
+    def expire(self, text):
+        """
+        Tells the client why and closes its connection, e.g. after a timeout.
+        """
+        if self.closing or self.closed:
+            return
+        try:
+            self.send(text)
+        except ConnectionError:
+            return
+        self.hang_up()
+
+    def throttle(self, scope, wait):
+        """
+        Answers a command refused by a rate limit, then holds this client's thread for
+        a while, so a flood backs up in its own socket buffers.
+        """
+        if self.binary is not None:
+            self.enqueue(self.binary.throttle(scope, wait))
+        else:
+            self.respond(throttle_text(scope, wait))
+        time.sleep(min(wait, PAUSE_MAX))
+
+    def goodbye(self, text, wait):
+        """
+        Tells the client the server is shutting down and to reconnect after 'wait' seconds.
+        """
+        if self.binary is not None:
+            self.enqueue(self.binary.goodbye(text, wait))
+        else:
+            self.enqueue(encode_message(text, self.framed))
+
+    def hang_up(self):
+        """
+        Closes the connection once the queued output is written: shutting down the
+        receiving side wakes the handler thread, which cleans up.
+        """
+        self.closing = True
+        try:
+            self.conn.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def enqueue(self, data):
+        """
+        Queues encoded bytes for the writer thread without blocking.
+        """
+        with self.out_ready:
+            if self.closed:
+                raise ConnectionError("client connection is closed")
+            if self.outq:
+                metrics.send_queue_bytes.observe(self.outq.pending())
+            try:
+                if not self.outq.push(data):
+                    metrics.slow_consumers.inc()
+            except SlowConsumerError:
+                metrics.slow_consumers.inc()
+                self.abort()
+                raise
+            # A writer collecting a batch wakes up on its own when the delay is over
+            if not self.coalescing or self.outq.pending() >= COALESCE_MAX_BYTES:
+                self.out_ready.notify_all()
+
+    def stream(self, chunks):
+        """
+        Sends an iterable of encoded chunks, queuing the next one only after the writer
+        has sent the previous one. Runs on this client's own thread.
+        """
+        for chunk in chunks:
+            with self.out_ready:
+                while (self.outq or self.writing) and not self.closed:
+                    self.out_ready.wait()
+            self.enqueue(chunk)
+
+    def write_loop(self):
+        """
+        Writer thread: sends queued messages until the connection is closed and drained.
+        """
+        while True:
+            with self.out_ready:
+                while not self.outq and not self.closed:
+                    self.out_ready.wait()
+                if not self.outq:
+                    return
+                # Give other threads a moment to add more messages, so they are all
+                # written with one system call; legacy clients read one message per recv
+                if COALESCE_DELAY and self.framed:
+                    deadline = time.monotonic() + COALESCE_DELAY
+                    self.coalescing = True
+                    while not self.closed and self.outq.pending() < COALESCE_MAX_BYTES:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.out_ready.wait(remaining)
+                    self.coalescing = False
+                chunks = self.outq.take_all()
+                self.writing = True
+            try:
+                write_all(self.conn, chunks, self.framed)
+            except OSError:
+                with self.out_ready:
+                    self.writing = False
+                    self.abort()
+                return
+            with self.out_ready:
+                self.writing = False
+                self.out_ready.notify_all()
+
+    def abort(self):
+        """
+        Drops queued output and shuts the socket down, which also wakes the reader thread.
+        Must be called with out_ready held.
+        """
+        self.closed = True
+        self.outq.clear()
+        self.out_ready.notify_all()
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self, flush_timeout=5.0):
+        """
+        Lets the writer thread flush what is queued, then closes the socket.
+        """
+        with self.out_ready:
+            self.closed = True
+            self.out_ready.notify_all()
+        self.writer.join(flush_timeout)
+        self.conn.close()
+
+def shared_message(message):
+    """
+    Wraps plain notice text in a SharedMessage; chat messages arrive already wrapped.
+    """
+    return message if isinstance(message, SharedMessage) else SharedMessage(message)
 
 def broadcast_message(message, exclude_conn=None):
     """
     Broadcasts a message to all connected clients except the one specified by exclude_conn.
-    This function iterates over all active clients and sends the encoded message.
+    In multi-worker mode the router also hands one copy to every other worker, and
+    every federation peer gets one copy.
+    """
+    shared = shared_message(message)
+    broadcast_local(shared, exclude_conn)
+    if bus is not None:
+        bus.broadcast(shared.fields())
+    if federation is not None:
+        federation.broadcast(shared.fields())
+
+def broadcast_local(message, exclude_conn=None):
+    """
+    Sends a message to the clients connected to this process. Nothing is sent while
+    they are being drained, e.g. not one "left." notice per user to every other user.
+    """
+    if draining:
+        return
+    fan_out(shared_message(message), presence.recipients(), exclude_conn)
+
+def room_message(room, message, exclude_conn=None):
+    """
+    Sends a message to the members of a room. Only the room's own members are visited;
+    in multi-worker mode every other worker gets one copy for its members, and so does
+    every federation peer with members in the room.
+    """
+    shared = shared_message(message)
+    room_local(room, shared, exclude_conn)
+    if bus is not None:
+        bus.room(room, shared.fields())
+    if federation is not None:
+        federation.room(room, shared.fields())
+
+def room_local(room, message, exclude_conn=None):
+    """
+    Sends a room message to the members connected to this process.
+    """
+    fan_out(shared_message(message), rooms.recipients(room), exclude_conn)
+
+def fan_out(shared, recipients, exclude_conn=None):
+    """
+    Queues one message to many clients. The message is encoded once per protocol and
+    'recipients' comes from an immutable snapshot, so no lock is held while sending.
+    """
+    start = time.perf_counter()
+    for client in recipients:
+        if client is exclude_conn:
+            continue
+        try:
+            client.enqueue(shared.encode_for(client))
+        except Exception as e:
+            # The recipient's own connection handles the failure
+            log.debug(f"Broadcast to {client.user} failed: {e}")
+    metrics.broadcast_seconds.observe(time.perf_counter() - start)
+    metrics.broadcast_recipients.observe(len(recipients))
+
+def deliver_local(user, fields):
+    """
+    Sends a message routed from another worker to a user connected to this process.
+    """
+    client = presence.get(user)
+    if client is not None and not client.remote:
+        try:
+            client.deliver(SharedMessage(*fields))
+        except Exception as e:
+            log.debug(f"Delivery to {user} failed: {e}")
+
+def deliver_from_peer(user, fields):
+    """
+    Sends a direct message from a federation peer to a user connected to this server.
+    If the user logged out while it was on its way, it is kept as an offline message.
+    """
+    if presence.get(user) is None and mailbox is not None and user_store.get(user) is not None:
+        mailbox.store(user, fields[0])
+    else:
+        deliver_local(user, fields)
+
+def remove_online_user(user, client=None):
+    """
+    Marks a user offline, optionally only while they are bound to the given connection.
     """
-    with active_clients_lock:
-        for user, client_conn in active_clients.items():
-            if client_conn != exclude_conn:
-                try:
-                    client_conn.sendall(message.encode('utf-8'))
-                except Exception:
-                    pass
+    rooms.leave_all(user, client)
+    if presence.remove(user, client):
+        if bus is not None:
+            bus.offline(user)  # Other workers drop the user from their rooms too
+        if federation is not None:
+            federation.offline(user)
 
-def handle_client(conn, addr):
+def command_limits(client):
+    """
+    Returns the rate limit buckets a client's commands are charged to: the user's
+    once logged in, the connection's own before that.
+    """
+    limits = client.limits
+    if limits is None or limits.user != client.user:
+        limits = client.limits = limiter.for_user(client.user)
+    return limits
+
+def command_cost(client, cmd, args):
+    """
+    Returns the bytes a command is charged for: the size of its arguments, times the
+    number of recipients for messages to everybody or to a room.
+    """
+    size = len(cmd) + sum(len(arg) for arg in args)
+    if cmd == "send" and len(args) == 2 and client.user:
+        target = args[0]
+        if target.lower() == "all":
+            size *= max(1, len(presence) - 1)
+        elif target.startswith('#'):
+            room = parse_room(target)
+            snap = rooms.snapshot(room) if room is not None else None
+            if snap is not None:
+                size *= max(1, len(snap.users) - 1)
+    return size
+
+def process_command(client, command):
+    """
+    Executes a single command for a client and returns the response text.
+    'command' is a text command line, or a (command, arguments) pair from the binary
+    protocol, which arrives already split; a binary command sent with a request id is
+    a triple ending in the id, with arguments None if it was a text command line.
+    An empty string is an empty response and None means the response was already
+    sent or will be sent later. Shared by every server mode; the client object only
+    has to be a Session (see chat_commands.py) that provides respond()/send().
+    """
+    if capture is not None:
+        capture.command(client, command)
+    if type(command) is str:
+        entry, cmd, args = commands.parse(command)
+    elif len(command) == 3:
+        # Responses carry the request id until the next command starts
+        cmd, args, client.binary.request_id = command
+        if args is None:
+            if not cmd:
+                return ""  # An empty command line still gets its (empty) response
+            entry, cmd, args = commands.parse(cmd)
+        else:
+            entry = commands.lookup(cmd)
+    else:
+        cmd, args = command
+        client.binary.request_id = None
+        entry = commands.lookup(cmd)
+    metrics.commands.inc(cmd if entry is not None else "unknown")
+
+    # Rate limits are checked before any work is done, so a throttled broadcast never fans out
+    if limiter is not None:
+        throttled = limiter.check(command_limits(client), command_cost(client, cmd, args))
+        if throttled is not None:
+            metrics.throttled.inc(throttled[0])
+            log.debug(f"Throttled {client.user or client.addr}: {throttled[0]}")
+            client.throttle(*throttled)
+            return None
+
+    # If the command is not recognized, send an error message
+    if entry is None:
+        return "Error: Unknown command"
+    return commands.dispatch(client, entry, args)
+
+def message_error(args):
+    """
+    Returns the error for a missing or oversized message of "send", or None.
+    """
+    if len(args) < 2 or args[1].strip() == "":
+        return "Error: Message is empty"
+    if len(args[1]) > 256:
+        return "Error: Message must be between 1 and 256 characters long"
+    return None
+
+# Command: login <UserID> <Password>
+@commands.command("login", states=(UNAUTHENTICATED,), args=(2, 2), usage="Usage: login <UserID> <Password>",
+                  denied="Error: Already logged in as {user}")
+def login_command(client, args):
+    user_id, pwd = args
+    if not authenticator.allow_attempt(user_id):
+        return "Denied. Too many login attempts. Try again later."
+    if (stored := user_store.get(user_id)) is None:
+        return "Denied. User name or password incorrect."
+    # The password hash is checked in the worker pool; the client decides
+    # whether to wait for it or to finish the login when it completes
+    future = authenticator.verify(user_id, pwd, stored, on_upgrade=user_store.update)
+    return client.defer(future, lambda ok: finish_login(client, user_id, ok))
+
+# Command: newuser <UserID> <Password>
+@commands.command("newuser", states=(UNAUTHENTICATED,), args=(2, 2), usage="Usage: newuser <UserID> <Password>",
+                  denied="Error: Cannot create new user while logged in")
+def newuser_command(client, args):
+    new_user, new_pwd = args
+    # Enforce length restrictions: UserID must be 3-32 chars, Password 4-8 chars
+    if len(new_user) < 3 or len(new_user) > 32:
+        return "UserID must be 3-32 characters long"
+    if len(new_pwd) < 4 or len(new_pwd) > 8:
+        return "Password must be 4-8 characters long"
+    if user_store.get(new_user) is not None:
+        return "Denied. User account already exists."
+    # Hashing and the store's commit both run in the worker pool
+    future = authenticator.submit(create_account, new_user, new_pwd)
+    return client.defer(future, lambda text: text)
+
+# Command: send <target> <message>
+@commands.command("send", args=(1, 2), usage="Usage: send <target> <message>", rest=True)
+def send_command(client, args):
+    target = args[0]
+    error = message_error(args)
+    # Check if message is for broadcasting to all clients
+    if target.lower() == "all":
+        if error is not None:
+            return error
+        message = args[1]
+        full_message = f"{client.user}: {message}"
+        # Broadcast the message to all clients except the sender
+        broadcast_message(SharedMessage(full_message, 'all', client.user, message), exclude_conn=client)
+        record_history('all', client.user, None, message)
+        log.info(full_message)
+        return ""
+    # Room message: send #room <message>
+    if target.startswith('#'):
+        room = parse_room(target)
+        if room is None or not rooms.is_member(room, client.user):
+            return f"Error: You are not in {target}"
+        if error is not None:
+            return error
+        message = args[1]
+        room_message(room, SharedMessage(f"{room} {client.user}: {message}", 'room', client.user, message, room),
+                     exclude_conn=client)
+        log.info(f"{client.user} (to {room}): {message}")
+        return ""
+    # Unicast: send message to a specific user
+    if error is not None:
+        return error
+    message = args[1]
+    shared = SharedMessage(f"{client.user}: {message}", 'msg', client.user, message)
+    target_client = presence.get(target)
+    if not target_client:
+        return store_offline(client, target, shared)
+    try:
+        target_client.deliver(shared)
+    except Exception as e:
+        log.debug(f"Unicast to {target} failed: {e}")
+        return f"Error: Could not send message to {target}."
+    record_history('msg', client.user, target, message)
+    log.info(f"{client.user} (to {target}): {message}")
+    return ""
+
+# Command: who [#room] [prefix] [page]
+@commands.command("who", args=(0, 3), usage="Usage: who [#room] [prefix] [page]")
+def who_command(client, args):
+    args = list(args)
+    room_name = args.pop(0) if args and args[0].startswith('#') else None
+    room = parse_room(room_name) if room_name else None
+    if len(args) > 2:
+        return "Usage: who [#room] [prefix] [page]"
+    if room_name and room is None:
+        return f"Error: Invalid room name {room_name}"
+    # A numeric last argument selects a page, anything else filters by prefix
+    prefix = None
+    page = None
+    if args and args[-1].isdigit():
+        page = int(args.pop())
+    if args:
+        prefix = args[0]
+    if page is not None and page < 1:
+        return "Error: Page numbers start at 1"
+    if room is not None:
+        return rooms.who(room, prefix, page) or f"No matching users in {room}."
+    return presence.who(prefix, page) or "No matching users online."
+
+# Command: join <#room>
+@commands.command("join", args=(1, 1), usage="Usage: join <#room>")
+def join_command(client, args):
+    if (room := parse_room(args[0])) is None:
+        return "Error: Room names are 1-32 letters, digits, '-' or '_'"
+    try:
+        joined = rooms.join(room, client.user, client)
+    except ValueError as e:
+        return f"Error: Cannot join {room}, {e}"
+    if not joined:
+        return f"Error: Already in {room}"
+    if bus is not None:
+        bus.join(room, client.user)
+    if federation is not None:
+        federation.join(room, client.user)
+    room_message(room, f"{client.user} joined {room}.", exclude_conn=client)
+    log.info(f"{client.user} joined {room}.")
+    return f"Joined {room}."
+
+# Command: leave <#room>
+@commands.command("leave", args=(1, 1), usage="Usage: leave <#room>")
+def leave_command(client, args):
+    if (room := parse_room(args[0])) is None or not rooms.leave(room, client.user, client):
+        return f"Error: You are not in {args[0]}"
+    if bus is not None:
+        bus.leave(room, client.user)
+    if federation is not None:
+        federation.leave(room, client.user)
+    room_message(room, f"{client.user} left {room}.", exclude_conn=client)
+    log.info(f"{client.user} left {room}.")
+    return f"Left {room}."
+
+# Command: rooms
+@commands.command("rooms")
+def rooms_command(client, args):
+    return rooms.listing() or "No rooms."
+
+# Command: history [all|<UserID>] [count]
+@commands.command("history", args=(0, 2), usage="Usage: history [all|<UserID>] [count]")
+def history_command(client, args):
+    args = list(args)
+    # A numeric last argument is the number of messages
+    count = int(args.pop()) if args and args[-1].isdigit() else chat_history.DEFAULT_COUNT
+    if len(args) > 1:
+        return "Usage: history [all|<UserID>] [count]"
+    if HISTORY_DIR is None:
+        return "Error: Message history is turned off."
+    # "send all" messages, or the direct messages between the client and one user
+    peer = args[0] if args and args[0].lower() != "all" else None
+    count = min(count, chat_history.MAX_COUNT)
+    return client.defer(read_history(client.user, peer, count),
+                        lambda messages: send_history(client, peer, messages))
+
+# Command: logout
+@commands.command("logout", denied="Error: You are not logged in")
+def logout_command(client, args):
+    response = f"{client.user} left."
+    log.info(f"{client.user} logout.")
+    # Broadcast to all clients that the user has left
+    broadcast_message(response, exclude_conn=client)
+    remove_online_user(client.user, client)
+    # The caller sends the logout confirmation and then closes the connection
+    client.logout()
+    return response
+
+def store_offline(client, target, shared):
+    """
+    Keeps a message for a user who is not online and returns the response for the sender.
+    """
+    if MAILBOX_DIR is None or user_store.get(target) is None:
+        return f"Error: User {target} is not online."
+    if bus is not None:
+        bus.store(target, shared.fields())  # The router stores it, or delivers it if the user just logged in
+    elif not mailbox.store(target, shared.text):
+        return f"Error: Could not save the message for {target}."
+    record_history('msg', client.user, target, shared.body)
+    log.info(f"{client.user} (to {target}, offline): {shared.body}")
+    return f"User {target} is offline. Message saved."
+
+def finish_login(client, user_id, ok):
+    """
+    Completes a login once the password check is done and returns the response text.
+    """
+    if not ok:
+        return "Denied. User name or password incorrect."
+    client.login(user_id)  # Mark client as logged in
+    presence.add(user_id, client)  # Add to active clients in login order
+    if bus is not None:
+        bus.online(user_id)  # The router answers with the user's offline messages
+    if federation is not None:
+        federation.online(user_id)
+    log.info(f"{user_id} login.")
+    # Notify all other clients that a new user has joined
+    broadcast_message(f"{user_id} joins.", exclude_conn=client)
+    if mailbox is not None and mailbox.has(user_id):
+        # Confirm first, then read the backlog in the worker pool and stream it
+        client.respond("login confirmed")
+        future = authenticator.submit(mailbox.take, user_id)
+        return client.defer(future, lambda messages: deliver_mail(client, user_id, messages))
+    return "login confirmed"
+
+def record_history(kind, sender, target, body):
+    """
+    Appends a delivered message to the history log, the router's in multi-worker mode.
+    """
+    if bus is not None:
+        bus.record((kind, sender, target, body))
+    elif history is not None:
+        history.append(kind, sender, target, body)
+
+def read_history(user, peer, count):
+    """
+    Returns a future of the newest messages for a "history" command. The log is read
+    in the worker pool, or by the router in multi-worker mode.
+    """
+    if bus is not None:
+        return bus.history(user, peer, count)
+    return authenticator.submit(history.recent, count, user, peer)
+
+def send_history(client, peer, messages):
+    """
+    Streams replayed messages to the client and returns the response text.
+    """
+    if not messages:
+        return f"No messages with {peer} in history." if peer else "No messages in history."
+    if client.closed:
+        return None
+    title = f"Last {len(messages)} message(s) with {peer}:" if peer else f"Last {len(messages)} message(s):"
+    batches = notice_batches(title, messages, client, replay=True)
+    if client.binary is not None:
+        # Binary clients get a response to every command; here it marks the end of the replay
+        batches = itertools.chain(batches, [client.binary.response("")])
+    client.stream(batches)
+    return None
+
+def mail_batches(messages, client):
+    """
+    Yields offline messages encoded in batches of MAILBOX_BATCH.
+    """
+    return notice_batches(f"You have {len(messages)} offline message(s).", messages, client)
+
+def notice_batches(notice, messages, client, replay=False):
+    """
+    Yields a notice and then the messages, encoded in batches of MAILBOX_BATCH.
+    Binary clients that allow compression get every batch compressed. With 'replay'
+    they are the output of the command being run, which binary clients get as
+    replay frames carrying its request id instead of notices.
+    """
+    framed = client.framed
+    session = client.binary
+    if session is not None:
+        encode = session.replay if replay else session.notice
+        yield encode(notice)
+    elif framed:
+        yield encode_message(notice, True)
+    else:
+        # Legacy clients print whatever one recv returns, so the notice and the messages
+        # go out as lines: the notice starts a new line (e.g. after "login confirmed")
+        # and every batch ends its last line
+        yield encode_message("\n" + "\n".join([notice] + messages[:MAILBOX_BATCH]) + "\n", False)
+        messages = messages[MAILBOX_BATCH:]
+    for start in range(0, len(messages), MAILBOX_BATCH):
+        batch = messages[start:start + MAILBOX_BATCH]
+        if session is not None:
+            yield compress_frames(b"".join(encode(text) for text in batch), session)
+        elif framed:
+            yield b"".join(encode_message(text, True) for text in batch)
+        else:
+            yield encode_message("\n".join(batch) + "\n", False)
+
+def deliver_mail(client, user, messages):
+    """
+    Sends a user's offline messages to their connection. The client paces the batches,
+    so a large backlog neither overflows its queue nor holds up other clients.
+    Messages for a connection that is already gone are stored again.
+    """
+    if not messages:
+        return None
+    if client.closed or client.user != user:
+        for text in messages:
+            if bus is not None:
+                bus.store(user, SharedMessage(text).fields())
+            else:
+                mailbox.store(user, text)
+        return None
+    log.info(f"Delivering {len(messages)} offline message(s) to {user}.")
+    client.stream(mail_batches(messages, client))
+    return None
+
+def deliver_mail_local(user, messages):
+    """
+    Delivers offline messages the router sent for a user connected to this worker.
+    """
+    client = presence.get(user)
+    if client is None or client.remote:
+        for text in messages:
+            bus.store(user, SharedMessage(text).fields())
+        return
+    try:
+        deliver_mail(client, user, messages)
+    except Exception as e:
+        log.debug(f"Offline delivery to {user} failed: {e}")
+
+def create_account(new_user, new_pwd):
+    """
+    Hashes the password of a new account and stores it. Runs in the worker pool
+    and returns the response text.
+    """
+    try:
+        if not user_store.add(new_user, hash_password(new_pwd, authenticator.iterations)):
+            return "Denied. User account already exists."
+    except Exception as e:
+        log.error(f"Could not save new user {new_user}: {e}")
+        return "Error: Could not save new user."
+    log.info("New user account created.")
+    return "New user account created."
+
+def disconnect_client(client):
+    """
+    Cleans up after a client connection has gone away, removing the user from active lists.
+    While draining, users on other workers and servers see the user leave.
+    """
+    if capture is not None:
+        capture.closed(client)
+    if client.user:
+        if draining:
+            broadcast_message(f"{client.user} left.", exclude_conn=client)
+        remove_online_user(client.user, client)
+        client.logout()
+
+# Number of connections currently served by handler threads, and their clients
+thread_clients = 0
+thread_clients_lock = threading.Lock()
+threaded_clients = set()
+
+def handle_client(conn, addr, max_clients=0):
     """
     Handles an individual client connection.
     Processes commands from the client, updates server state, and responds accordingly.
+    With TLS the handshake runs first, on this thread.
     """
-    global active_clients, online_order
-    logged_in_user = None  
+    global thread_clients
+    if TLS_CONTEXT is not None:
+        try:
+            conn = server_handshake(TLS_CONTEXT, conn)
+        except (OSError, ValueError) as e:
+            metrics.tls_handshake_failures.inc()
+            log.debug(f"TLS handshake with {addr} failed: {e}")
+            conn.close()
+            return
+        metrics.tls_handshakes.inc('resumed' if conn.session_reused else 'full')
+    client = ThreadedClient(conn, addr)
+    metrics.connections.inc()
+    metrics.connections_total.inc()
 
+    with thread_clients_lock:
+        thread_clients += 1
+        threaded_clients.add(client)
+        over_limit = max_clients and thread_clients > max_clients
     try:
+        if over_limit:
+            conn.sendall(b"Error: Server is full")
+            return
+        if timeouts is not None:
+            timeouts.watch(client)
         while True:
-            data = conn.recv(1024)  
+            data = conn.recv(client.reader.recv_size())
             if not data:
                 break  # If no data, client has disconnected; exit loop
-            command_line = data.decode('utf-8', errors='ignore').strip()
-            if not command_line:
-                continue  # Ignore empty commands
-
-            tokens = command_line.split()  
-            cmd = tokens[0].lower()  
-            response = ""  
-
-            # Command: login <UserID> <Password>
-            if cmd == "login":
-                if len(tokens) != 3:
-                    response = "Usage: login <UserID> <Password>"
-                elif logged_in_user:
-                    response = f"Error: Already logged in as {logged_in_user}"
-                else:
-                    user_id = tokens[1]
-                    pwd = tokens[2]
-                    if user_id in users and users[user_id] == pwd:
-                        logged_in_user = user_id  # Mark client as logged in
-                        with active_clients_lock:
-                            active_clients[logged_in_user] = conn  # Add to active clients
-                        with online_order_lock:
-                            online_order.append(logged_in_user)  # Record login order
-                        response = "login confirmed"
-                        print(f"{logged_in_user} login.")
-                        # Notify all other clients that a new user has joined
-                        broadcast_message(f"{logged_in_user} joins.", exclude_conn=conn)
-                    else:
-                        response = "Denied. User name or password incorrect."
-
-            # Command: newuser <UserID> <Password>
-            elif cmd == "newuser":
-                if len(tokens) != 3:
-                    response = "Usage: newuser <UserID> <Password>"
-                elif logged_in_user:
-                    response = "Error: Cannot create new user while logged in"
-                else:
-                    new_user = tokens[1]
-                    new_pwd = tokens[2]
-                    # Enforce length restrictions: UserID must be 3-32 chars, Password 4-8 chars
-                    if len(new_user) < 3 or len(new_user) > 32:
-                        response = "UserID must be 3-32 characters long"
-                    elif len(new_pwd) < 4 or len(new_pwd) > 8:
-                        response = "Password must be 4-8 characters long"
-                    elif new_user in users:
-                        response = "Denied. User account already exists."
-                    else:
-                        users[new_user] = new_pwd  # Add new user to the dictionary
-                        try:
-                            # Ensure the file has proper newline formatting before appending
-                            if os.path.exists(USERFILE):
-                                with open(USERFILE, 'rb+') as f:
-                                    f.seek(0, os.SEEK_END)
-                                    if f.tell() > 0:
-                                        f.seek(-1, os.SEEK_END)
-                                        if f.read(1) != b'\n':
-                                            f.write(b'\n')
-                            with open(USERFILE, 'a') as f:
-                                f.write(f"({new_user}, {new_pwd})\n")
-                            response = "New user account created."
-                            print("New user account created.")
-                        except Exception as e:
-                            # If file writing fails, remove the new user from the dictionary
-                            users.pop(new_user, None)
-                            response = "Error: Could not save new user."
-
-            # Command: send <target> <message>
-            elif cmd == "send":
-                if not logged_in_user:
-                    response = "Denied. Please login first."
-                else:
-                    # Split into at most 3 parts: command, target, and message
-                    parts = command_line.split(' ', 2)
-                    if len(parts) < 2:
-                        response = "Usage: send <target> <message>"
-                    else:
-                        target = parts[1]
-                        # Check if message is for broadcasting to all clients
-                        if target.lower() == "all":
-                            if len(parts) < 3 or parts[2].strip() == "":
-                                response = "Error: Message is empty"
-                            elif len(parts[2]) > 256:
-                                response = "Error: Message must be between 1 and 256 characters long"
-                            else:
-                                message = parts[2]
-                                full_message = f"{logged_in_user}: {message}"
-                                # Broadcast the message to all clients except the sender
-                                broadcast_message(full_message, exclude_conn=conn)
-                                print(full_message)
-                                response = ""
-                        # Unicast: send message to a specific user
-                        else:
-                            if len(parts) < 3 or parts[2].strip() == "":
-                                response = "Error: Message is empty"
-                            elif len(parts[2]) > 256:
-                                response = "Error: Message must be between 1 and 256 characters long"
-                            else:
-                                message = parts[2]
-                                full_message = f"{logged_in_user}: {message}"
-                                with active_clients_lock:
-                                    target_conn = active_clients.get(target)
-                                if target_conn:
-                                    try:
-                                        target_conn.sendall(full_message.encode('utf-8'))
-                                        print(f"{logged_in_user} (to {target}): {message}")
-                                        response = ""
-                                    except Exception as e:
-                                        response = f"Error: Could not send message to {target}."
-                                else:
-                                    response = f"Error: User {target} is not online."
-
-            # Command: who
-            elif cmd == "who":
-                if not logged_in_user:
-                    response = "Denied. Please login first."
-                else:
-                    with online_order_lock:
-                        response = ", ".join(online_order)
-
-            # Command: logout
-            elif cmd == "logout":
-                if not logged_in_user:
-                    response = "Error: You are not logged in"
-                else:
-                    response = f"{logged_in_user} left."
-                    print(f"{logged_in_user} logout.")
-                    # Broadcast to all clients that the user has left
-                    broadcast_message(response, exclude_conn=conn)
-                    with active_clients_lock:
-                        if logged_in_user in active_clients:
-                            del active_clients[logged_in_user]
-                    with online_order_lock:
-                        if logged_in_user in online_order:
-                            online_order.remove(logged_in_user)
-                    # Send the logout confirmation to the client before breaking the loop
-                    conn.sendall(response.encode('utf-8'))
-                    break
+            metrics.bytes_in.inc(len(data))
+            client.last_seen = time.monotonic()
+            if client.closing:
+                break  # Timed out while this data was on its way
+            commands = client.reader.feed(data)
+            if client.reader.framed and not client.framed:
+                # The client asked for the framed or binary protocol; confirm before any response
+                client.framed = True
+                client.binary = client.reader.binary
+                client.enqueue(client.reader.hello)
 
-            # If the command is not recognized, send an error message
-            else:
-                response = "Error: Unknown command"
-
-            # Send the response to the client, if there is any response to send
-            if response:
-                try:
-                    conn.sendall(response.encode('utf-8'))
-                except Exception as e:
-                    print(f"Error sending response to client: {e}")
+            for command_line in commands:
+                if not command_line:
+                    continue  # Ignore empty commands
+
+                response = process_command(client, command_line)
+
+                # Send the response to the client, unless it was already sent
+                if response is not None:
+                    try:
+                        client.respond(response)
+                    except Exception as e:
+                        log.debug(f"Error sending response to client: {e}")
+                        client.closing = True
+                if client.closing:
                     break
+            if client.closing:
+                break
 
-    except Exception as e:
+    except OSError as e:
+        # The connection failed; only this client is affected
+        log.debug(f"Connection from {addr} failed: {e}")
+    except Exception:
         # Catch all exceptions to prevent server crash due to a single client error
-        pass
+        metrics.command_errors.inc()
+        log.exception(f"Error while serving {addr}")
     finally:
         # Clean up: close the connection and remove the user from active lists if necessary
+        disconnect_client(client)
+        client.close()
+        metrics.connections.dec()
+        with thread_clients_lock:
+            thread_clients -= 1
+            threaded_clients.discard(client)
+
+def serve_threaded(server_sock):
+    """
+    Accepts connections forever, spawning a handler thread for each client.
+    """
+    while True:
+        # Accept a new client connection
+        conn, addr = server_sock.accept()
+        tune_socket(conn, TCP_NODELAY, SOCKET_SNDBUF, SOCKET_RCVBUF, IDLE_TIMEOUT_SECONDS)
+        # Start a new thread to handle the client connection
+        threading.Thread(target=handle_client, args=(conn, addr, CLIENT_LIMIT), daemon=True).start()
+
+def say_goodbye(client):
+    """
+    Tells a client the server is shutting down and when to reconnect: a different,
+    random time for every client, so they do not all come back at once.
+    """
+    wait = RECONNECT_AFTER + random.uniform(0, RECONNECT_SPREAD)
+    client.goodbye(f"Server is shutting down. Reconnect in {wait:.1f} seconds.", wait)
+
+def handle_shutdown(start_drain=None):
+    """
+    Makes SIGTERM and the first Ctrl+C start a drain with start_drain(); a second
+    Ctrl+C stops at once and further SIGTERMs are ignored. Without start_drain
+    (threaded mode) the signal ends the accept loop and main() drains. With
+    --drain-timeout 0 both signals stop at once.
+    """
+    def shut_down(signum, frame):
+        global draining
+        if draining or not DRAIN_TIMEOUT:
+            if signum == signal.SIGINT or not DRAIN_TIMEOUT:
+                raise KeyboardInterrupt
+            return
+        draining = True
+        if start_drain is None:
+            raise KeyboardInterrupt
+        start_drain()
+    signal.signal(signal.SIGINT, shut_down)
+    signal.signal(signal.SIGTERM, shut_down)
+
+def schedule_drain():
+    # call_soon_threadsafe() takes a lock the interrupted loop may hold, so it runs on its own thread
+    threading.Thread(target=event_loop.call_soon_threadsafe, args=(drain_event_loop,), name='drain',
+                     daemon=True).start()
+
+def drain_event_loop():
+    """
+    Drains the connections of the event loop, which stops when it is done (see
+    EventLoopServer.drain()).
+    """
+    close_control()  # A server that is shutting down cannot be taken over
+    event_loop.drain(say_goodbye, DRAIN_TIMEOUT, DRAIN_BATCH, DRAIN_INTERVAL)
+
+def drain_threads():
+    """
+    Drains the connections of the threaded mode: tells every client when to reconnect,
+    then closes DRAIN_BATCH connections every DRAIN_INTERVAL seconds once their output
+    is written, and waits for their handler threads. Connections still open after
+    DRAIN_TIMEOUT seconds are dropped.
+    """
+    started = time.monotonic()
+    deadline = started + DRAIN_TIMEOUT
+    with thread_clients_lock:
+        clients = list(threaded_clients)
+    log.warning(f"Draining {len(clients)} connections.")
+    for client in clients:
+        try:
+            say_goodbye(client)
+        except ConnectionError:
+            pass  # Already closed
+    for start in range(0, len(clients), DRAIN_BATCH):
+        if time.monotonic() > deadline:
+            break
+        for client in clients[start:start + DRAIN_BATCH]:
+            client.hang_up()
+        metrics.drain_seconds.set(time.monotonic() - started)
+        time.sleep(DRAIN_INTERVAL)
+    while threaded_clients and time.monotonic() < deadline:
+        metrics.drain_seconds.set(time.monotonic() - started)
+        time.sleep(DRAIN_INTERVAL)
+    with thread_clients_lock:
+        forced = list(threaded_clients)
+    for client in forced:
+        with client.out_ready:
+            client.abort()
+    metrics.drain_forced.inc(len(forced))
+    elapsed = time.monotonic() - started
+    metrics.drain_seconds.set(elapsed)
+    log.warning(f"Drain done in {elapsed:.2f} s; {len(forced)} connections closed by the timeout.")
+
+def parse_args(argv=None):
+    """
+    Parses the server command line options, on top of the settings file if one is given.
+    """
+    parser = make_parser()
+    argv = sys.argv[1:] if argv is None else argv
+    args = parser.parse_args(argv)
+    if args.config:
+        args = parser.parse_args(read_config(args.config) + list(argv))
+    if args.workers > 1:
+        args.mode = 'event'  # Workers always run the event loop
+    return args
+
+def mode_defaults(args):
+    """
+    Returns the connection limit, the listen backlog and the coalescing delay for the
+    selected mode, where the options leave them open.
+    """
+    if args.mode == 'event':
+        max_clients = EVENT_MAX_CLIENTS if args.max_clients is None else args.max_clients
+        backlog = EVENT_BACKLOG if args.backlog is None else args.backlog
+        coalesce_delay = DEFAULT_COALESCE_DELAY
+    else:
+        max_clients = 0 if args.max_clients is None else args.max_clients
+        backlog = MAXCLIENTS if args.backlog is None else args.backlog
+        coalesce_delay = 0.0  # Writer threads batch whatever queued up while they were busy
+    if args.coalesce_ms is not None:
+        coalesce_delay = max(0.0, args.coalesce_ms / 1000)
+    return max_clients, backlog, coalesce_delay
+
+def make_parser():
+    """
+    Returns the parser of the server command line options.
+    """
+    parser = argparse.ArgumentParser(description="Chat room server, version two.")
+    parser.add_argument('--config', default=None,
+                        help="settings file with a [server] section of options, e.g. 'queue-limit = 1048576'; "
+                             "command line options win. SIGHUP or POST /config on the metrics port reloads it")
+    parser.add_argument('--takeover', action='store_true',
+                        help="take the listening socket and every connection over from the running server "
+                             "(event mode, no TLS), which then exits: a restart without disconnecting anybody")
+    parser.add_argument('--control-socket', default=CONTROL_SOCKET,
+                        help="Unix socket a new server process connects to for --takeover, or 'off'")
+    parser.add_argument('--host', default=HOST, help="address to listen on")
+    parser.add_argument('--port', type=int, default=PORT, help="TCP port to listen on")
+    parser.add_argument('--tls-cert', default=None,
+                        help="certificate chain (PEM) to encrypt every connection with TLS; read again on reload")
+    parser.add_argument('--tls-key', default=None,
+                        help="private key (PEM) of --tls-cert, if it is not in the same file")
+    parser.add_argument('--tls-tickets', type=int, default=SESSION_TICKETS,
+                        help="session tickets sent after each TLS 1.3 handshake, for resumed reconnects "
+                             "(0 = no resumption)")
+    parser.add_argument('--tls-workers', type=int, default=HANDSHAKE_WORKERS,
+                        help="threads that run TLS handshakes in the event mode (0 = on the event loop)")
+    parser.add_argument('--mode', choices=('threaded', 'event'), default='threaded',
+                        help="threaded: one thread per client; event: single event loop")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of event-loop worker processes sharing the port")
+    parser.add_argument('--federation-port', type=int, default=0,
+                        help="port on which other chat servers link with this one (0 = off); federation needs "
+                             "--mode event and one worker")
+    parser.add_argument('--peers', default='',
+                        help="federation ports of other chat servers to link with, e.g. 127.0.0.1:29954,127.0.0.1:29955")
+    parser.add_argument('--federation-name', default=None,
+                        help="name of this server among its peers, unique in the federation (default HOST:PORT)")
+    parser.add_argument('--peer-timeout', type=float, default=PEER_TIMEOUT,
+                        help="seconds a federation peer may stay silent before its users are dropped (0 = never)")
+    parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT,
+                        help="seconds a shutdown (SIGTERM or Ctrl+C) may take to tell every client when to reconnect "
+                             "and write out their queued output; a second Ctrl+C stops at once "
+                             "(0 = close every connection at once)")
+    parser.add_argument('--drain-batch', type=int, default=DRAIN_BATCH,
+                        help=f"connections closed every {DRAIN_INTERVAL * 1000:g} ms while draining")
+    parser.add_argument('--reconnect-spread', type=float, default=RECONNECT_SPREAD,
+                        help=f"seconds over which clients are told to reconnect after a shutdown, at random, on top "
+                             f"of {RECONNECT_AFTER:g} s, so they do not all come back at once")
+    parser.add_argument('--max-clients', type=int, default=None,
+                        help="maximum number of concurrent connections per process (0 = unlimited)")
+    parser.add_argument('--backlog', type=int, default=None,
+                        help="listen backlog for pending connections")
+    parser.add_argument('--user-store', default=USERSTORE,
+                        help="account storage, e.g. text:users.txt or sqlite:users.db")
+    parser.add_argument('--user-sync', choices=SYNC_POLICIES, default='batch',
+                        help="when new accounts are forced to disk")
+    parser.add_argument('--auth-workers', type=int, default=AUTH_WORKERS,
+                        help="threads used for password hashing")
+    parser.add_argument('--hash-iterations', type=int, default=HASH_ITERATIONS,
+                        help="PBKDF2 iterations for new password hashes")
+    parser.add_argument('--queue-limit', type=int, default=OUTBOUND_QUEUE_BYTES,
+                        help="bytes a client may fall behind before the slow client policy applies (0 = unlimited)")
+    parser.add_argument('--slow-client-policy', choices=POLICIES, default=SLOW_CLIENT_POLICY,
+                        help="what to do with clients whose outbound queue is full")
+    parser.add_argument('--coalesce-ms', type=float, default=None,
+                        help="milliseconds output waits to be written together with more messages "
+                             f"(0 = write as soon as possible; default {DEFAULT_COALESCE_DELAY * 1000:g} "
+                             "for the event loop, 0 for threads)")
+    parser.add_argument('--tcp-nodelay', choices=('on', 'off'), default='on',
+                        help="disable Nagle's algorithm on client sockets")
+    parser.add_argument('--sndbuf', type=int, default=SOCKET_SNDBUF,
+                        help="kernel send buffer size per client socket in bytes (0 = system default)")
+    parser.add_argument('--rcvbuf', type=int, default=SOCKET_RCVBUF,
+                        help="kernel receive buffer size per client socket in bytes (0 = system default)")
+    parser.add_argument('--login-timeout', type=float, default=LOGIN_TIMEOUT_SECONDS,
+                        help="seconds a connection may take to log in (0 = no limit)")
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT_SECONDS,
+                        help="seconds of silence before framed clients are pinged (0 = never)")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT_SECONDS,
+                        help="seconds of silence before framed clients are disconnected (0 = never)")
+    parser.add_argument('--user-commands', type=parse_limit, default=USER_COMMANDS, metavar='RATE[/BURST]',
+                        help=f"commands per second per user (0 = no limit; default {format_limit(USER_COMMANDS)})")
+    parser.add_argument('--user-bytes', type=parse_limit, default=USER_BYTES, metavar='RATE[/BURST]',
+                        help="bytes per second per user, messages counted once per recipient "
+                             f"(default {format_limit(USER_BYTES)})")
+    parser.add_argument('--global-commands', type=parse_limit, default=GLOBAL_COMMANDS, metavar='RATE[/BURST]',
+                        help="commands per second for the whole server (default no limit)")
+    parser.add_argument('--global-bytes', type=parse_limit, default=GLOBAL_BYTES, metavar='RATE[/BURST]',
+                        help="bytes per second for the whole server (default no limit); with --metrics-port "
+                             "every limit can be changed at runtime with POST /limits?user_commands=RATE/BURST")
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="serve Prometheus metrics over HTTP on this local port (0 = off); "
+                             "worker N of --workers uses this port + N")
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default=DEFAULT_LEVEL,
+                        help="info logs every message, warning keeps only problems")
+    parser.add_argument('--mailbox', default=MAILBOX_DIR,
+                        help="directory for offline messages, or 'off' to refuse messages to offline users")
+    parser.add_argument('--mailbox-limit', type=int, default=MAX_MESSAGES,
+                        help="offline messages kept per user; older ones are dropped (0 = unlimited)")
+    parser.add_argument('--mailbox-retention', type=float, default=RETENTION / 86400,
+                        help="days an offline message is kept (0 = forever)")
+    parser.add_argument('--mailbox-max-bytes', type=int, default=MAX_BYTES,
+                        help="total size of the offline message logs (0 = unlimited)")
+    parser.add_argument('--mailbox-sync', choices=SYNC_POLICIES, default='batch',
+                        help="when offline messages are forced to disk")
+    parser.add_argument('--history', default=HISTORY_DIR,
+                        help="directory of the message history log, or 'off'")
+    parser.add_argument('--history-retention', type=float, default=chat_history.RETENTION / 86400,
+                        help="days a message is kept in the history (0 = forever)")
+    parser.add_argument('--history-max-bytes', type=int, default=chat_history.MAX_BYTES,
+                        help="total size of the history segments; the oldest are dropped beyond it (0 = unlimited)")
+    parser.add_argument('--history-sync', choices=SYNC_POLICIES, default='batch',
+                        help="when history records are forced to disk")
+    parser.add_argument('--capture', metavar='FILE',
+                        help="record every received command with its time and connection to FILE, "
+                             "for chat_replay.py (FILE.N for worker N of --workers); replaces an existing file")
+    return parser
+
+def open_services(args):
+    """
+    Opens the account store, the password verification pool and the rate limiter.
+    """
+    global user_store, authenticator
+    # Open the account store; a new sqlite store imports the legacy users file once
+    try:
+        user_store = open_user_store(args.user_store, sync=args.user_sync, legacy_file=USERFILE)
+    except Exception as e:
+        print(f"Failed to open user store {args.user_store}: {e}")
+        sys.exit(1)
+    authenticator = Authenticator(workers=args.auth_workers, iterations=args.hash_iterations)
+    open_limiter(args)
+
+def open_capture(path):
+    """
+    Starts recording the received commands, if a capture file is configured.
+    """
+    global capture
+    if not path:
+        return
+    try:
+        capture = TrafficCapture(path)
+    except OSError as e:
+        print(f"Failed to open capture file {path}: {e}")
+        sys.exit(1)
+
+def open_history(args):
+    """
+    Opens the message history log, or returns None if it is turned off.
+    """
+    if HISTORY_DIR is None:
+        return None
+    try:
+        return chat_history.History(HISTORY_DIR, sync=args.history_sync,
+                                    retention=args.history_retention * 86400, max_bytes=args.history_max_bytes)
+    except OSError as e:
+        print(f"Failed to open history directory {HISTORY_DIR}: {e}")
+        sys.exit(1)
+
+def open_limiter(args):
+    """
+    Creates the rate limiter. Server-wide limits are split evenly between worker processes.
+    """
+    global limiter
+    limiter = RateLimiter(**limit_settings(args))
+    metrics.register_settings('/limits', limiter)
+
+def limit_settings(args):
+    workers = max(1, args.workers)
+    return {'user_commands': args.user_commands, 'user_bytes': args.user_bytes,
+            'global_commands': tuple(value / workers for value in args.global_commands),
+            'global_bytes': tuple(value / workers for value in args.global_bytes)}
+
+def open_mailbox(args):
+    """
+    Opens the offline message store, or returns None if it is turned off.
+    """
+    if MAILBOX_DIR is None:
+        return None
+    try:
+        return Mailbox(MAILBOX_DIR, sync=args.mailbox_sync, max_messages=args.mailbox_limit,
+                       retention=args.mailbox_retention * 86400, max_bytes=args.mailbox_max_bytes)
+    except (OSError, ValueError) as e:
+        print(f"Failed to open mailbox directory {MAILBOX_DIR}: {e}")
+        sys.exit(1)
+
+def start_metrics(port):
+    """
+    Publishes the server metrics on the local admin endpoint, if a port is configured.
+    """
+    metrics.online_users.function = lambda: len(presence)
+    metrics.queued_bytes.function = lambda: sum(client.outq.pending() for client in presence.recipients())
+    global metrics_server
+    if not port:
+        return
+    try:
+        metrics_server = metrics.start_metrics_server('127.0.0.1', port)
+    except OSError as e:
+        log.warning(f"Failed to start metrics endpoint on port {port}: {e}")
+
+def close_services():
+    close_stores()
+    stop_logging()  # Write out queued log lines
+
+def close_stores():
+    """
+    Closes the account store, the password pool, the message stores and the capture.
+    Safe to call again, e.g. after they were released for a new server process.
+    """
+    global authenticator, user_store, mailbox, history, capture
+    if capture is not None:
+        capture.close()
+        capture = None
+    if authenticator is not None:
+        authenticator.close()
+        authenticator = None
+    if user_store is not None:
+        user_store.close()  # Write out any accounts that are not on disk yet
+        user_store = None
+    if mailbox is not None:
+        mailbox.close()
+        mailbox = None
+    if history is not None:
+        history.close()
+        history = None
+
+# Settings a reload applies while the server runs; every other change needs a restart
+LIVE_SETTINGS = ('log_level', 'max_clients', 'coalesce_ms', 'queue_limit', 'slow_client_policy', 'tcp_nodelay',
+                 'sndbuf', 'rcvbuf', 'login_timeout', 'heartbeat', 'idle_timeout', 'hash_iterations', 'drain_timeout',
+                 'drain_batch', 'reconnect_spread') + LIMITS
+MAILBOX_SETTINGS = ('mailbox_limit', 'mailbox_retention', 'mailbox_max_bytes')
+HISTORY_SETTINGS = ('history_retention', 'history_max_bytes')
+
+def watch_settings(args, argv, schedule=None):
+    """
+    Reloads the settings file and the accounts on SIGHUP and on POST /config.
+    'schedule(func)' runs a reload on the event loop thread; threaded servers reload in place.
+    """
+    global reloader
+    reloader = Reloader(args, lambda: parse_args(argv), apply_settings, schedule)
+    metrics.register_settings('/config', reloader)
+    if hasattr(signal, 'SIGHUP'):
+        # A reload takes locks the interrupted code may hold, so it runs on its own thread
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+            target=reloader.request_reload, name='reload', daemon=True).start())
+
+def apply_settings(old, new):
+    """
+    Puts reloaded settings into effect and reloads the accounts. Returns the names of
+    changed settings that only take effect after a restart.
+    """
+    global CLIENT_LIMIT, COALESCE_DELAY, OUTBOUND_QUEUE_BYTES, SLOW_CLIENT_POLICY
+    global TCP_NODELAY, SOCKET_SNDBUF, SOCKET_RCVBUF, LOGIN_TIMEOUT_SECONDS, HEARTBEAT_SECONDS, IDLE_TIMEOUT_SECONDS
+    global DRAIN_TIMEOUT, DRAIN_BATCH, RECONNECT_SPREAD
+    live = set(LIVE_SETTINGS)
+    # The message stores live in the router process in the multi-worker mode
+    if mailbox is not None or MAILBOX_DIR is None:
+        live.update(MAILBOX_SETTINGS)
+    if history is not None or HISTORY_DIR is None:
+        live.update(HISTORY_SETTINGS)
+    timers = ('login_timeout', 'heartbeat', 'idle_timeout')
+    if timeouts is None and any(getattr(new, name) for name in timers):
+        live.difference_update(timers)  # No timers are running to pick them up
+    restart = [name for name in vars(new) if name not in live and getattr(old, name, None) != getattr(new, name)]
+    for name in restart:
+        setattr(new, name, getattr(old, name))
+
+    log.setLevel(new.log_level.upper())
+    CLIENT_LIMIT, _, COALESCE_DELAY = mode_defaults(new)
+    OUTBOUND_QUEUE_BYTES = new.queue_limit
+    SLOW_CLIENT_POLICY = new.slow_client_policy
+    # Socket options apply to connections accepted from now on
+    TCP_NODELAY = new.tcp_nodelay == 'on'
+    SOCKET_SNDBUF = new.sndbuf
+    SOCKET_RCVBUF = new.rcvbuf
+    LOGIN_TIMEOUT_SECONDS = new.login_timeout
+    HEARTBEAT_SECONDS = new.heartbeat
+    IDLE_TIMEOUT_SECONDS = new.idle_timeout
+    DRAIN_TIMEOUT, DRAIN_BATCH, RECONNECT_SPREAD = drain_settings(new)
+    if event_loop is not None:
+        event_loop.max_clients = CLIENT_LIMIT
+        event_loop.coalesce_delay = COALESCE_DELAY
+        event_loop.queue_limit = OUTBOUND_QUEUE_BYTES
+        event_loop.slow_client_policy = SLOW_CLIENT_POLICY
+        event_loop.socket_options = (TCP_NODELAY, SOCKET_SNDBUF, SOCKET_RCVBUF, IDLE_TIMEOUT_SECONDS)
+    if timeouts is not None:
+        # Every connection's next check uses the new values
+        timeouts.login_timeout = LOGIN_TIMEOUT_SECONDS
+        timeouts.heartbeat = HEARTBEAT_SECONDS
+        timeouts.idle_timeout = IDLE_TIMEOUT_SECONDS
+    limiter.configure(**limit_settings(new))
+    authenticator.iterations = new.hash_iterations
+    if TLS_CONTEXT is not None:
+        # A renewed certificate is used for new handshakes; open connections keep theirs
+        try:
+            TLS_CONTEXT.load_cert_chain(new.tls_cert, new.tls_key)
+        except (OSError, ssl.SSLError) as e:
+            log.error(f"Failed to reload the TLS certificate, keeping the old one: {e}")
+    if mailbox is not None:
+        mailbox.max_messages = new.mailbox_limit
+        mailbox.retention = new.mailbox_retention * 86400
+        mailbox.max_bytes = new.mailbox_max_bytes
+    if history is not None:
+        history.retention = new.history_retention * 86400
+        history.max_bytes = new.history_max_bytes
+
+    try:
+        added, changed, removed = user_store.reload()
+    except Exception as e:
+        log.error(f"Failed to reload the user store: {e}")
+    else:
+        log.warning(f"Accounts reloaded: {added} added, {changed} changed, {removed} removed.")
+    return restart
+
+def drain_settings(args):
+    return max(0.0, args.drain_timeout), max(1, args.drain_batch), max(0.0, args.reconnect_spread)
+
+def make_timeouts(call_later=None):
+    """
+    Returns the login, heartbeat and idle timeouts, or None if all of them are off.
+    Without call_later (threaded mode) the timers run on a new timer thread.
+    """
+    if not (LOGIN_TIMEOUT_SECONDS or HEARTBEAT_SECONDS or IDLE_TIMEOUT_SECONDS):
+        return None
+    if call_later is None:
+        call_later = TimerThread().call_later
+    return ConnectionTimeouts(call_later, login_timeout=LOGIN_TIMEOUT_SECONDS,
+                              heartbeat=HEARTBEAT_SECONDS, idle_timeout=IDLE_TIMEOUT_SECONDS)
+
+def make_event_loop(server_sock, max_clients):
+    global event_loop, timeouts
+    import chat_eventloop
+    loop = chat_eventloop.EventLoopServer(server_sock, process_command, disconnect_client,
+                                          max_clients=max_clients,
+                                          queue_limit=OUTBOUND_QUEUE_BYTES,
+                                          slow_client_policy=SLOW_CLIENT_POLICY,
+                                          coalesce_delay=COALESCE_DELAY, nodelay=TCP_NODELAY,
+                                          sndbuf=SOCKET_SNDBUF, rcvbuf=SOCKET_RCVBUF,
+                                          keepalive=IDLE_TIMEOUT_SECONDS, tls=TLS_CONTEXT,
+                                          handshake_pool=handshake_pool(TLS_WORKERS) if TLS_CONTEXT else None)
+    timeouts = make_timeouts(loop.call_later)
+    if timeouts is not None:
+        loop.on_connect = timeouts.watch
+    event_loop = loop
+    return loop
+
+def start_federation(args, loop, peers):
+    """
+    Opens the federation port and dials the peers of this server.
+    """
+    global federation
+    listen_address = (HOST, args.federation_port) if args.federation_port else None
+    try:
+        federation = Federation(args.federation_name or f"{HOST}:{PORT}", loop, presence, rooms, deliver_from_peer,
+                                lambda fields: broadcast_local(SharedMessage(*fields)),
+                                lambda room, fields: room_local(room, SharedMessage(*fields)),
+                                listen_address=listen_address, peers=peers, timeout=args.peer_timeout)
+    except OSError as e:
+        print(f"Failed to open federation port {args.federation_port}: {e}")
+        sys.exit(1)
+
+def serve_worker(args, argv, worker_id, listen_sock, bus_sock):
+    """
+    Runs one worker process of the multi-worker mode.
+    """
+    global bus
+    import chat_workers
+    setup_logging(args.log_level)  # The parent's log writer thread does not survive fork()
+    open_services(args)
+    open_capture(args.capture and f"{args.capture}.{worker_id}")
+    start_metrics(args.metrics_port and args.metrics_port + worker_id)
+    try:
+        loop = make_event_loop(listen_sock, CLIENT_LIMIT)
+        watch_settings(args, argv, loop.call_soon_threadsafe)
+        handle_shutdown(schedule_drain)
+        bus = chat_workers.WorkerBus(bus_sock, loop, presence, deliver_local,
+                                     lambda fields: broadcast_local(SharedMessage(*fields)),
+                                     mail=deliver_mail_local, rooms=rooms,
+                                     room_deliver=lambda room, fields: room_local(room, SharedMessage(*fields)))
+        loop.serve_forever()
+    finally:
+        close_services()
+
+def open_control(path):
+    """
+    Listens on the control socket for a new server process to hand over to.
+    """
+    global control_sock
+    if path == 'off':
+        return
+    try:
+        control_sock = listen_control(path)
+    except OSError as e:
+        log.warning(f"Failed to open control socket {path}: {e}")
+        return
+    event_loop.add_handler(control_sock, accept_takeover)
+
+def close_control():
+    global control_sock
+    if control_sock is None:
+        return
+    path = control_sock.getsockname()
+    control_sock.close()
+    control_sock = None
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def accept_takeover(mask):
+    """
+    Control socket handler: a new server process asks for the connections. New
+    commands are held back until the ones in progress are done, then everything is
+    handed over.
+    """
+    conn, _ = control_sock.accept()
+    conn.settimeout(HANDOFF_TIMEOUT)
+    try:
+        message, fds = recv_message(conn)
+        for fd in fds:
+            os.close(fd)
+        if message[0] != 'takeover':
+            raise HandoffError(f"unexpected control message '{message[0]}'")
+    except OSError as e:
+        log.warning(f"Bad control connection: {e}")
+        conn.close()
+        return
+    log.warning(f"Process {message[1]} takes over; handing over {len(event_loop.clients)} connections.")
+    event_loop.freeze()
+    wait_for_handoff(conn, time.monotonic() + QUIESCE_TIMEOUT)
+
+def wait_for_handoff(conn, deadline):
+    if event_loop.quiescent():
+        finish_handoff(conn)
+    elif time.monotonic() > deadline:
+        # Handing over now would lose the results of the commands still running
+        log.warning("Takeover cancelled: commands still in progress.")
         conn.close()
-        if logged_in_user:
-            with active_clients_lock:
-                if logged_in_user in active_clients:
-                    del active_clients[logged_in_user]
-            with online_order_lock:
-                if logged_in_user in online_order:
-                    online_order.remove(logged_in_user)
+        event_loop.thaw()
+    else:
+        event_loop.call_later(0.01, wait_for_handoff, conn, deadline)
 
-def main():
+def finish_handoff(conn):
+    """
+    Passes the listening socket and every connection to the new process, then closes
+    the stores for it and stops the loop. Nothing is handed over if the new process
+    fails before it has everything; this one then simply goes on.
+    """
+    loop = event_loop
+    clients = list(loop.clients.values())
+    for client in clients:
+        loop.flush(client, resume=False)  # Less to carry over
+    loop.close_pending()
+    # Logged in users first, in login order, so the new process lists them the same way
+    order = {client: position for position, client in enumerate(presence.recipients())}
+    clients = sorted((client for client in clients if not client.closed), key=lambda c: order.get(c, len(order)))
+    states = [client_state(client) for client in clients]
+    shared = {'user_ids': USER_IDS.names()}
+    released = False
+
+    def release():
+        # The new process opens the stores and the admin endpoint as soon as this returns
+        nonlocal released
+        released = True
+        close_stores()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        close_control()
+
+    try:
+        hand_over(conn, loop.server_sock, [(client.sock, state) for client, state in zip(clients, states)],
+                  shared, release)
+    except Exception as e:
+        if not released:
+            log.warning(f"Takeover failed: {e}")
+            for client, state in zip(clients, states):
+                client.outq.extend(state[5])  # Put back the output that was taken for the new process
+                loop.flush(client)
+            loop.thaw()
+            return
+        log.exception("Failed to close the stores for the new process")
+    finally:
+        conn.close()
+    for client in loop.detach():
+        client.sock.close()  # The new process has its own descriptors
+    log.warning("Handed over to the new process; exiting.")
+
+def client_state(client):
+    """
+    Returns what the new process needs to continue a connection (see adopt_clients()).
+    """
+    output = client.outq.take_all()
+    if client.streaming is not None:
+        output += list(client.streaming)
+        client.streaming = None
+        client.busy = False
+    defined = sorted(client.binary.defined) if client.binary is not None else []
+    joined = rooms.rooms_of(client.user) if client.user is not None else []
+    return (client.addr, client.user, client.reader.state(), defined, list(client.commands), output, joined,
+            client.closing)
+
+def adopt_clients(loop, handed, shared):
+    """
+    Continues serving the connections handed over by the previous server process.
+    """
+    # Same ids as before, so binary clients keep the names they were told
+    for name in shared['user_ids']:
+        USER_IDS.intern(name)
+    adopted = []
+    for sock, state in handed:
+        addr, user, reader_state, defined, commands, output, joined, closing = state
+        client = loop.adopt(sock, tuple(addr))
+        client.reader, received = CommandReader.restore(reader_state)
+        if client.reader.framed:
+            client.framed = True
+            client.binary = client.reader.binary
+            if client.binary is not None:
+                client.binary.defined.update(defined)
+        if user is not None:
+            client.login(user)
+            presence.add(user, client)
+            for room in joined:
+                rooms.join(room, user, client)
+        client.outq.extend(output)
+        client.commands.extend(commands + received)
+        client.closing = closing
+        adopted.append(client)
+    for client in adopted:
+        loop.flush(client)
+        loop.run_commands(client)
+    loop.close_pending()
+    log.warning(f"Took over {len(adopted)} connections.")
+
+def main(argv=None):
     """
     Main function to start the chat server.
     It creates a socket, binds to the specified host and port,
-    listens for incoming client connections, and spawns a new thread for each client.
+    listens for incoming client connections, and serves them with the selected mode.
+    With --takeover the socket and the connections come from the running server instead.
     """
-    # Create a TCP/IP socket
-    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # Set socket options to allow reusing the address (prevents "address already in use" errors)
-    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    global OUTBOUND_QUEUE_BYTES, SLOW_CLIENT_POLICY, HOST, PORT, MAILBOX_DIR, mailbox, HISTORY_DIR, history
+    global COALESCE_DELAY, TCP_NODELAY, SOCKET_SNDBUF, SOCKET_RCVBUF, CLIENT_LIMIT, timeouts
+    global LOGIN_TIMEOUT_SECONDS, HEARTBEAT_SECONDS, IDLE_TIMEOUT_SECONDS, TLS_CONTEXT, TLS_WORKERS
+    global DRAIN_TIMEOUT, DRAIN_BATCH, RECONNECT_SPREAD
     try:
-        # Bind the socket to the configured host and port
-        server_sock.bind((HOST, PORT))
-    except Exception as e:
-        print(f"Failed to bind server on port {PORT}: {e}")
+        args = parse_args(argv)
+    except (OSError, ValueError, configparser.Error) as e:
+        print(f"Failed to read the settings file: {e}")
         sys.exit(1)
-    # Start listening for incoming connections with a limit of MAXCLIENTS in the queue
-    server_sock.listen(MAXCLIENTS)
+    HOST = args.host
+    PORT = args.port
+    OUTBOUND_QUEUE_BYTES = args.queue_limit
+    SLOW_CLIENT_POLICY = args.slow_client_policy
+    TCP_NODELAY = args.tcp_nodelay == 'on'
+    SOCKET_SNDBUF = args.sndbuf
+    SOCKET_RCVBUF = args.rcvbuf
+    LOGIN_TIMEOUT_SECONDS = args.login_timeout
+    HEARTBEAT_SECONDS = args.heartbeat
+    IDLE_TIMEOUT_SECONDS = args.idle_timeout
+    DRAIN_TIMEOUT, DRAIN_BATCH, RECONNECT_SPREAD = drain_settings(args)
+    MAILBOX_DIR = None if args.mailbox == 'off' else args.mailbox
+    HISTORY_DIR = None if args.history == 'off' else args.history
+    setup_logging(args.log_level)
+    CLIENT_LIMIT, backlog, COALESCE_DELAY = mode_defaults(args)
+    TLS_WORKERS = args.tls_workers
+    if args.tls_cert:
+        if args.takeover:
+            # The TLS state of a connection cannot move to another process
+            print("--takeover does not work with --tls-cert")
+            sys.exit(1)
+        try:
+            # Created before workers are forked, so all of them accept each other's session tickets
+            TLS_CONTEXT = server_context(args.tls_cert, args.tls_key, args.tls_tickets)
+        except (OSError, ssl.SSLError) as e:
+            print(f"Failed to load the TLS certificate: {e}")
+            sys.exit(1)
+
+    peers = []
+    if args.federation_port or args.peers:
+        if args.mode != 'event' or args.workers > 1 or args.takeover:
+            print("Federation (--federation-port, --peers) needs --mode event, one worker and no --takeover")
+            sys.exit(1)
+        try:
+            peers = [parse_address(peer) for peer in args.peers.split(',') if peer.strip()]
+        except ValueError:
+            print(f"Invalid --peers {args.peers}; expected HOST:PORT[,HOST:PORT...]")
+            sys.exit(1)
+
+    if args.workers > 1:
+        import chat_workers
+        if not args.user_store.startswith('sqlite:') and not args.user_store.endswith('.db'):
+            # Every worker would keep its own copy of users.txt and miss the others' new accounts
+            print("Multiple workers need a shared user store, e.g. --user-store sqlite:users.db")
+            sys.exit(1)
+        print(f"\nMy chat room server. Version Two. ({args.workers} workers)\n")
+        try:
+            chat_workers.run_workers(args.workers,
+                                     lambda *worker: serve_worker(args, argv, *worker),
+                                     HOST, PORT, backlog, open_mailbox=lambda: open_mailbox(args),
+                                     open_history=lambda: open_history(args))
+        except OSError as e:
+            print(f"Failed to bind server on port {PORT}: {e}")
+            sys.exit(1)
+        finally:
+            stop_logging()
+        return
+
+    handed = None
+    if args.takeover:
+        if args.mode != 'event':
+            print("--takeover needs --mode event")
+            sys.exit(1)
+        try:
+            server_sock, handed, shared = take_over(args.control_socket)
+        except (OSError, ValueError) as e:
+            print(f"Failed to take over from the server on {args.control_socket}: {e}")
+            sys.exit(1)
+    else:
+        # Create a TCP/IP socket
+        server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Set socket options to allow reusing the address (prevents "address already in use" errors)
+        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            # Bind the socket to the configured host and port
+            server_sock.bind((HOST, PORT))
+        except Exception as e:
+            print(f"Failed to bind server on port {PORT}: {e}")
+            sys.exit(1)
+    open_services(args)
+    mailbox = open_mailbox(args)
+    history = open_history(args)
+    open_capture(args.capture)
+    start_metrics(args.metrics_port)
+    if handed is None:
+        # Start listening for incoming connections with the configured backlog
+        server_sock.listen(backlog)
     print("\nMy chat room server. Version Two.\n")
     try:
-        while True:
-            # Accept a new client connection
-            conn, addr = server_sock.accept()
-            # Start a new thread to handle the client connection
-            threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+        if args.mode == 'event':
+            loop = make_event_loop(server_sock, CLIENT_LIMIT)
+            if handed is not None:
+                adopt_clients(loop, handed, shared)
+            if args.federation_port or peers:
+                start_federation(args, loop, peers)
+            elif TLS_CONTEXT is None:
+                # Federation links and TLS state cannot be handed to another process
+                open_control(args.control_socket)
+            watch_settings(args, argv, loop.call_soon_threadsafe)
+            handle_shutdown(schedule_drain)
+            loop.serve_forever()
+        else:
+            timeouts = make_timeouts()
+            watch_settings(args, argv)
+            handle_shutdown()
+            serve_threaded(server_sock)
     except KeyboardInterrupt:
         # Allow graceful shutdown on Ctrl+C
         pass
     server_sock.close()  # Close the server socket when done
+    if draining and args.mode != 'event':
+        try:
+            drain_threads()
+        except KeyboardInterrupt:
+            pass  # Ctrl+C again: stop at once
+    close_control()
+    close_services()
 
 # Entry point of the program
 if __name__ == "__main__":
@@ -0,0 +1,260 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Timers for the chat room server.
+A hierarchical timer wheel keeps every pending timer in a bucket of its level, so
+scheduling and cancelling cost O(1) and advancing the clock only looks at timers
+that are due, whether there are ten connections or 100,000. The event loop advances
+its own wheel; the threaded mode shares one wheel driven by a single timer thread.
+ConnectionTimeouts uses it for login timeouts, heartbeats and idle timeouts with at
+most one pending timer per connection.
+'''
+
+# Using Python version 3.12.0
+
+import threading
+import time
+
+from chat_logging import log
+
+# Seconds per tick of the lowest level; timers fire at most this late
+TICK = 0.25
+# Buckets per level (a power of two) and number of levels:
+# 64**4 ticks of 0.25 seconds cover about 48 days, later timers are re-armed on the way
+WHEEL_BITS = 6
+WHEEL_LEVELS = 4
+
+# Default connection timeouts in seconds (0 turns one off)
+LOGIN_TIMEOUT = 60.0
+HEARTBEAT_INTERVAL = 30.0
+IDLE_TIMEOUT = 90.0
+
+
+class Timer:
+    """
+    One scheduled call. cancel() is O(1): the timer is only marked and skipped when
+    its bucket comes up.
+    """
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel on the time.monotonic() clock. Level 0 has one bucket per
+    tick; every bucket of level N spans a whole turn of level N-1, and its timers
+    cascade down one level when their turn comes. Not thread-safe by itself.
+    """
+    def __init__(self, tick=TICK, bits=WHEEL_BITS, levels=WHEEL_LEVELS, now=None):
+        self.tick = tick
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.levels = levels
+        self.wheels = [[[] for _ in range(1 << bits)] for _ in range(levels)]
+        self.current = int((time.monotonic() if now is None else now) / tick)
+        self.count = 0  # Pending timers, including cancelled ones not swept yet
+
+    def __len__(self):
+        return self.count
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedules callback(*args) in 'delay' seconds and returns its Timer.
+        """
+        timer = Timer(time.monotonic() + delay, callback, args)
+        self.insert(timer)
+        return timer
+
+    def insert(self, timer, earliest=None):
+        """
+        Puts a timer in the bucket of the tick at which it is due. That is never the
+        current tick, which has been run already, except for timers cascading down
+        right before the current bucket is run.
+        """
+        expires = int(timer.deadline / self.tick) + 1
+        expires = max(expires, self.current + 1 if earliest is None else earliest)
+        diff = expires - self.current
+        level = 0
+        while level < self.levels - 1 and diff >= 1 << (self.bits * (level + 1)):
+            level += 1
+        if diff >= 1 << (self.bits * self.levels):
+            # Beyond the range of the wheel: park it as far out as possible
+            expires = self.current + (1 << (self.bits * self.levels)) - 1
+        self.wheels[level][(expires >> (self.bits * level)) & self.mask].append(timer)
+        self.count += 1
+
+    def timeout(self, now=None):
+        """
+        Returns the seconds until the next tick with pending timers may be due,
+        or None if there are no timers. Suitable as a select() timeout.
+        """
+        if not self.count:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, (self.current + 1) * self.tick - now)
+
+    def advance(self, now=None):
+        """
+        Moves the wheel up to 'now' and returns the timers that are due, in no
+        particular order. The caller runs them.
+        """
+        target = int((time.monotonic() if now is None else now) / self.tick)
+        due = []
+        if not self.count:
+            self.current = max(self.current, target)
+            return due
+        mask = self.mask
+        wheel = self.wheels[0]
+        while self.current < target and self.count:
+            self.current += 1
+            index = self.current & mask
+            if index == 0:
+                self.cascade(1)
+            bucket = wheel[index]
+            if bucket:
+                wheel[index] = []
+                self.count -= len(bucket)
+                for timer in bucket:
+                    if timer.cancelled:
+                        continue
+                    if timer.deadline > (self.current + 1) * self.tick:
+                        self.insert(timer)  # Parked beyond the range of the wheel
+                    else:
+                        due.append(timer)
+        self.current = max(self.current, target)
+        return due
+
+    def cascade(self, level):
+        """
+        Moves the timers of the bucket that came up on 'level' down to lower levels.
+        """
+        if level >= self.levels:
+            return
+        index = (self.current >> (self.bits * level)) & self.mask
+        if index == 0:
+            self.cascade(level + 1)
+        bucket = self.wheels[level][index]
+        if bucket:
+            self.wheels[level][index] = []
+            self.count -= len(bucket)
+            for timer in bucket:
+                if not timer.cancelled:
+                    self.insert(timer, self.current)
+
+    def run_due(self, now=None):
+        """
+        Runs every timer that is due. Returns the number of timers run.
+        """
+        due = self.advance(now)
+        for timer in due:
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+        return len(due)
+
+
+class TimerThread:
+    """
+    One background thread running a shared TimerWheel; call_later() may be used from
+    any thread. Callbacks run on the timer thread and must not block for long.
+    """
+    def __init__(self, tick=TICK, name='timers'):
+        self.wheel = TimerWheel(tick)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(time.monotonic() + delay, callback, args)
+        with self.lock:
+            self.wheel.insert(timer)
+        return timer
+
+    def run(self):
+        while not self.stopped.wait(self.wheel.tick):
+            with self.lock:
+                due = self.wheel.advance()
+            for timer in due:
+                if timer.cancelled:
+                    continue
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    log.exception("Timer callback failed")
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class ConnectionTimeouts:
+    """
+    Login, heartbeat and idle deadlines of every connection.
+    Receiving data only stores a timestamp on the connection (client.last_seen); the
+    connection's single timer checks it when it fires and re-arms itself for the next
+    deadline, so busy connections cost nothing per message.
+    A connection that has not logged in after 'login_timeout' seconds is closed.
+    Connections that can answer heartbeats (client.framed) are pinged after
+    'heartbeat' seconds of silence and closed after 'idle_timeout' seconds.
+    Clients provide user, framed, closed, last_seen, ping() and expire(text).
+    """
+    def __init__(self, call_later, login_timeout=LOGIN_TIMEOUT, heartbeat=HEARTBEAT_INTERVAL,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.call_later = call_later
+        self.login_timeout = login_timeout
+        self.heartbeat = heartbeat
+        self.idle_timeout = idle_timeout
+
+    def watch(self, client):
+        """
+        Starts watching a new connection.
+        """
+        now = time.monotonic()
+        client.connected = client.last_seen = now
+        client.pinged = 0.0  # When the last heartbeat was sent
+        self.arm(client, now)
+
+    def arm(self, client, now):
+        deadlines = []
+        if self.login_timeout and client.user is None:
+            deadlines.append(client.connected + self.login_timeout)
+        # Whether the client can answer heartbeats is only known after its first bytes
+        if client.framed or client.user is None:
+            if self.heartbeat and client.pinged < client.last_seen:
+                deadlines.append(client.last_seen + self.heartbeat)
+            else:
+                # Waiting for the answer to a ping: look again after one more interval
+                if self.heartbeat:
+                    deadlines.append(client.pinged + self.heartbeat)
+                if self.idle_timeout:
+                    deadlines.append(client.last_seen + self.idle_timeout)
+        if deadlines:
+            self.call_later(max(0.0, min(deadlines) - now), self.check, client)
+
+    def check(self, client):
+        """
+        Timer callback: enforces whatever deadline has passed, then re-arms.
+        """
+        if client.closed:
+            return
+        now = time.monotonic()
+        if self.login_timeout and client.user is None and now - client.connected >= self.login_timeout:
+            client.expire("Error: Login timed out.")
+            return
+        if client.framed:
+            idle = now - client.last_seen
+            if self.idle_timeout and idle >= self.idle_timeout:
+                client.expire("Error: Connection timed out.")
+                return
+            if self.heartbeat and idle >= self.heartbeat and client.pinged < client.last_seen:
+                client.pinged = now
+                client.ping()
+        self.arm(client, now)
@@ -0,0 +1,184 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: TLS for the chat room server and clients (stdlib ssl).
+The server encrypts every connection on its port when it is given a certificate.
+Handshakes do not hold up other connections: the event loop drives them without
+blocking and runs their expensive steps in a small thread pool (OpenSSL releases
+the GIL while it computes), and the threaded mode does them on the connection's
+own thread. Clients offer the session of their last connection to the same server,
+so a reconnect is resumed with a session ticket instead of a full handshake. The
+ticket keys belong to the server's SSL context, which is created before worker
+processes are forked, so a ticket from one worker is accepted by all of them.
+'''
+
+# Using Python version 3.12.0
+
+import selectors
+import socket
+import ssl
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Oldest protocol version accepted on either side
+MINIMUM_VERSION = ssl.TLSVersion.TLSv1_2
+# Session tickets the server sends after each TLS 1.3 handshake
+SESSION_TICKETS = 2
+# Threads for the expensive handshake steps of the event loop (0 = run them on the loop)
+HANDSHAKE_WORKERS = 2
+# Seconds a connection of the threaded mode may take for its handshake
+HANDSHAKE_TIMEOUT = 10.0
+
+
+def server_context(certfile, keyfile=None, tickets=SESSION_TICKETS):
+    """
+    Returns the server's SSL context for a certificate chain in PEM format; the
+    private key may be in the same file.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = MINIMUM_VERSION
+    context.load_cert_chain(certfile, keyfile)
+    context.num_tickets = tickets
+    return context
+
+
+class ResumingSocket(ssl.SSLSocket):
+    """
+    SSLSocket that leaves its session to its context when it is closed.
+    """
+    def close(self):
+        latest = self.context.latest
+        if not self.server_side and latest.get(self.server_hostname) is self:
+            latest[self.server_hostname] = self.session  # Gone once the socket is closed
+        super().close()
+
+
+class ResumingContext(ssl.SSLContext):
+    """
+    Client SSL context that offers the session of the latest connection to a server
+    when it connects there again. Works for blocking sockets (wrap_socket) and for
+    asyncio connections (wrap_bio).
+    """
+    sslsocket_class = ResumingSocket
+
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT):
+        super().__init__()
+        # Latest connection (or the session of a closed socket) per server name; a
+        # connection's session includes the tickets received since its handshake
+        self.latest = {}
+
+    def session_for(self, server_hostname):
+        previous = self.latest.get(server_hostname)
+        if previous is None or isinstance(previous, ssl.SSLSession):
+            return previous
+        return previous.session
+
+    def wrap_socket(self, sock, server_side=False, do_handshake_on_connect=True, suppress_ragged_eofs=True,
+                    server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.session_for(server_hostname)
+        wrapped = super().wrap_socket(sock, server_side, do_handshake_on_connect, suppress_ragged_eofs,
+                                      server_hostname, session)
+        if not server_side:
+            self.latest[server_hostname] = wrapped
+        return wrapped
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.session_for(server_hostname)
+        wrapped = super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+        if not server_side:
+            self.latest[server_hostname] = wrapped
+        return wrapped
+
+
+def client_context(cafile=None, verify=True):
+    """
+    Returns a client SSL context that resumes sessions. Certificates are checked
+    against 'cafile', or the system's trusted certificates without one; 'verify'
+    False accepts any certificate (for tests only).
+    """
+    context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = MINIMUM_VERSION
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif cafile:
+        context.load_verify_locations(cafile)
+    else:
+        context.load_default_certs()
+    return context
+
+
+def handshake_pool(workers=HANDSHAKE_WORKERS):
+    """
+    Returns the thread pool for handshake steps, or None to run them on the caller's thread.
+    """
+    if workers <= 0:
+        return None
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tls')
+
+
+def wait_ready(sock, events):
+    with selectors.DefaultSelector() as selector:
+        selector.register(sock, events)
+        selector.select()
+
+
+class SharedTLSSocket:
+    """
+    Blocking TLS connection for a reader and a writer thread (the threaded server
+    mode). OpenSSL must not be called for one connection from two threads at once,
+    so every call holds a lock and never blocks; the threads wait for the socket
+    outside of it.
+    """
+    def __init__(self, sock):
+        sock.setblocking(False)
+        self.sock = sock
+        self.lock = threading.Lock()
+
+    @property
+    def session_reused(self):
+        return self.sock.session_reused
+
+    def recv(self, size):
+        while True:
+            with self.lock:
+                try:
+                    return self.sock.recv(size)
+                except ssl.SSLWantReadError:
+                    events = selectors.EVENT_READ
+                except ssl.SSLWantWriteError:
+                    events = selectors.EVENT_WRITE
+            wait_ready(self.sock, events)
+
+    def sendall(self, data):
+        view = memoryview(data)
+        while view:
+            with self.lock:
+                try:
+                    # A retried write passes the same data again
+                    view = view[self.sock.send(view):]
+                    continue
+                except ssl.SSLWantWriteError:
+                    events = selectors.EVENT_WRITE
+                except ssl.SSLWantReadError:
+                    events = selectors.EVENT_READ
+            wait_ready(self.sock, events)
+
+    def shutdown(self, how):
+        # SSLSocket.shutdown() would also throw away the TLS state, after which
+        # output still queued would go out unencrypted
+        socket.socket.shutdown(self.sock, how)
+
+    def close(self):
+        self.sock.close()
+
+
+def server_handshake(context, sock, timeout=HANDSHAKE_TIMEOUT):
+    """
+    Runs the server side of a handshake on a blocking socket. Returns the connection
+    as a SharedTLSSocket; raises OSError or ValueError if the handshake fails.
+    """
+    sock.settimeout(timeout)
+    return SharedTLSSocket(context.wrap_socket(sock, server_side=True))
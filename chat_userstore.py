@@ -0,0 +1,466 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Pluggable user account storage for the chat room server.
+The text backend keeps the original users.txt format. The sqlite backend looks
+accounts up lazily from an indexed table and groups new accounts into batched
+commits, so startup time and memory do not depend on the number of accounts.
+Both pick up accounts changed by other programs on reload(), touching only what
+differs.
+
+Usage: python chat_userstore.py migrate <users.txt> <users.db>
+'''
+
+# Using Python version 3.12.0
+
+import os
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+
+# Durability policies for new accounts:
+#   off    - leave flushing to the operating system
+#   batch  - text: fsync appended accounts every SYNC_INTERVAL seconds;
+#            sqlite: WAL with synchronous=NORMAL
+#   always - text: fsync every new account; sqlite: synchronous=FULL
+SYNC_POLICIES = ('off', 'batch', 'always')
+
+# Seconds between background fsyncs of the text backend for the 'batch' policy
+SYNC_INTERVAL = 0.05
+# Largest number of new accounts written in one sqlite transaction
+COMMIT_BATCH = 1000
+# Number of looked-up accounts the sqlite backend keeps in memory
+CACHE_SIZE = 10000
+
+
+def parse_user_line(line):
+    """
+    Parses one line of the legacy users file, formatted as (UserID, Password).
+    Returns (username, password) or None for blank or malformed lines.
+    """
+    line = line.strip()  # Remove leading/trailing whitespace
+    if not line:
+        return None  # Skip empty lines
+    if line.startswith("(") and line.endswith(")"):
+        line = line[1:-1]  # Remove surrounding parentheses if present
+    parts = line.split(',')  # Split into username and password parts
+    if len(parts) < 2:
+        return None
+    return parts[0].strip(), parts[1].strip()
+
+
+def read_user_file(path):
+    """
+    Yields (username, password) pairs from a legacy users file.
+    """
+    with open(path, 'r') as f:
+        for line in f:
+            entry = parse_user_line(line)
+            if entry:
+                yield entry
+
+
+class TextUserStore:
+    """
+    The original users.txt backend: every account is loaded into a dict at startup
+    and new accounts are appended to the file under a lock.
+    """
+    def __init__(self, path, sync='batch'):
+        if sync not in SYNC_POLICIES:
+            raise ValueError(f"unknown sync policy: {sync}")
+        self.path = path
+        self.sync = sync
+        self.lock = threading.Lock()
+        self.users = {}
+        if os.path.exists(path):
+            for username, password in read_user_file(path):
+                self.users[username] = password
+        self.open_file()
+        self.dirty = False
+        self.stopped = threading.Event()
+        self.syncer = None
+        if sync == 'batch':
+            self.syncer = threading.Thread(target=self.sync_loop, daemon=True)
+            self.syncer.start()
+
+    def open_file(self):
+        self.file = open(self.path, 'a+b')
+        # Make sure the first appended record starts on its own line
+        self.file.seek(0, os.SEEK_END)
+        self.needs_newline = False
+        if self.file.tell() > 0:
+            self.file.seek(-1, os.SEEK_END)
+            self.needs_newline = self.file.read(1) != b'\n'
+            self.file.seek(0, os.SEEK_END)
+
+    def get(self, username):
+        """
+        Returns the stored password for a user, or None if there is no such account.
+        """
+        return self.users.get(username)
+
+    def reload(self):
+        """
+        Applies changes made to the users file by hand. Only accounts that were added,
+        changed or removed are touched. Returns (added, changed, removed).
+        """
+        with self.lock:
+            entries = dict(read_user_file(self.path)) if os.path.exists(self.path) else {}
+            added = changed = 0
+            for username, password in entries.items():
+                current = self.users.get(username)
+                if current != password:
+                    self.users[username] = password
+                    if current is None:
+                        added += 1
+                    else:
+                        changed += 1
+            removed = [username for username in self.users if username not in entries]
+            for username in removed:
+                del self.users[username]
+            # An editor may have replaced the file; new accounts must go to the new one
+            try:
+                replaced = os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino
+            except FileNotFoundError:
+                replaced = True
+            if replaced:
+                self.file.close()
+                self.open_file()
+                self.dirty = False
+        return added, changed, len(removed)
+
+    def add(self, username, password):
+        """
+        Creates an account. Returns False if the user already exists.
+        """
+        with self.lock:
+            if username in self.users:
+                return False
+            self.append(username, password)
+            return True
+
+    def update(self, username, password):
+        """
+        Replaces the stored password of an existing account. The file is rewritten with
+        the new record in place of the old ones (e.g. a plaintext password being upgraded
+        to a hash), so the old password does not stay on disk.
+        """
+        with self.lock:
+            self.rewrite(username, password)
+
+    def rewrite(self, username, password):
+        """
+        Writes the users file again with one account's record replaced, through a
+        temporary file that atomically takes the place of the old one. Other lines are
+        kept as they are. Must be called with the lock held.
+        """
+        record = f"({username}, {password})\n"
+        lines = []
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    entry = parse_user_line(line)
+                    if entry is None or entry[0] != username:
+                        lines.append(line if line.endswith("\n") else line + "\n")
+                    elif record is not None:
+                        # The user's first record is replaced and any later ones dropped
+                        lines.append(record)
+                        record = None
+        if record is not None:
+            lines.append(record)
+        temp = f"{self.path}.tmp"
+        with open(temp, 'w') as f:
+            f.writelines(lines)
+            f.flush()
+            # Whatever the policy, the file must not be replaced by one that is not on disk yet
+            os.fsync(f.fileno())
+        if os.path.exists(self.path):
+            os.chmod(temp, os.stat(self.path).st_mode & 0o7777)
+        os.replace(temp, self.path)
+        # New accounts must be appended to the new file
+        self.file.close()
+        self.open_file()
+        self.dirty = False
+        self.users[username] = password
+
+    def append(self, username, password):
+        """
+        Writes one account record. Must be called with the lock held.
+        """
+        record = f"({username}, {password})\n".encode('utf-8')
+        if self.needs_newline:
+            record = b'\n' + record
+        self.file.write(record)
+        self.file.flush()
+        self.needs_newline = False
+        if self.sync == 'always':
+            os.fsync(self.file.fileno())
+        else:
+            self.dirty = True
+        self.users[username] = password
+
+    def sync_loop(self):
+        """
+        Background thread for the 'batch' policy: one fsync covers every account
+        appended since the previous one.
+        """
+        while not self.stopped.wait(SYNC_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        """
+        Forces appended accounts to disk.
+        """
+        with self.lock:
+            if self.dirty and not self.file.closed:
+                os.fsync(self.file.fileno())
+                self.dirty = False
+
+    def close(self):
+        self.stopped.set()
+        if self.syncer:
+            self.syncer.join()
+        self.flush()
+        with self.lock:
+            self.file.close()
+
+
+class SqliteUserStore:
+    """
+    Indexed sqlite backend. Lookups go to the database on demand through a bounded
+    cache, and new accounts are committed by a writer thread in batches (group commit).
+    """
+    def __init__(self, path, sync='batch', cache_size=CACHE_SIZE):
+        if sync not in SYNC_POLICIES:
+            raise ValueError(f"unknown sync policy: {sync}")
+        self.path = path
+        self.sync = sync
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.committed = threading.Condition(self.lock)
+        self.cache = OrderedDict()
+        # Accounts added or changed but not committed yet, in insertion order; the names
+        # in 'updates' change an existing account, the others are new
+        self.pending = {}
+        self.updates = set()
+        # Outcome of accounts that were not added, reported back to the waiting add()
+        # call: the sqlite error, or False if the name was taken meanwhile (e.g. by
+        # another server process)
+        self.failed = {}
+        self.stopped = False
+        self.db = self.connect()
+        self.db.execute("CREATE TABLE IF NOT EXISTS users ("
+                        "name TEXT PRIMARY KEY, password TEXT NOT NULL) WITHOUT ROWID")
+        self.db.commit()
+        self.writer_db = self.connect()
+        self.wakeup = threading.Condition(self.lock)
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=" + {'off': 'OFF', 'batch': 'NORMAL', 'always': 'FULL'}[self.sync])
+        return db
+
+    def get(self, username):
+        """
+        Returns the stored password for a user, or None if there is no such account.
+        """
+        with self.lock:
+            password = self.pending.get(username)
+            if password is not None:
+                return password
+            if username in self.cache:
+                self.cache.move_to_end(username)
+                return self.cache[username]
+            row = self.db.execute("SELECT password FROM users WHERE name = ?", (username,)).fetchone()
+            password = row[0] if row else None
+            if password is not None:
+                self.cache[username] = password
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            return password
+
+    def reload(self):
+        """
+        Drops cached accounts that another program changed or removed in the database;
+        the others stay cached. Returns (added, changed, removed), where new accounts
+        are never counted since they are looked up on demand anyway.
+        """
+        changed = removed = 0
+        with self.lock:
+            names = list(self.cache)
+            for start in range(0, len(names), 500):
+                chunk = names[start:start + 500]
+                marks = ", ".join("?" * len(chunk))
+                stored = dict(self.db.execute(f"SELECT name, password FROM users WHERE name IN ({marks})", chunk))
+                for name in chunk:
+                    password = stored.get(name)
+                    if password != self.cache[name]:
+                        del self.cache[name]
+                        if password is None:
+                            removed += 1
+                        else:
+                            changed += 1
+        return 0, changed, removed
+
+    def add(self, username, password):
+        """
+        Creates an account and waits until it is committed, so it is visible to other
+        server processes once this returns. Concurrent calls share one transaction.
+        Returns False if the user already exists.
+        """
+        if self.get(username) is not None:
+            return False
+        with self.lock:
+            if username in self.pending:
+                return False
+            self.pending[username] = password
+            self.wakeup.notify()
+            while username in self.pending:
+                self.committed.wait()
+            error = self.failed.pop(username, None)
+        if error is False:
+            return False
+        if error is not None:
+            raise error
+        return True
+
+    def update(self, username, password):
+        """
+        Replaces the stored password of an existing account.
+        """
+        with self.lock:
+            self.cache.pop(username, None)
+            if username not in self.pending:
+                self.updates.add(username)
+            # An account still being added is simply added with the new password
+            self.pending[username] = password
+            self.wakeup.notify()
+
+    def add_many(self, entries):
+        """
+        Bulk-loads (username, password) pairs, skipping users that already exist.
+        Used for migrations; returns the number of accounts inserted.
+        """
+        before = self.db.total_changes
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT OR IGNORE INTO users (name, password) VALUES (?, ?)", entries)
+            self.db.execute("COMMIT")
+        return self.db.total_changes - before
+
+    def is_empty(self):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def write_loop(self):
+        """
+        Writer thread: commits pending accounts in groups. Accounts added while one
+        transaction is running are all written by the next one. A new account never
+        replaces an existing one; its add() call learns that the name is taken.
+        """
+        with self.lock:
+            while True:
+                while not self.pending and not self.stopped:
+                    self.wakeup.wait()
+                if not self.pending:
+                    return
+                batch = list(self.pending.items())[:COMMIT_BATCH]
+                updates = [(password, username) for username, password in batch if username in self.updates]
+                adds = [(username, password) for username, password in batch if username not in self.updates]
+                self.lock.release()
+                taken = set()
+                try:
+                    self.writer_db.execute("BEGIN")
+                    for username, password in adds:
+                        cursor = self.writer_db.execute(
+                            "INSERT OR IGNORE INTO users (name, password) VALUES (?, ?)", (username, password))
+                        if cursor.rowcount == 0:
+                            taken.add(username)
+                    self.writer_db.executemany("UPDATE users SET password = ? WHERE name = ?", updates)
+                    self.writer_db.execute("COMMIT")
+                    error = None
+                except sqlite3.Error as e:
+                    error = e
+                    try:
+                        self.writer_db.execute("ROLLBACK")
+                    except sqlite3.Error:
+                        pass
+                finally:
+                    self.lock.acquire()
+                for username, password in batch:
+                    if self.pending.get(username) == password:
+                        del self.pending[username]
+                        if username in self.updates:
+                            self.updates.discard(username)  # Nobody waits for an update
+                        elif error is not None:
+                            self.failed[username] = error
+                        elif username in taken:
+                            self.failed[username] = False
+                self.committed.notify_all()
+
+    def flush(self):
+        """
+        Waits until every added account is committed.
+        """
+        with self.lock:
+            self.wakeup.notify()
+            while self.pending:
+                self.committed.wait()
+
+    def close(self):
+        with self.lock:
+            self.stopped = True
+            self.wakeup.notify()
+        self.writer.join()
+        self.writer_db.close()
+        self.db.close()
+
+
+def open_user_store(spec, sync='batch', legacy_file=None):
+    """
+    Opens a user store from a spec such as "text:users.txt" or "sqlite:users.db".
+    A new, empty sqlite store imports the accounts of 'legacy_file' if it exists.
+    """
+    kind, _, path = spec.partition(':')
+    if not path:
+        kind, path = ('sqlite' if spec.endswith('.db') else 'text'), spec
+    if kind == 'text':
+        return TextUserStore(path, sync=sync)
+    if kind == 'sqlite':
+        store = SqliteUserStore(path, sync=sync)
+        if legacy_file and os.path.exists(legacy_file) and store.is_empty():
+            migrate(legacy_file, store)
+        return store
+    raise ValueError(f"unknown user store type: {kind}")
+
+
+def migrate(text_path, store):
+    """
+    Copies every account from a legacy users file into a sqlite store.
+    """
+    return store.add_many(read_user_file(text_path))
+
+
+def main(argv):
+    if len(argv) != 4 or argv[1] != 'migrate':
+        print("Usage: python chat_userstore.py migrate <users.txt> <users.db>")
+        return 1
+    store = SqliteUserStore(argv[3])
+    try:
+        added = migrate(argv[2], store)
+        print(f"Migrated {added} accounts into {argv[3]} ({store.count()} total).")
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
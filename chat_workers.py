@@ -0,0 +1,436 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Multi-process mode for the chat room server.
+The parent process forks several event-loop workers that accept on the same port
+(SO_REUSEPORT, or one listening socket inherited from the parent) and then acts as a
+router: every worker keeps a Unix-domain socket link to it, over which logins,
+logouts, unicast messages for users on other workers and "send all" broadcasts travel.
+Each worker applies the presence updates, so "who" lists users from every worker.
+The router also owns the offline mailboxes, so a message stored by one worker is
+delivered whichever worker the user logs in on, and the message history, which
+workers append to and query through the link. Room memberships are replicated the
+same way as presence, and a room message reaches every other worker once.
+SIGTERM or Ctrl+C makes every worker drain its connections; the router keeps
+routing until the last worker is done, and a second Ctrl+C stops everything at once.
+'''
+
+# Using Python version 3.12.0
+
+import marshal
+import os
+import selectors
+import signal
+import socket
+import sys
+from concurrent.futures import Future
+
+from chat_logging import log
+from chat_outbound import OutboundQueue
+from chat_protocol import FrameDecoder, encode_frame
+
+# Largest message exchanged between the router and a worker
+BUS_MAX_FRAME = 16 * 1024 * 1024
+BUS_RECV_SIZE = 256 * 1024
+
+
+class BusLink:
+    """
+    Non-blocking, framed link between the router and one worker.
+    Messages are tuples of builtin types, serialized with marshal.
+    on_message(link, message) runs for every received message and
+    on_close(link) once the other side goes away.
+    """
+    def __init__(self, sock, selector, on_message, on_close, name=None):
+        self.sock = sock
+        self.selector = selector
+        self.on_message = on_message
+        self.on_close = on_close
+        self.name = name
+        self.decoder = FrameDecoder(max_frame=BUS_MAX_FRAME)
+        self.outq = OutboundQueue(max_bytes=0)  # Never drop routing messages
+        self.want_write = False
+        self.closed = False
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, self.handle)
+
+    def send(self, *message):
+        """
+        Queues one message for the other side without blocking.
+        """
+        if self.closed:
+            return
+        data = encode_frame(marshal.dumps(message))
+        if self.outq:
+            self.outq.push(data)
+            return
+        try:
+            sent = self.sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.close()
+            return
+        if sent < len(data):
+            self.outq.push(data)
+            self.outq.consume(sent)
+            self.set_write_interest(True)
+
+    def handle(self, mask):
+        if mask & selectors.EVENT_READ:
+            self.read()
+        if mask & selectors.EVENT_WRITE and not self.closed:
+            self.flush()
+
+    def read(self):
+        try:
+            data = self.sock.recv(BUS_RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close()
+            return
+        for frame in self.decoder.feed(data):
+            self.on_message(self, marshal.loads(frame))
+
+    def flush(self):
+        outq = self.outq
+        try:
+            while outq:
+                view = outq.peek()
+                sent = self.sock.send(view)
+                outq.consume(sent)
+                if sent < len(view):
+                    return
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close()
+            return
+        self.set_write_interest(False)
+
+    def set_write_interest(self, enabled):
+        if self.want_write == enabled:
+            return
+        self.want_write = enabled
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if enabled else selectors.EVENT_READ
+        self.selector.modify(self.sock, events, self.handle)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.selector.unregister(self.sock)
+        except (KeyError, ValueError):
+            pass
+        self.sock.close()
+        self.on_close(self)
+
+
+class Router:
+    """
+    Runs in the parent process. Knows which worker holds every online user and
+    forwards messages between workers.
+    """
+    def __init__(self, socks, mailbox=None, history=None):
+        self.mailbox = mailbox
+        self.history = history
+        self.selector = selectors.DefaultSelector()
+        self.links = {}
+        for worker_id, sock in socks.items():
+            self.links[worker_id] = BusLink(sock, self.selector, self.on_message, self.on_close, worker_id)
+        self.owners = {}  # user -> worker id, in login order
+
+    def others(self, worker_id):
+        return [link for wid, link in self.links.items() if wid != worker_id]
+
+    def on_message(self, link, message):
+        op = message[0]
+        worker_id = link.name
+        if op == 'online':
+            user = message[1]
+            self.owners[user] = worker_id
+            for other in self.others(worker_id):
+                other.send('online', user, worker_id)
+            if self.mailbox is not None and self.mailbox.has(user):
+                link.send('mail', user, self.mailbox.take(user))
+        elif op == 'offline':
+            user = message[1]
+            if self.owners.get(user) == worker_id:
+                del self.owners[user]
+                for other in self.others(worker_id):
+                    other.send('offline', user, worker_id)
+        elif op == 'unicast':
+            target = self.owners.get(message[1])
+            if target is not None and target in self.links:
+                self.links[target].send('deliver', message[1], message[2])
+        elif op == 'broadcast':
+            # One copy per worker, however many users it serves
+            for other in self.others(worker_id):
+                other.send('broadcast', message[1])
+        elif op in ('join', 'leave'):
+            for other in self.others(worker_id):
+                other.send(op, message[1], message[2])
+        elif op == 'room':
+            for other in self.others(worker_id):
+                other.send('room', message[1], message[2])
+        elif op == 'store':
+            user, fields = message[1], message[2]
+            target = self.owners.get(user)
+            if target is not None and target in self.links:
+                # The user logged in while the message was on its way
+                self.links[target].send('deliver', user, fields)
+            elif self.mailbox is None or not self.mailbox.store(user, fields[0]):
+                log.warning(f"Could not save an offline message for {user}.")
+        elif op == 'record':
+            if self.history is not None:
+                self.history.append(*message[1])
+        elif op == 'history':
+            request_id, user, peer, count = message[1:]
+            messages = self.history.recent(count, user, peer) if self.history is not None else []
+            link.send('history', request_id, messages)
+
+    def on_close(self, link):
+        """
+        A worker exited: its users are offline everywhere else.
+        """
+        self.links.pop(link.name, None)
+        gone = [user for user, owner in self.owners.items() if owner == link.name]
+        for user in gone:
+            del self.owners[user]
+            for other in self.links.values():
+                other.send('offline', user, link.name)
+        log.warning(f"Worker {link.name} exited.")
+
+    def serve(self):
+        while self.links:
+            for key, mask in self.selector.select():
+                key.data(mask)
+        self.selector.close()
+
+
+class RemoteUser:
+    """
+    Presence entry for a user connected to another worker process.
+    Sending to it routes the message through the router.
+    """
+    remote = True
+    framed = False
+    binary = None
+
+    def __init__(self, user, worker_id, bus):
+        self.user = user
+        self.worker_id = worker_id
+        self.bus = bus
+
+    def send(self, text):
+        self.bus.unicast(self.user, (text, None, None, None, None))
+
+    def deliver(self, shared):
+        self.bus.unicast(self.user, shared.fields())
+
+
+class WorkerBus:
+    """
+    A worker's side of the routing layer. Publishes local presence changes and
+    messages for other workers, and applies what the router sends back.
+    Messages travel as SharedMessage field tuples: 'deliver(user, fields)' sends to a
+    local user and 'broadcast(fields)' fans out locally;
+    'mail(user, messages)' hands a local user the offline messages kept by the router.
+    record() and history() append to and read the router's message history.
+    Remote members are added to 'rooms', and 'room_deliver(room, fields)' sends a room
+    message to the room's local members.
+    """
+    def __init__(self, sock, loop, presence, deliver, broadcast, mail=None, rooms=None, room_deliver=None):
+        self.presence = presence
+        self.deliver = deliver
+        self.local_broadcast = broadcast
+        self.mail = mail
+        self.rooms = rooms
+        self.room_deliver = room_deliver
+        self.requests = {}  # Request id -> Future waiting for the router's answer
+        self.next_request = 0
+        self.link = BusLink(sock, loop.selector, self.on_message, self.on_close)
+
+    def online(self, user):
+        self.link.send('online', user)
+
+    def offline(self, user):
+        self.link.send('offline', user)
+
+    def unicast(self, user, fields):
+        self.link.send('unicast', user, fields)
+
+    def broadcast(self, fields):
+        self.link.send('broadcast', fields)
+
+    def store(self, user, fields):
+        self.link.send('store', user, fields)
+
+    def join(self, room, user):
+        self.link.send('join', room, user)
+
+    def leave(self, room, user):
+        self.link.send('leave', room, user)
+
+    def room(self, room, fields):
+        self.link.send('room', room, fields)
+
+    def record(self, fields):
+        self.link.send('record', fields)
+
+    def history(self, user, peer, count):
+        """
+        Asks the router for recent messages (see History.recent) and returns a Future
+        of the list, completed on the loop thread when the answer arrives.
+        """
+        future = Future()
+        self.next_request += 1
+        self.requests[self.next_request] = future
+        self.link.send('history', self.next_request, user, peer, count)
+        return future
+
+    def on_message(self, link, message):
+        op = message[0]
+        if op == 'online':
+            user, worker_id = message[1], message[2]
+            current = self.presence.get(user)
+            # A local session of the same user stays reachable here
+            if current is None or current.remote:
+                self.presence.add(user, RemoteUser(user, worker_id, self))
+        elif op == 'offline':
+            user, worker_id = message[1], message[2]
+            current = self.presence.get(user)
+            if current is not None and current.remote and current.worker_id == worker_id:
+                self.presence.remove(user, current)
+                if self.rooms is not None:
+                    self.rooms.leave_all(user, current)
+        elif op == 'deliver':
+            self.deliver(message[1], message[2])
+        elif op == 'broadcast':
+            self.local_broadcast(message[1])
+        elif op == 'mail' and self.mail is not None:
+            self.mail(message[1], message[2])
+        elif op == 'join' and self.rooms is not None:
+            room, user = message[1], message[2]
+            current = self.presence.get(user)
+            if current is not None and current.remote:
+                self.rooms.join(room, user, current)
+        elif op == 'leave' and self.rooms is not None:
+            room, user = message[1], message[2]
+            current = self.presence.get(user)
+            if current is not None and current.remote:
+                self.rooms.leave(room, user, current)
+        elif op == 'room' and self.room_deliver is not None:
+            self.room_deliver(message[1], message[2])
+        elif op == 'history':
+            future = self.requests.pop(message[1], None)
+            if future is not None:
+                future.set_result(message[2])
+
+    def on_close(self, link):
+        raise SystemExit("Lost the connection to the router process.")
+
+
+def listening_socket(host, port, backlog, reuse_port):
+    """
+    Creates a listening TCP socket, optionally with SO_REUSEPORT so every worker
+    can bind its own socket to the same port.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def forward_signal(pids, signum):
+    """
+    Passes a signal the router received on to the workers.
+    """
+    for pid in pids:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+def run_workers(count, worker_main, host, port, backlog, open_mailbox=None, open_history=None):
+    """
+    Forks 'count' workers and routes messages between them until they exit.
+    Each child runs worker_main(worker_id, listen_sock, bus_sock) and never returns here.
+    open_mailbox() returns the offline message store of the router, opened after forking;
+    open_history() likewise returns its message history.
+    """
+    reuse_port = hasattr(socket, 'SO_REUSEPORT')
+    shared = None
+    if not reuse_port:
+        # Pre-fork accept: every worker inherits and accepts on the same socket
+        shared = listening_socket(host, port, backlog, False)
+    else:
+        # Bind once in the parent so a port conflict is reported before forking
+        listening_socket(host, port, backlog, True).close()
+    socks = {}
+    pids = []
+    for worker_id in range(count):
+        parent_end, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        pid = os.fork()
+        if pid == 0:
+            parent_end.close()
+            for other in socks.values():
+                other.close()
+            status = 0
+            try:
+                listen_sock = shared or listening_socket(host, port, backlog, True)
+                worker_main(worker_id, listen_sock, child_end)
+            except KeyboardInterrupt:
+                pass
+            except BaseException as e:
+                print(f"Worker {worker_id} failed: {e}")
+                status = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(status)
+        child_end.close()
+        socks[worker_id] = parent_end
+        pids.append(pid)
+    if shared is not None:
+        shared.close()
+    if hasattr(signal, 'SIGHUP'):
+        # Settings reloads are done by the workers, which serve the clients
+        signal.signal(signal.SIGHUP, lambda signum, frame: forward_signal(pids, signum))
+    stopping = []
+
+    def shut_down(signum, frame):
+        # The workers drain their connections and still need the router meanwhile
+        if stopping and signum == signal.SIGINT:
+            raise KeyboardInterrupt
+        stopping.append(signum)
+        forward_signal(pids, signal.SIGTERM)
+    signal.signal(signal.SIGINT, shut_down)
+    signal.signal(signal.SIGTERM, shut_down)
+    mailbox = open_mailbox() if open_mailbox is not None else None
+    history = open_history() if open_history is not None else None
+    finished = False
+    try:
+        Router(socks, mailbox, history).serve()
+        finished = True  # Every worker has closed its link and exits by itself
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if mailbox is not None:
+            mailbox.close()
+        if history is not None:
+            history.close()
+        if not finished:
+            forward_signal(pids, signal.SIGINT)
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
@@ -0,0 +1,4 @@
+'''
+Tests of the chat room server and its client library. Run them from the repository
+root with python -m pytest tests
+'''
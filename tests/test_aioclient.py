@@ -0,0 +1,29 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Checks that the asyncio client splits typed command lines into
+the same command and arguments as the server's command table.
+
+Usage: python -m pytest tests
+'''
+
+# Using Python version 3.12.0
+
+import unittest
+
+from chat_aioclient import split_command
+from chat_serverV2 import commands
+
+
+class SplitCommandTest(unittest.TestCase):
+    LINES = ["send all hi", "send  Tom   hi  there ", "  SEND Tom hi", "send Tom", "send", "login Tom Tom11",
+             "login   Tom\tTom11 ", "who", "  logout  ", "history 5", "join #general", ""]
+
+    def test_same_arguments_as_the_server(self):
+        for line in self.LINES:
+            _, name, args = commands.parse(line)
+            self.assertEqual(split_command(line), (name, list(args)), line)
+
+
+if __name__ == "__main__":
+    unittest.main()
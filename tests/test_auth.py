@@ -0,0 +1,45 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Checks that the login rate limit only counts attempts with a
+wrong password, so a user who logs in often is never locked out.
+
+Usage: python -m pytest tests
+'''
+
+# Using Python version 3.12.0
+
+import unittest
+
+from chat_auth import Authenticator, LoginRateLimiter, hash_password
+
+
+class LoginLimitTest(unittest.TestCase):
+    def setUp(self):
+        # No refill, so every token taken and not given back is gone
+        self.auth = Authenticator(workers=1, iterations=1000, limiter=LoginRateLimiter(burst=3, rate=0))
+        self.stored = hash_password('Tom11', 1000)
+
+    def tearDown(self):
+        self.auth.close()
+
+    def attempt(self, password):
+        if not self.auth.allow_attempt('Tom'):
+            return None
+        return self.auth.verify('Tom', password, self.stored).result()
+
+    def test_successful_logins_are_not_counted(self):
+        for _ in range(10):
+            self.assertTrue(self.attempt('Tom11'))
+
+    def test_failed_logins_are_counted(self):
+        self.assertEqual([self.attempt('wrong') for _ in range(4)], [False, False, False, None])
+
+    def test_plaintext_logins_are_not_counted(self):
+        for _ in range(5):
+            self.assertTrue(self.auth.allow_attempt('Tom'))
+            self.assertTrue(self.auth.verify('Tom', 'Tom11', 'Tom11').result())
+
+
+if __name__ == "__main__":
+    unittest.main()
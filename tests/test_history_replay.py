@@ -0,0 +1,99 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Checks that the lines a "history" command replays reach the
+command and that notices sent meanwhile (e.g. another user logging out) reach the
+message handlers, on the server's encoding and on the asyncio client's side, and
+that legacy clients get the title and the lines as separate lines.
+
+Usage: python -m pytest tests
+'''
+
+# Using Python version 3.12.0
+
+import asyncio
+import unittest
+
+from chat_aioclient import ChatSession
+from chat_binary import (HELLO_BINARY, OP_NOTICE, OP_REQUEST, OP_RESP_ID, BinarySession, ClientDecoder, FrameDecoder,
+                         decode_varint, encode_string, encode_varint, frame, frame_strings)
+from chat_serverV2 import MAILBOX_BATCH, notice_batches
+
+
+class Client:
+    """
+    The attributes notice_batches() looks at.
+    """
+    def __init__(self, binary, framed=True):
+        self.framed = framed
+        self.binary = binary
+
+
+class ServerEncodingTest(unittest.TestCase):
+    def test_replay_lines_carry_the_request_id(self):
+        session = BinarySession()
+        session.request_id = 7
+        data = b"".join(notice_batches("Last 2 message(s):", ["a", "b"], Client(session), replay=True))
+        events = ClientDecoder().feed(data)
+        self.assertEqual(events, [('replay', "Last 2 message(s):", 7), ('replay', "a", 7), ('replay', "b", 7)])
+
+    def test_offline_messages_stay_notices(self):
+        data = b"".join(notice_batches("You have 1 offline message(s).", ["a"], Client(BinarySession())))
+        self.assertEqual([event[0] for event in ClientDecoder().feed(data)], ['notice', 'notice'])
+
+    def test_legacy_lines_do_not_run_together(self):
+        messages = [f"Tom: {i}" for i in range(MAILBOX_BATCH + 1)]
+        batches = list(notice_batches("You have 101 offline message(s).", messages, Client(None, framed=False)))
+        self.assertEqual(len(batches), 2)
+        self.assertTrue(all(batch.endswith(b"\n") for batch in batches))
+        data = b"login confirmed" + b"".join(batches)
+        self.assertEqual(data.decode().splitlines(), ["login confirmed", "You have 101 offline message(s)."] + messages)
+
+
+class ClientReplayTest(unittest.TestCase):
+    def test_notice_during_history_goes_to_handlers(self):
+        """
+        A scripted server answers "history" with a replayed line, then a notice of
+        another user leaving, then another line and the response.
+        """
+        async def serve(reader, writer):
+            hello = await reader.readexactly(len(HELLO_BINARY))
+            writer.write(hello)
+            frames = FrameDecoder()
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                for op, body in frames.feed(data):
+                    self.assertEqual(op, OP_REQUEST)
+                    request_id = decode_varint(body, 0)[0]
+                    session = BinarySession()
+                    session.request_id = request_id
+                    writer.write(session.replay("Last 2 message(s):") + session.replay("[10:00:00] Tom: one") +
+                                 frame_strings(OP_NOTICE, "Beth left.") + session.replay("[10:00:01] Tom: two") +
+                                 frame(OP_RESP_ID, encode_varint(request_id) + encode_string("")))
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(serve, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            notices = []
+            session = ChatSession('127.0.0.1', port, reconnect=False, compress=False)
+            await session.connect()
+            session.add_handler(lambda message: notices.append(message.text))
+            try:
+                lines = await asyncio.wait_for(session.history(), 5)
+                await asyncio.sleep(0.05)  # Handlers run soon after the message arrived
+            finally:
+                await session.close()
+                server.close()
+                await server.wait_closed()
+            return lines, notices
+
+        lines, notices = asyncio.run(run())
+        self.assertEqual(lines, ["Last 2 message(s):", "[10:00:00] Tom: one", "[10:00:01] Tom: two"])
+        self.assertEqual(notices, ["Beth left."])
+
+
+if __name__ == "__main__":
+    unittest.main()
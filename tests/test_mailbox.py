@@ -0,0 +1,105 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Checks that offline messages dropped for the per-user limit
+or the retention time stay dropped when the mailboxes are opened again, even with
+a higher limit or a longer retention, and that a damaged record is cut off instead
+of keeping the mailboxes from opening.
+
+Usage: python -m pytest tests
+'''
+
+# Using Python version 3.12.0
+
+import os
+import tempfile
+import time
+import unittest
+
+from chat_mailbox import RECORD, Mailbox
+
+
+class MailboxDropTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def open(self, **options):
+        return Mailbox(self.directory.name, shards=2, sync='off', **options)
+
+    def test_limit_survives_a_restart(self):
+        mailbox = self.open(max_messages=3)
+        for i in range(5):
+            self.assertTrue(mailbox.store('Tom', f"message {i}"))
+        mailbox.close()
+        mailbox = self.open(max_messages=0)
+        try:
+            self.assertEqual(mailbox.take('Tom'), ["message 2", "message 3", "message 4"])
+        finally:
+            mailbox.close()
+
+    def test_lowered_limit_applies_on_open(self):
+        mailbox = self.open(max_messages=0)
+        for i in range(5):
+            mailbox.store('Tom', f"message {i}")
+        mailbox.close()
+        self.open(max_messages=2).close()
+        mailbox = self.open(max_messages=0)
+        try:
+            self.assertEqual(mailbox.take('Tom'), ["message 3", "message 4"])
+        finally:
+            mailbox.close()
+
+    def test_expired_messages_stay_expired(self):
+        now = time.time()
+        mailbox = self.open(retention=60)
+        mailbox.store('Tom', "old", now=now - 120)
+        mailbox.store('Tom', "new", now=now)
+        mailbox.store('Beth', "old", now=now - 120)
+        mailbox.expire(now)
+        self.assertFalse(mailbox.has('Beth'))
+        mailbox.close()
+        mailbox = self.open(retention=0)
+        try:
+            self.assertEqual(mailbox.take('Tom'), ["new"])
+            self.assertEqual(mailbox.take('Beth'), [])
+        finally:
+            mailbox.close()
+
+    def test_compaction_keeps_the_survivors(self):
+        mailbox = self.open(max_messages=2)
+        for i in range(4):
+            mailbox.store('Tom', f"message {i}")
+        mailbox.compact(force=True)
+        mailbox.close()
+        mailbox = self.open(max_messages=0)
+        try:
+            self.assertEqual(mailbox.take('Tom'), ["message 2", "message 3"])
+        finally:
+            mailbox.close()
+
+
+    def test_damaged_user_name_is_cut_off(self):
+        mailbox = self.open()
+        mailbox.store('Tom', "kept")
+        mailbox.store('Tom', "damaged")
+        shard = mailbox.shard('Tom')
+        path = shard.path
+        mailbox.close()
+        with open(path, 'r+b') as f:
+            # The user name of the second record is no longer UTF-8
+            first = RECORD.size + len(b"Tom") + len(b"kept")
+            f.seek(first + RECORD.size)
+            f.write(b"\xff")
+        mailbox = self.open()
+        try:
+            self.assertEqual(os.path.getsize(path), first)
+            self.assertEqual(mailbox.take('Tom'), ["kept"])
+        finally:
+            mailbox.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
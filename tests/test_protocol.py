@@ -0,0 +1,56 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Checks the length-prefixed frame decoder of the framed
+protocol: frames split across reads or arriving several per read come out whole
+and in order, and a frame above the size limit is refused.
+
+Usage: python -m pytest tests
+'''
+
+# Using Python version 3.12.0
+
+import unittest
+
+from chat_protocol import COMPACT_THRESHOLD, FrameDecoder, FrameError, encode_frame
+
+
+class FrameDecoderTest(unittest.TestCase):
+    def test_partial_frame_waits_for_the_rest(self):
+        decoder = FrameDecoder()
+        data = encode_frame(b"login Tom Tom11")
+        self.assertEqual(decoder.feed(data[:2]), [])  # Part of the length prefix
+        self.assertEqual(decoder.feed(data[2:7]), [])  # Part of the payload
+        self.assertEqual(decoder.buffered(), 7)
+        self.assertEqual(decoder.feed(data[7:]), [b"login Tom Tom11"])
+        self.assertEqual(decoder.buffered(), 0)
+
+    def test_frames_split_across_reads(self):
+        payloads = [b"who", b"", b"send all " + b"x" * 300, b"logout"]
+        stream = b"".join(encode_frame(payload) for payload in payloads)
+        for size in (1, 3, 7, 64, len(stream)):
+            decoder = FrameDecoder()
+            frames = []
+            for start in range(0, len(stream), size):
+                frames.extend(decoder.feed(stream[start:start + size]))
+            self.assertEqual(frames, payloads, size)
+            self.assertEqual(decoder.buffered(), 0)
+
+    def test_consumed_bytes_are_dropped(self):
+        decoder = FrameDecoder()
+        frame = encode_frame(b"y" * 1000)
+        count = COMPACT_THRESHOLD // len(frame) + 2
+        # Every read ends in the middle of a frame, so the buffer is never empty
+        self.assertEqual(len(decoder.feed(frame * count + frame[:10])), count)
+        self.assertEqual(len(decoder.buf), 10)
+        self.assertEqual(decoder.feed(frame[10:]), [b"y" * 1000])
+
+    def test_oversized_frame_is_refused(self):
+        decoder = FrameDecoder(max_frame=16)
+        self.assertEqual(decoder.feed(encode_frame(b"x" * 16)), [b"x" * 16])
+        with self.assertRaises(FrameError):
+            decoder.feed(encode_frame(b"x" * 17)[:4])  # Refused from the header alone
+
+
+if __name__ == "__main__":
+    unittest.main()
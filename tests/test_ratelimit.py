@@ -0,0 +1,131 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Checks the token-bucket rate limits: a bucket allows its
+burst at once and then refills at its rate, a command larger than the burst
+leaves a debt that is paid off first, the process-wide budget is available in
+full to a single user as well as to many, and connections of one user served by
+different threads never take more than the user's burst.
+
+Usage: python -m pytest tests
+'''
+
+# Using Python version 3.12.0
+
+import sys
+import threading
+import unittest
+
+from chat_ratelimit import Bucket, RateLimiter
+
+
+def allowed(limiter, users, attempts, now):
+    """
+    Sends 'attempts' commands round-robin over the users' buckets at one moment and
+    returns how many were allowed.
+    """
+    count = 0
+    for i in range(attempts):
+        if limiter.check(users[i % len(users)], 10, now) is None:
+            count += 1
+    return count
+
+
+class BucketTest(unittest.TestCase):
+    def test_burst_then_refill(self):
+        bucket = Bucket(4.0, 0.0)
+        for _ in range(4):
+            self.assertEqual(bucket.wait(1, 2.0, 4.0, 0.0), 0.0)
+            bucket.take(1)
+        self.assertEqual(bucket.wait(1, 2.0, 4.0, 0.0), 0.5)
+        self.assertEqual(bucket.wait(1, 2.0, 4.0, 0.5), 0.0)
+        # Never refills beyond the burst
+        self.assertEqual(bucket.wait(1, 2.0, 4.0, 100.0), 0.0)
+        self.assertEqual(bucket.tokens, 4.0)
+
+    def test_oversize_cost_leaves_a_debt(self):
+        bucket = Bucket(100.0, 0.0)
+        # More than the burst: allowed with a full bucket only
+        self.assertEqual(bucket.wait(250, 50.0, 100.0, 0.0), 0.0)
+        bucket.take(250)
+        self.assertEqual(bucket.tokens, -150.0)
+        # The debt is paid off at the rate before the next command is allowed
+        self.assertEqual(bucket.wait(1, 50.0, 100.0, 0.0), 151 / 50.0)
+        self.assertGreater(bucket.wait(1, 50.0, 100.0, 3.0), 0.0)
+        self.assertEqual(bucket.wait(1, 50.0, 100.0, 3.02), 0.0)
+
+
+class UserLimitTest(unittest.TestCase):
+    def test_user_commands_and_bytes(self):
+        limiter = RateLimiter(user_commands=(2.0, 3.0), user_bytes=(100.0, 200.0))
+        user = limiter.for_user('Tom')
+        now = user.commands.stamp
+        self.assertEqual([limiter.check(user, 10, now) for _ in range(3)], [None, None, None])
+        self.assertEqual(limiter.check(user, 10, now), ('user commands', 0.5))
+        self.assertIsNone(limiter.check(user, 10, now + 0.5))
+
+    def test_large_message_is_allowed_once_then_throttled(self):
+        limiter = RateLimiter(user_commands=(0.0, 0.0), user_bytes=(100.0, 200.0))
+        user = limiter.for_user('Tom')
+        now = user.bytes.stamp
+        self.assertIsNone(limiter.check(user, 500, now))
+        scope, wait = limiter.check(user, 10, now)
+        self.assertEqual(scope, 'user bytes')
+        self.assertAlmostEqual(wait, 3.1)
+        # A refused command is not charged
+        self.assertEqual(user.bytes.tokens, -300.0)
+
+    def test_reconnect_keeps_the_buckets(self):
+        limiter = RateLimiter(user_commands=(1.0, 1.0), user_bytes=(0.0, 0.0))
+        now = limiter.for_user('Tom').commands.stamp
+        self.assertIsNone(limiter.check(limiter.for_user('Tom'), 1, now))
+        self.assertEqual(limiter.check(limiter.for_user('Tom'), 1, now)[0], 'user commands')
+        # A connection that is not logged in has buckets of its own
+        guest = limiter.for_user(None)
+        self.assertIsNone(limiter.check(guest, 1, guest.commands.stamp))
+
+
+class GlobalLimitTest(unittest.TestCase):
+    def make(self):
+        return RateLimiter(user_commands=(0.0, 0.0), user_bytes=(0.0, 0.0), global_commands=(160.0, 160.0))
+
+    def test_lone_user_gets_the_whole_budget(self):
+        limiter = self.make()
+        user = limiter.for_user('Tom')
+        now = limiter.server_commands.stamp
+        self.assertEqual(allowed(limiter, [user], 200, now), 160)
+        self.assertEqual(limiter.check(user, 10, now), ('server commands', 1 / 160))
+
+    def test_many_users_share_the_budget(self):
+        limiter = self.make()
+        users = [limiter.for_user(f"user{i}") for i in range(200)]
+        self.assertEqual(allowed(limiter, users, 400, limiter.server_commands.stamp), 160)
+
+
+class SharedUserTest(unittest.TestCase):
+    def test_threads_of_one_user_do_not_lose_debits(self):
+        limiter = RateLimiter(user_commands=(1e-9, 500.0), user_bytes=(0.0, 0.0))
+        user = limiter.for_user('Tom')
+        counts = []
+        start = threading.Barrier(8)
+
+        def connection():
+            start.wait()
+            counts.append(sum(limiter.check(limiter.for_user('Tom'), 10) is None for _ in range(200)))
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=connection) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(sum(counts), 500)
+        self.assertLess(user.commands.tokens, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
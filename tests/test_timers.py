@@ -0,0 +1,78 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Checks the hierarchical timer wheel: timers due several turns
+ahead cascade down the levels and fire on time, never early and at most one tick
+late, also past the range of the wheel; cancelled timers never fire.
+
+Usage: python -m pytest tests
+'''
+
+# Using Python version 3.12.0
+
+import unittest
+
+from chat_timers import Timer, TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        # A small wheel: 4 ticks of one second on level 0, 16 on level 1, 64 on level 2
+        self.wheel = TimerWheel(tick=1.0, bits=2, levels=3, now=0.0)
+
+    def add(self, deadline, name):
+        timer = Timer(deadline, None, (name,))
+        self.wheel.insert(timer)
+        return timer
+
+    def run_ticks(self, last):
+        """
+        Advances the wheel one tick at a time and returns {name: second it came due}.
+        """
+        fired = {}
+        for second in range(1, last + 1):
+            for timer in self.wheel.advance(float(second)):
+                self.assertNotIn(timer.args[0], fired)
+                fired[timer.args[0]] = second
+        return fired
+
+    def test_timers_cascade_across_levels(self):
+        deadlines = {'level 0': 2.5, 'level 1': 10.5, 'level 2': 40.5, 'parked': 100.5, 'boundary': 16.0}
+        for name, deadline in deadlines.items():
+            self.add(deadline, name)
+        levels = [sum(len(bucket) for bucket in wheel) for wheel in self.wheel.wheels]
+        self.assertEqual(levels, [1, 1, 3])
+        fired = self.run_ticks(120)
+        self.assertEqual(fired, {name: int(deadline) + 1 for name, deadline in deadlines.items()})
+        self.assertEqual(len(self.wheel), 0)
+        self.assertIsNone(self.wheel.timeout(120.0))
+
+    def test_one_large_step_returns_everything_due(self):
+        for deadline in (0.5, 3.5, 17.5, 63.5):
+            self.add(deadline, deadline)
+        self.add(90.5, 'later')
+        due = self.wheel.advance(70.0)
+        self.assertEqual(sorted(timer.args[0] for timer in due), [0.5, 3.5, 17.5, 63.5])
+        self.assertEqual(self.run_ticks(100), {'later': 91})
+
+    def test_cancelled_timers_never_fire(self):
+        kept = self.add(5.5, 'kept')
+        for deadline in (1.5, 5.5, 30.5):
+            self.add(deadline, 'cancelled').cancel()
+        self.assertEqual(len(self.wheel), 4)
+        self.assertEqual(self.run_ticks(40), {'kept': 6})
+        self.assertFalse(kept.cancelled)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_run_due_skips_timers_cancelled_by_an_earlier_callback(self):
+        calls = []
+        second = Timer(1.5, calls.append, ('second',))
+        first = Timer(1.5, lambda: (calls.append('first'), second.cancel()), ())
+        self.wheel.insert(first)
+        self.wheel.insert(second)
+        self.wheel.run_due(2.0)
+        self.assertEqual(calls, ['first'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+'''
+Nolan Rink
+CS 4850 Project V2
+Program Description: Checks that a new account in the sqlite user store never
+replaces an account with the same name that another process committed first,
+that password updates still replace the stored password, and that upgrading a
+password in users.txt leaves no trace of the old one in the file.
+
+Usage: python -m pytest tests
+'''
+
+# Using Python version 3.12.0
+
+import os
+import tempfile
+import unittest
+
+from chat_auth import hash_password
+from chat_userstore import SqliteUserStore, TextUserStore
+
+
+class LateCheckStore(SqliteUserStore):
+    """
+    A store whose duplicate check ran before another process committed the same name.
+    """
+    def get(self, username):
+        return None
+
+
+class SqliteAddTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'users.db')
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        self.directory.cleanup()
+
+    def open(self, kind=SqliteUserStore):
+        store = kind(self.path)
+        self.stores.append(store)
+        return store
+
+    def test_racing_add_does_not_replace_the_first_account(self):
+        first = self.open()
+        late = self.open(LateCheckStore)
+        self.assertTrue(first.add('bob', 'one'))
+        self.assertFalse(late.add('bob', 'two'))
+        self.assertEqual(self.open().get('bob'), 'one')
+
+    def test_update_replaces_the_password(self):
+        store = self.open()
+        self.assertTrue(store.add('bob', 'one'))
+        store.update('bob', 'two')
+        store.flush()
+        self.assertEqual(self.open().get('bob'), 'two')
+
+    def test_update_of_an_account_being_added(self):
+        store = self.open()
+        with store.lock:
+            store.pending['bob'] = 'one'  # add() in progress
+        store.update('bob', 'two')
+        store.flush()
+        self.assertEqual(self.open().get('bob'), 'two')
+        self.assertFalse(store.failed)
+
+
+class TextUpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'users.txt')
+        with open(self.path, 'w') as f:
+            f.write("(Tom, Tom11)\n(David, David22)\n(Tom, Tom33)")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_upgrade_removes_the_plaintext_password(self):
+        store = TextUserStore(self.path, sync='off')
+        stored = hash_password('Tom33', 1000)
+        store.update('Tom', stored)
+        self.assertTrue(store.add('Beth', 'Beth44'))
+        store.close()
+        with open(self.path) as f:
+            self.assertEqual(f.read(), f"(Tom, {stored})\n(David, David22)\n(Beth, Beth44)\n")
+        self.assertEqual(os.listdir(self.directory.name), ['users.txt'])
+
+
+if __name__ == "__main__":
+    unittest.main()